@@ -5,14 +5,18 @@ from hedgepig_logger import log
 from .. import nn_io
 from ..data_models import *
 from ..database import EmbeddingNeighborhoodDatabase
-from .paired_neighborhood_overlap import pairedOverlapDistributions
+from .paired_neighborhood_overlap import pairedOverlapArrayDistributions
 
-def analyzeInternalConfidence(src, config, db, k=5, outf=None, filter_spec=''):
+def analyzeInternalConfidence(src, config, db, k=5, outf=None, filter_spec='',
+        processes=1, neighbor_cache=None):
     src_neighbor_sets = []
+    if neighbor_cache is None:
+        neighbor_cache = nn_io.NeighborArrayCache()
+    vocab = neighbor_cache.vocab
 
     log.track('  >> [1/3] Loaded {0:,}/10 neighbor sets')
     for i in range(1,11):
-        src_neighbor_sets.append(nn_io.loadPairedNeighbors(
+        src_neighbor_sets.append(neighbor_cache.loadPairedNeighborArrays(
             src,
             i,
             src,
@@ -24,20 +28,21 @@ def analyzeInternalConfidence(src, config, db, k=5, outf=None, filter_spec=''):
     log.flushTracker()
     
     log.writeln('  >> [2/3] Calculating source self overlaps...')
-    src_self_distribs = pairedOverlapDistributions(
+    (keys, src_self_distribs) = pairedOverlapArrayDistributions(
         src_neighbor_sets,
         src_neighbor_sets,
-        self_paired=True
+        self_paired=True,
+        processes=processes
     )
 
     log.writeln('  >> [3/3] Adding overlap analyses to database...')
     confidences = []
-    for key in src_self_distribs:
+    for (key, confidence) in zip(keys.tolist(), src_self_distribs.tolist()):
         confidences.append(InternalConfidence(
             source=src,
             at_k=k,
-            key=key,
-            confidence=src_self_distribs[key]
+            key=vocab.keys[key],
+            confidence=confidence
         ))
     db.insertOrUpdate(confidences)
 
@@ -63,6 +68,9 @@ if __name__ == '__main__':
         parser.add_option('-k', '--nearest-neighbors', dest='k',
             help='number of nearest neighbors to use in statistics (default: %default)',
             type='int', default=5)
+        parser.add_option('--processes', dest='processes',
+            help='number of processes to compare replicate pairs with (default: %default)',
+            type='int', default=1)
         parser.add_option('--dump', dest='dumpf',
             help='(optional) file to dump confidence values to (in addition to DB export)')
         parser.add_option('-l', '--logfile', dest='logfile',
@@ -81,6 +89,7 @@ if __name__ == '__main__':
         ('Filter specifier', options.filter_spec),
         ('Configuration file', options.configf),
         ('Number of nearest neighbors to analyze', options.k),
+        ('Number of processes', options.processes),
         ('Output dump file', '--unused--' if not options.dumpf else options.dumpf),
     ], 'Paired neighborhood analysis')
 
@@ -101,8 +110,13 @@ if __name__ == '__main__':
         db,
         k=options.k,
         outf=options.dumpf,
-        filter_spec=options.filter_spec
+        filter_spec=options.filter_spec,
+        processes=options.processes
     )
     log.writeln('Extracted statistics.\n')
 
+    ## mark the DB as changed (once for the whole run), invalidating
+    ## cached dashboard responses
+    db.bumpGeneration()
+
     log.stop()
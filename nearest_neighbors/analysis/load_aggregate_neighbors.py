@@ -5,7 +5,7 @@ from ..data_models import *
 from ..database import *
 
 def loadAggregateNeighbors(src, trg, config, db, k=10, neighbor_type=None,
-        spec='', filter_spec='', query_spec='', vocab_spec=''):
+        spec='', filter_spec='', query_spec='', vocab_spec='', on_conflict='warn'):
     log.writeln('  >> Loading pre-calculated aggregate nearest neighbors')
     aggregate_neighbors = nn_io.loadPairedNeighbors(
         src, None, trg, config, k, aggregate=True, with_distances=True,
@@ -28,7 +28,12 @@ def loadAggregateNeighbors(src, trg, config, db, k=10, neighbor_type=None,
                 neighbor_key=nbr_key,
                 mean_distance=dist
             ))
-    db.insertOrUpdate(nbrs, neighbor_type=neighbor_type)
+    conflicts = db.insertOrUpdate(nbrs, neighbor_type=neighbor_type,
+        on_conflict=on_conflict)
+    if len(conflicts) > 0:
+        log.writeln('  >> {0:,} neighbors conflicted with saved distances (policy: {1})'.format(
+            len(conflicts), on_conflict
+        ))
 
 
 if __name__ == '__main__':
@@ -55,6 +60,11 @@ if __name__ == '__main__':
             default='', help='specifier of query key set used to generate neighbor file')
         parser.add_option('--vocab-spec', dest='vocab_spec',
             default='', help='specifier of vocabulary set used to interpret neighbor file')
+        parser.add_option('--on-conflict', dest='on_conflict',
+            type='choice', choices=['warn', 'replace', 'abort'], default='warn',
+            help='how to handle neighbors already saved with a different distance:'
+                 ' keep saved values and warn (warn), overwrite them (replace),'
+                 ' or roll back and exit (abort) (default: %default)')
         parser.add_option('-l', '--logfile', dest='logfile',
             help='name of file to write log contents to (empty for stdout)',
             default=None)
@@ -83,6 +93,7 @@ if __name__ == '__main__':
         ('Key filter specifier', options.filter_spec),
         ('Query key set specifier', options.query_spec),
         ('Vocabulary set specifier', options.vocab_spec),
+        ('Conflict policy', options.on_conflict),
     ], 'Loading aggregate neighbors into DB')
 
     log.writeln('Reading configuration file from %s...' % options.configf)
@@ -110,8 +121,13 @@ if __name__ == '__main__':
         spec=options.neighbor_spec,
         filter_spec=options.filter_spec,
         query_spec=options.query_spec,
-        vocab_spec=options.vocab_spec
+        vocab_spec=options.vocab_spec,
+        on_conflict=options.on_conflict
     )
     log.writeln('Done.')
 
+    ## mark the DB as changed (once for the whole run), invalidating
+    ## cached dashboard responses
+    db.bumpGeneration()
+
     log.stop()
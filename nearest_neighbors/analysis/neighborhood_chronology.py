@@ -0,0 +1,117 @@
+'''
+Runs the internal confidence analysis for every corpus in CorpusOrdering,
+and the paired neighborhood overlap analysis for every consecutive pair of
+corpora, in a single process so that parsed neighbor files are shared
+between analyses.
+'''
+
+import configparser
+from hedgepig_logger import log
+from .. import nn_io
+from ..database import EmbeddingNeighborhoodDatabase
+from .internal_confidence import analyzeInternalConfidence
+from .paired_neighborhood_overlap import analyzeOverlap
+
+def analyzeChronology(corpora, config, db, ks=(5,), filter_spec='',
+        processes=1, neighbor_cache=None):
+    '''Runs all analyses for each corpus in turn, over every k in ks while
+    that corpus's neighbor files are loaded (the same cached arrays serve
+    any k), so neighbor_cache only needs to hold the files for one corpus
+    and its predecessor (30 files).
+    '''
+    if neighbor_cache is None:
+        neighbor_cache = nn_io.NeighborArrayCache()
+
+    for i in range(len(corpora)):
+        for k in ks:
+            log.writeln('Analyzing {0} internal confidence @ {1}...'.format(corpora[i], k))
+            analyzeInternalConfidence(
+                corpora[i],
+                config,
+                db,
+                k=k,
+                filter_spec=filter_spec,
+                processes=processes,
+                neighbor_cache=neighbor_cache
+            )
+
+        if i > 0:
+            for k in ks:
+                log.writeln('Analyzing {0}/{1} neighbors @ {2}...'.format(corpora[i-1], corpora[i], k))
+                analyzeOverlap(
+                    corpora[i-1],
+                    corpora[i],
+                    config,
+                    db,
+                    k=k,
+                    filter_spec=filter_spec,
+                    processes=processes,
+                    neighbor_cache=neighbor_cache
+                )
+        log.writeln('  Neighbor file cache: {0:,} hits, {1:,} misses\n'.format(
+            neighbor_cache.hits, neighbor_cache.misses
+        ))
+
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog')
+        parser.add_option('--filter-spec', dest='filter_spec',
+            default='',
+            help='(optional) filter specifier')
+        parser.add_option('-c', '--config', dest='configf',
+            default='config.ini')
+        parser.add_option('-k', '--nearest-neighbors', dest='ks',
+            help='comma-separated numbers of nearest neighbors to use in statistics (default: %default)',
+            default='5')
+        parser.add_option('--processes', dest='processes',
+            help='number of processes to compare replicate pairs with (default: %default)',
+            type='int', default=1)
+        parser.add_option('--cache-size', dest='cache_size',
+            help='maximum number of parsed neighbor files to keep in memory (default: %default)',
+            type='int', default=40)
+        parser.add_option('-l', '--logfile', dest='logfile',
+            help='name of file to write log contents to (empty for stdout)',
+            default=None)
+        (options, args) = parser.parse_args()
+        options.ks = [int(k) for k in options.ks.split(',')]
+        return options
+
+    options = _cli()
+    log.start(options.logfile)
+    log.writeConfig([
+        ('Filter specifier', options.filter_spec),
+        ('Configuration file', options.configf),
+        ('Numbers of nearest neighbors to analyze', options.ks),
+        ('Number of processes', options.processes),
+        ('Neighbor file cache size', options.cache_size),
+    ], 'Paired neighborhood analysis over corpus chronology')
+
+    log.writeln('Reading configuration file from %s...' % options.configf)
+    config = configparser.ConfigParser()
+    config.read(options.configf)
+    config = config['PairedNeighborhoodAnalysis']
+    corpora = config['CorpusOrdering'].split(',')
+    log.writeln('Done.\n')
+
+    log.writeln('Loading embedding neighborhood database...')
+    db = EmbeddingNeighborhoodDatabase(config['DatabaseFile'])
+    log.writeln('Database ready.\n')
+
+    analyzeChronology(
+        corpora,
+        config,
+        db,
+        ks=options.ks,
+        filter_spec=options.filter_spec,
+        processes=options.processes,
+        neighbor_cache=nn_io.NeighborArrayCache(max_size=options.cache_size)
+    )
+    log.writeln('Extracted statistics.\n')
+
+    ## mark the DB as changed (once for the whole run), invalidating
+    ## cached dashboard responses
+    db.bumpGeneration()
+
+    log.stop()
@@ -1,4 +1,5 @@
 import configparser
+import multiprocessing as mp
 import numpy as np
 from hedgepig_logger import log
 from .. import nn_io
@@ -55,6 +56,154 @@ def pairedOverlapDistributions(neighbor_sets_1, neighbor_sets_2, self_paired=Fal
 
     return overlap_percentage_means
 
+def neighborhoodOverlapArrays(keys_1, neighbors_1, keys_2, neighbors_2):
+    '''Array equivalent of getNeighborhoodOverlap, for (keys, neighbors)
+    arrays of IDs in a shared vocabulary (as from loadPairedNeighborArrays).
+
+    Returns (keys, overlaps) for the (sorted) union of keys.
+    '''
+    keys = np.union1d(keys_1, keys_2)
+    rows_1 = _alignedNeighborRows(keys, keys_1, neighbors_1)
+    rows_2 = _alignedNeighborRows(keys, keys_2, neighbors_2)
+
+    # neighbor lists are treated as sets, as in getNeighborhoodOverlap
+    rows_1 = _uniqueRows(rows_1)
+    rows_2 = _uniqueRows(rows_2)
+
+    # compare neighbor lists pairwise in blocks of rows, with bounded memory
+    block_size = max(1, (2**24) // max(1, rows_1.shape[1] * rows_2.shape[1]))
+    overlap_counts = np.zeros(len(keys), dtype=np.int64)
+    for start in range(0, len(keys), block_size):
+        block_1 = rows_1[start:start+block_size]
+        block_2 = rows_2[start:start+block_size]
+        matches = (
+            (block_1[:, :, np.newaxis] == block_2[:, np.newaxis, :])
+            & (block_1[:, :, np.newaxis] >= 0)
+        )
+        overlap_counts[start:start+block_size] = matches.any(axis=2).sum(axis=1)
+
+    sizes = np.maximum(
+        (rows_1 >= 0).sum(axis=1),
+        (rows_2 >= 0).sum(axis=1)
+    )
+    # a key with no neighbors in either set has no defined overlap (the
+    # same as in getNeighborhoodOverlap)
+    empty = (sizes == 0)
+    if empty.any():
+        raise ZeroDivisionError('No neighbors in either set for {0:,} key(s) (e.g., {1})'.format(
+            int(empty.sum()), keys[empty][0]
+        ))
+    return keys, overlap_counts / sizes
+
+def _alignedNeighborRows(keys, row_keys, neighbors):
+    '''Rows of neighbors for each of keys (all -1 if key not in row_keys)'''
+    positions = np.full(int(keys.max(initial=-1)) + 1, -1, dtype=np.int64)
+    positions[row_keys] = np.arange(len(row_keys))
+    positions = positions[keys]
+    rows = np.full((len(keys), neighbors.shape[1]), -1, dtype=neighbors.dtype)
+    rows[positions >= 0] = neighbors[positions[positions >= 0]]
+    return rows
+
+def _uniqueRows(rows):
+    '''Replaces repeated IDs within each row with -1'''
+    rows = np.sort(rows, axis=1)
+    repeated = np.zeros(rows.shape, dtype=bool)
+    repeated[:, 1:] = (rows[:, 1:] == rows[:, :-1])
+    rows[repeated] = -1
+    return rows
+
+def pairedOverlapArrayDistributions(neighbor_sets_1, neighbor_sets_2, self_paired=False,
+        processes=1):
+    '''Array equivalent of pairedOverlapDistributions, for lists of
+    (keys, neighbors) arrays in a shared vocabulary.
+
+    If processes > 1, set pairs are compared in a process pool, with the
+    neighbor arrays placed once in shared memory for all workers.
+
+    Returns (keys, mean overlaps) arrays; each mean is calculated exactly
+    as np.mean over that key's samples, so results are identical to
+    pairedOverlapDistributions.
+    '''
+    pairs = []
+    for i in range(len(neighbor_sets_1)):
+        inner_loop_start = (i+1) if self_paired else 0
+        for j in range(inner_loop_start, len(neighbor_sets_2)):
+            pairs.append((i, j))
+
+    if processes > 1:
+        key_overlaps = _parallelOverlaps(neighbor_sets_1, neighbor_sets_2,
+            pairs, processes)
+    else:
+        key_overlaps = [
+            neighborhoodOverlapArrays(*neighbor_sets_1[i], *neighbor_sets_2[j])
+                for (i, j) in pairs
+        ]
+    return _meanOverlaps(key_overlaps)
+
+def _parallelOverlaps(neighbor_sets_1, neighbor_sets_2, pairs, processes):
+    same_sets = neighbor_sets_1 is neighbor_sets_2
+    shared_1 = nn_io.SharedMatrices(
+        [array for neighbor_set in neighbor_sets_1 for array in neighbor_set],
+        dtype=np.int32
+    )
+    if same_sets:
+        shared_2 = shared_1
+    else:
+        shared_2 = nn_io.SharedMatrices(
+            [array for neighbor_set in neighbor_sets_2 for array in neighbor_set],
+            dtype=np.int32
+        )
+    try:
+        with mp.Pool(
+                    processes,
+                    initializer=_initOverlapWorker,
+                    initargs=(shared_1.descriptors, shared_2.descriptors)
+                ) as pool:
+            # results are returned in pair order, to keep sample order
+            key_overlaps = pool.map(_pairOverlap, pairs)
+    finally:
+        shared_1.release()
+        if not same_sets:
+            shared_2.release()
+    return key_overlaps
+
+_worker_neighbor_sets = None
+
+def _initOverlapWorker(descriptors_1, descriptors_2):
+    global _worker_neighbor_sets
+    (blocks_1, arrays_1) = nn_io.attachSharedMatrices(descriptors_1)
+    (blocks_2, arrays_2) = nn_io.attachSharedMatrices(descriptors_2)
+    _worker_neighbor_sets = (
+        blocks_1 + blocks_2,
+        list(zip(arrays_1[0::2], arrays_1[1::2])),
+        list(zip(arrays_2[0::2], arrays_2[1::2]))
+    )
+
+def _pairOverlap(pair):
+    (_, neighbor_sets_1, neighbor_sets_2) = _worker_neighbor_sets
+    (i, j) = pair
+    return neighborhoodOverlapArrays(*neighbor_sets_1[i], *neighbor_sets_2[j])
+
+def _meanOverlaps(key_overlaps):
+    '''Reduce a list of (keys, overlaps) samples to (keys, mean overlaps)'''
+    keys = np.unique(np.concatenate(
+        [keys for (keys, _) in key_overlaps]
+        + [np.zeros(0, dtype=np.int32)]
+    ))
+
+    # one (contiguous) row of samples per key, in sample order
+    samples = np.full((len(keys), len(key_overlaps)), np.nan)
+    for (p, (sample_keys, overlaps)) in enumerate(key_overlaps):
+        samples[np.searchsorted(keys, sample_keys), p] = overlaps
+
+    sampled = ~np.isnan(samples)
+    complete = sampled.all(axis=1)
+    means = np.zeros(len(keys))
+    means[complete] = np.mean(samples[complete], axis=1)
+    for ix in np.flatnonzero(~complete):
+        means[ix] = np.mean(samples[ix][sampled[ix]])
+    return keys, means
+
 def rankKeysByMeanDeltaFromBaseline(control_overlap_percentage_means,
         experimental_overlap_percentage_means):
     keys = set(control_overlap_percentage_means.keys()) \
@@ -78,13 +227,17 @@ def rankKeysByMeanDeltaFromBaseline(control_overlap_percentage_means,
 
 
 def analyzeOverlap(src, trg, config, db, k=5,
-        confidence_threshold=0.5, filter_spec=''):
+        confidence_threshold=0.5, filter_spec='', processes=1,
+        neighbor_cache=None):
     src_neighbor_sets = []
     trg_neighbor_sets = []
+    if neighbor_cache is None:
+        neighbor_cache = nn_io.NeighborArrayCache()
+    vocab = neighbor_cache.vocab
 
     log.track('  >> [1/3] Loaded {0:,}/10 neighbor sets')
     for i in range(1,11):
-        src_neighbor_sets.append(nn_io.loadPairedNeighbors(
+        src_neighbor_sets.append(neighbor_cache.loadPairedNeighborArrays(
             src,
             i,
             trg,
@@ -92,7 +245,7 @@ def analyzeOverlap(src, trg, config, db, k=5,
             k=k,
             filter_spec=filter_spec
         ))
-        trg_neighbor_sets.append(nn_io.loadPairedNeighbors(
+        trg_neighbor_sets.append(neighbor_cache.loadPairedNeighborArrays(
             trg,
             i,
             src,
@@ -104,22 +257,23 @@ def analyzeOverlap(src, trg, config, db, k=5,
     log.flushTracker()
 
     log.writeln('  >> [2/3] Calculating cross overlaps...')
-    cross_distribs = pairedOverlapDistributions(
+    (keys, en_similarities) = pairedOverlapArrayDistributions(
         src_neighbor_sets,
         trg_neighbor_sets,
-        self_paired=False
+        self_paired=False,
+        processes=processes
     )
 
     log.writeln('  >> [3/3] Adding overlap analyses to database...')
 
     overlaps = []
-    for (key, en_similarity) in cross_distribs.items():
+    for (key, en_similarity) in zip(keys.tolist(), en_similarities.tolist()):
         overlaps.append(EntityOverlapAnalysis(
             source=src,
             target=trg,
             filter_set=filter_spec,
             at_k=k,
-            key=key,
+            key=vocab.keys[key],
             EN_similarity=en_similarity
         ))
     db.insertOrUpdate(overlaps)
@@ -140,6 +294,9 @@ if __name__ == '__main__':
         parser.add_option('-k', '--nearest-neighbors', dest='k',
             help='number of nearest neighbors to use in statistics (default: %default)',
             type='int', default=5)
+        parser.add_option('--processes', dest='processes',
+            help='number of processes to compare replicate pairs with (default: %default)',
+            type='int', default=1)
         parser.add_option('-m', '--string-map', dest='string_mapf',
             help='file mapping embedding keys to strings')
         parser.add_option('-l', '--logfile', dest='logfile',
@@ -162,6 +319,7 @@ if __name__ == '__main__':
         ('Filter specifier', options.filter_spec),
         ('Configuration file', options.configf),
         ('Number of nearest neighbors to analyze', options.k),
+        ('Number of processes', options.processes),
         ('String map file', options.string_mapf)
     ], 'Paired neighborhood analysis')
 
@@ -189,8 +347,13 @@ if __name__ == '__main__':
         config,
         db,
         k=options.k,
-        filter_spec=options.filter_spec
+        filter_spec=options.filter_spec,
+        processes=options.processes
     )
     log.writeln('Extracted statistics.\n')
 
+    ## mark the DB as changed (once for the whole run), invalidating
+    ## cached dashboard responses
+    db.bumpGeneration()
+
     log.stop()
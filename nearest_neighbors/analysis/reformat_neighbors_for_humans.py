@@ -49,7 +49,7 @@ if __name__ == '__main__':
 
     node_map = nn_io.readNodeMap(options.vocabf)
 
-    neighbors = nn_io.readNeighborFile(
+    neighbors = nn_io.NeighborTable.read(
         options.inputf,
         k=options.k,
         node_map=node_map,
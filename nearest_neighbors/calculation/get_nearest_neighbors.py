@@ -3,10 +3,13 @@ Get the top k nearest neighbors for a set of embeddings and save to a file
 '''
 
 import multiprocessing as mp
-import tensorflow as tf
 import numpy as np
 import codecs
+import datetime
+import json
+import hashlib
 import os
+import time
 import pyemblib
 from hedgepig_logger import log
 from drgriffis.common import util
@@ -19,141 +22,580 @@ class _SIGNALS:
 
 def KNearestNeighbors(emb_arrs, node_IDs, top_k, neighbor_file, threads=2,
         batch_size=5, completed_neighbors=None, with_distances=False,
-        neighbor_file_mode='w'):
-    '''docstring goes here
+        neighbor_file_mode='w', block_size=50000, fused=False, binary=False,
+        binary_distance_dtype=np.float32, checkpoint=False, checkpoint_interval=60,
+        checkpoint_inputs=None,
+        approximate=False, ivf_lists=None, ivf_probes=8, recall_sample=1000):
+    '''Finds the top_k nearest neighbors (by cosine distance, averaged over
+    replicates) of every row in emb_arrs among the other rows, and writes
+    them to neighbor_file, with rows identified by node_IDs.
+
+    Rows are split into batches of batch_size indices, which are put on a
+    shared task queue and taken by the first free worker (threads-1
+    workers, plus one writer process); batches finish out of order, but
+    each is written as a unit. Indices listed in completed_neighbors are
+    skipped.
+
+    If checkpoint is True, the completed index ranges are recorded in a
+    manifest alongside neighbor_file (at most every checkpoint_interval
+    seconds, and at the end), and a later call with the same settings
+    and checkpoint_inputs (the input files the arrays were read from)
+    resumes where that one stopped. The manifest is kept after the call
+    returns (a later phase may write to the same file); remove it with
+    _Checkpoint.remove once the whole job is done.
+
+    Raises RuntimeError if any worker or the writer fails, or fewer
+    neighbor rows are written than were queued.
+
+    See _shareTargets and _attachModel for the block_size, fused and
+    approximate (IVF) search settings, and nn_io.BinaryNeighborFile for
+    the binary output format.
     '''
     # set up threads
     log.writeln('1 | Thread initialization')
-    all_indices = list(range(len(emb_arrs[0])))
-    if completed_neighbors:
-        filtered_indices = []
-        for ix in all_indices:
-            if not ix in completed_neighbors:
-                filtered_indices.append(ix)
-        all_indices = filtered_indices
-        log.writeln('  >> Filtered out {0:,} completed indices'.format(len(emb_arrs[0]) - len(filtered_indices)))
-        log.writeln('  >> Filtered set size: {0:,}'.format(len(all_indices)))
-    index_subsets = util.prepareForParallel(all_indices, threads-1, data_only=True)
+    if checkpoint:
+        checkpoint = _Checkpoint(neighbor_file, 'KNearestNeighbors',
+            len(emb_arrs[0]), _checkpointSettings(top_k, with_distances,
+                binary, binary_distance_dtype, approximate, node_IDs,
+                node_IDs, checkpoint_inputs),
+            interval=checkpoint_interval)
+        neighbor_file_mode = checkpoint.prepareFile(binary, neighbor_file_mode)
+    else:
+        checkpoint = None
+    task_q = mp.Queue()
+    num_samples = _queueBatches(task_q, len(emb_arrs[0]), batch_size,
+        completed_neighbors, threads-1, checkpoint=checkpoint)
+    # unit norm the embeddings (and build any index) once, and share
+    # them with all workers
+    (shared_embs, model_settings, recall_models) = _shareTargets(emb_arrs,
+        block_size, fused, approximate, ivf_lists, ivf_probes, recall_sample)
+    if recall_models:
+        sample = np.random.RandomState(1).choice(len(emb_arrs[0]),
+            min(recall_sample, len(emb_arrs[0])), replace=False)
+        _reportRecall(recall_models, sample, top_k, indices=True, no_self=True)
     nn_q = mp.Queue()
+    num_written = mp.Value('q', 0)
     nn_writer = mp.Process(
         target=_nn_writer,
-        args=(neighbor_file, node_IDs, None, nn_q, with_distances, neighbor_file_mode)
+        args=(neighbor_file, node_IDs, None, nn_q, with_distances, neighbor_file_mode, num_samples,
+            top_k, binary, binary_distance_dtype, checkpoint, num_written)
     )
     computers = [
         mp.Process(
             target=_threadedNeighbors,
-            args=(index_subsets[i], emb_arrs, batch_size, top_k, nn_q, with_distances)
+            args=(task_q, model_settings, top_k, nn_q, with_distances)
         )
             for i in range(threads - 1)
     ]
     nn_writer.start()
     log.writeln('2 | Neighbor computation')
-    util.parallelExecute(computers)
+    try:
+        util.parallelExecute(computers)
+    finally:
+        for shared in shared_embs:
+            shared.release()
     nn_q.put(_SIGNALS.HALT)
     nn_writer.join()
+    _checkCompleted(computers, nn_writer, num_written.value, num_samples)
 
 def KNearestNeighborsFromQueries(emb_arrs, node_IDs, query_emb_arrs,
         query_node_IDs, top_k, neighbor_file, threads=2,
         batch_size=5, completed_neighbors=None, with_distances=False,
-        neighbor_file_mode='w'):
-    '''docstring goes here
+        neighbor_file_mode='w', block_size=50000, fused=False, binary=False,
+        binary_distance_dtype=np.float32, checkpoint=False, checkpoint_interval=60,
+        checkpoint_inputs=None,
+        approximate=False, ivf_lists=None, ivf_probes=8, recall_sample=1000):
+    '''Finds the top_k nearest neighbors in emb_arrs (identified by
+    node_IDs) of every row in query_emb_arrs (identified by
+    query_node_IDs), and writes them to neighbor_file.
+
+    Queries are scheduled, skipped (completed_neighbors holds query
+    indices) and checkpointed as in KNearestNeighbors; checkpoints are
+    tracked separately for each of the two functions, so both can write
+    to the same neighbor_file.
     '''
     # set up threads
     log.writeln('1 | Thread initialization')
-    all_indices = list(range(len(query_emb_arrs[0])))
-    log.writeln('  ALL INDICES COUNT: %d' % len(all_indices))
-    if completed_neighbors:
-        filtered_indices = []
-        for ix in all_indices:
-            if not ix in completed_neighbors:
-                filtered_indices.append(ix)
-        all_indices = filtered_indices
-        log.writeln('  >> Filtered out {0:,} completed indices'.format(len(emb_arrs[0]) - len(filtered_indices)))
-        log.writeln('  >> Filtered set size: {0:,}'.format(len(all_indices)))
-    index_subsets = util.prepareForParallel(all_indices, threads-1, data_only=True)
+    if checkpoint:
+        checkpoint = _Checkpoint(neighbor_file, 'KNearestNeighborsFromQueries',
+            len(query_emb_arrs[0]), _checkpointSettings(top_k, with_distances,
+                binary, binary_distance_dtype, approximate, query_node_IDs,
+                node_IDs, checkpoint_inputs),
+            interval=checkpoint_interval)
+        neighbor_file_mode = checkpoint.prepareFile(binary, neighbor_file_mode)
+    else:
+        checkpoint = None
+    task_q = mp.Queue()
+    num_samples = _queueBatches(task_q, len(query_emb_arrs[0]), batch_size,
+        completed_neighbors, threads-1, checkpoint=checkpoint)
+    # unit norm the target embeddings (and build any index) once, and
+    # share them (and the query embeddings) with all workers
+    (shared_embs, model_settings, recall_models) = _shareTargets(emb_arrs,
+        block_size, fused, approximate, ivf_lists, ivf_probes, recall_sample)
+    if recall_models:
+        sample = np.random.RandomState(1).choice(len(query_emb_arrs[0]),
+            min(recall_sample, len(query_emb_arrs[0])), replace=False)
+        _reportRecall(recall_models, [q[sample] for q in query_emb_arrs], top_k,
+            indices=False, no_self=False)
+    shared_query_embs = nn_io.SharedMatrices(query_emb_arrs)
     nn_q = mp.Queue()
+    num_written = mp.Value('q', 0)
     nn_writer = mp.Process(
         target=_nn_writer,
-        args=(neighbor_file, node_IDs, query_node_IDs, nn_q, with_distances, neighbor_file_mode)
+        args=(neighbor_file, node_IDs, query_node_IDs, nn_q, with_distances, neighbor_file_mode, num_samples,
+            top_k, binary, binary_distance_dtype, checkpoint, num_written)
     )
     computers = [
         mp.Process(
             target=_threadedCrossSetNeighbors,
-            args=(index_subsets[i], query_emb_arrs, emb_arrs, batch_size, top_k, nn_q, with_distances)
+            args=(task_q, shared_query_embs.descriptors, model_settings, top_k, nn_q, with_distances)
         )
             for i in range(threads - 1)
     ]
     nn_writer.start()
     log.writeln('2 | Neighbor computation')
-    util.parallelExecute(computers)
+    try:
+        util.parallelExecute(computers)
+    finally:
+        for shared in shared_embs:
+            shared.release()
+        shared_query_embs.release()
     nn_q.put(_SIGNALS.HALT)
     nn_writer.join()
+    _checkCompleted(computers, nn_writer, num_written.value, num_samples)
+
+def _checkCompleted(computers, nn_writer, num_written, num_samples):
+    '''Raises RuntimeError if any worker or the writer process exited
+    with an error, or the writer wrote fewer samples than were queued
+    (leaving any checkpoint in place to resume from).
+    '''
+    failed = [
+        'worker %d (exit code %s)' % (i+1, computers[i].exitcode)
+            for i in range(len(computers))
+                if computers[i].exitcode != 0
+    ]
+    if nn_writer.exitcode != 0:
+        failed.append('writer (exit code %s)' % nn_writer.exitcode)
+    if len(failed) > 0:
+        raise RuntimeError('Nearest neighbor computation failed: %s' % ', '.join(failed))
+    if num_written != num_samples:
+        raise RuntimeError('Nearest neighbor computation incomplete: wrote {0:,} of {1:,} samples'.format(
+            num_written, num_samples
+        ))
+
+def _queueBatches(task_q, num_indices, batch_size, completed_neighbors, num_workers,
+        checkpoint=None):
+    '''Splits [0, num_indices) into ranges of batch_size indices, and
+    queues each range (minus any completed indices, either listed in
+    completed_neighbors or recorded in checkpoint) as a task for the
+    first available worker, followed by one HALT per worker.
+
+    Returns the number of samples queued.
+    '''
+    if checkpoint and checkpoint.resuming:
+        completed_mask = checkpoint.completedMask()
+        log.writeln('  >> Resuming from checkpoint {0} ({1:,} indices already completed)'.format(
+            checkpoint.path, int(completed_mask.sum())
+        ))
+    else:
+        completed_mask = np.zeros(num_indices, dtype=bool)
+
+    num_samples, num_filtered = 0, 0
+    for start in range(0, num_indices, batch_size):
+        end = min(start + batch_size, num_indices)
+        batch = [
+            ix for ix in range(start, end)
+                if not (completed_mask[ix] or (completed_neighbors and ix in completed_neighbors))
+        ]
+        num_filtered += (end - start) - len(batch)
+        if len(batch) > 0:
+            task_q.put((start, end, batch))
+            num_samples += len(batch)
+    for _ in range(num_workers):
+        task_q.put(_SIGNALS.HALT)
+
+    if completed_neighbors or num_filtered > 0:
+        log.writeln('  >> Filtered out {0:,} completed indices'.format(num_filtered))
+        log.writeln('  >> Filtered set size: {0:,}'.format(num_samples))
+    return num_samples
+
+def _checkpointSettings(top_k, with_distances, binary, binary_distance_dtype,
+        approximate, query_node_IDs, target_node_IDs, inputs):
+    '''Settings a checkpoint must match to be resumed: the neighbor file
+    format, the query and target node ID sets (as SHA-1 fingerprints), and
+    the path, size and modification time of each input file.
+    '''
+    def _fingerprint(IDs):
+        return hashlib.sha1(np.asarray(IDs, dtype=np.int64).tobytes()).hexdigest()
+    def _identity(fpath):
+        stat = os.stat(fpath)
+        return [os.path.abspath(fpath), stat.st_size, stat.st_mtime_ns]
+    return {
+        'top_k': top_k,
+        'with_distances': bool(with_distances),
+        'binary': bool(binary),
+        'binary_distance_dtype': (np.dtype(binary_distance_dtype).name if binary else None),
+        'approximate': bool(approximate),
+        'query_IDs': _fingerprint(query_node_IDs),
+        'target_IDs': _fingerprint(target_node_IDs),
+        'inputs': [_identity(f) for f in (inputs or [])],
+    }
+
+class _Checkpoint:
+    '''Manifest of the index ranges already written to a neighbor file
+    (stored alongside it as <neighbor file>.checkpoint), used to resume
+    an interrupted job.
+
+    The manifest is only updated after neighbor output has been flushed
+    and fsynced, and is replaced atomically, so it never claims more than
+    is safely on disk; for text files it also records the file size, so
+    any partial output past the last checkpoint can be truncated away.
+    Ranges are tracked separately for each phase (KNearestNeighbors or
+    KNearestNeighborsFromQueries) writing to the same file, along with the
+    settings (see _checkpointSettings) they were computed with; resuming
+    with different settings is refused.
+    '''
+
+    def __init__(self, neighbor_file, phase, num_indices, settings, interval=60):
+        self.path = '%s.checkpoint' % neighbor_file
+        self._neighbor_file = neighbor_file
+        self._phase = phase
+        self._num_indices = num_indices
+        self._settings = settings
+        self._interval = interval
+
+        self._state = {'offset': None, 'phases': {}}
+        if os.path.isfile(self.path) and os.path.isfile(neighbor_file):
+            with open(self.path, 'r') as stream:
+                self._state = json.load(stream)
+
+        phase_state = self._state['phases'].get(phase, None)
+        self.resuming = not (phase_state is None)
+        if phase_state is None:
+            self._completed = []
+        elif phase_state['num_indices'] != num_indices:
+            raise ValueError('Checkpoint {0} is for {1:,} indices, but {2:,} were given'.format(
+                self.path, phase_state['num_indices'], num_indices
+            ))
+        elif phase_state.get('settings', None) != settings:
+            stored = phase_state.get('settings', None) or {}
+            mismatched = sorted(
+                key for key in set(stored.keys()) | set(settings.keys())
+                    if stored.get(key, None) != settings.get(key, None)
+            )
+            raise ValueError('Checkpoint {0} was written with different settings ({1});'
+                ' remove it to start over'.format(self.path, ', '.join(mismatched)))
+        else:
+            self._completed = phase_state['completed']
+        self._last_save_time = time.time()
+
+    def completedMask(self):
+        mask = np.zeros(self._num_indices, dtype=bool)
+        for (start, end) in self._completed:
+            mask[start:end] = True
+        return mask
+
+    def prepareFile(self, binary, neighbor_file_mode):
+        '''Truncates any (text) output past the last checkpoint, and
+        returns the mode to open the neighbor file in.
+        '''
+        if len(self._state['phases']) == 0:
+            return neighbor_file_mode
+        if (not binary) and (not self._state['offset'] is None):
+            with open(self._neighbor_file, 'r+b') as stream:
+                stream.truncate(self._state['offset'])
+        return 'a'
+
+    def addRange(self, start, end):
+        self._completed.append([start, end])
+
+    def due(self):
+        return (time.time() - self._last_save_time) >= self._interval
+
+    def save(self, offset=None):
+        # merge completed ranges to keep the manifest small
+        merged = []
+        for (start, end) in sorted(self._completed):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self._completed = merged
+
+        self._state['phases'][self._phase] = {
+            'num_indices': self._num_indices,
+            'settings': self._settings,
+            'completed': merged,
+        }
+        if not offset is None:
+            self._state['offset'] = offset
+
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as stream:
+            json.dump(self._state, stream)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(tmp_path, self.path)
+        self._last_save_time = time.time()
+
+    @staticmethod
+    def remove(neighbor_file):
+        path = '%s.checkpoint' % neighbor_file
+        if os.path.isfile(path):
+            os.remove(path)
+
+class _ProgressTracker:
+    '''Logs the number of samples processed so far, with throughput
+    and estimated time remaining, at most every write_interval seconds.
+    '''
+
+    def __init__(self, total, write_interval=30):
+        self._total = total
+        self._processed = 0
+        self._write_interval = write_interval
+        self._start_time = time.time()
+        self._last_write_time = self._start_time
+
+    @property
+    def processed(self):
+        return self._processed
+
+    def update(self, num_samples):
+        self._processed += num_samples
+        now = time.time()
+        if (now - self._last_write_time) >= self._write_interval:
+            self._last_write_time = now
+            self.write()
+
+    def write(self):
+        elapsed = time.time() - self._start_time
+        rate = self._processed / elapsed if elapsed > 0 else 0
+        if rate > 0:
+            eta = datetime.timedelta(seconds=int((self._total - self._processed) / rate))
+        else:
+            eta = '--'
+        log.writeln('  >> Processed {0:,}/{1:,} samples ({2:.1f} samples/s, ETA {3})'.format(
+            self._processed, self._total, rate, eta
+        ))
+
+def _nn_writer(neighborf, node_IDs, query_node_IDs, nn_q, with_distances, neighbor_file_mode, total,
+        top_k, binary, binary_distance_dtype, checkpoint, num_written):
+    node_IDs = np.array(node_IDs)
+    if query_node_IDs is None:
+        query_node_IDs = node_IDs
+    else:
+        query_node_IDs = np.array(query_node_IDs)
 
-def _nn_writer(neighborf, node_IDs, query_node_IDs, nn_q, with_distances, neighbor_file_mode):
-    stream = open(neighborf, neighbor_file_mode)
-    stream.write('# File format is:\n# <word vocab index>,<NN 1>,<NN 2>,...\n')
+    if binary:
+        # rows in the binary file are in query index order
+        if neighbor_file_mode == 'a' and os.path.isfile(neighborf):
+            nbr_file = nn_io.BinaryNeighborFile(neighborf, mode='r+')
+        else:
+            nbr_file = nn_io.BinaryNeighborFile.create(
+                neighborf,
+                query_node_IDs,
+                top_k,
+                distance_dtype=(binary_distance_dtype if with_distances else None)
+            )
+    else:
+        stream = open(neighborf, neighbor_file_mode)
+        if not (checkpoint and checkpoint.resuming):
+            stream.write('# File format is:\n# <word vocab index>,<NN 1>,<NN 2>,...\n')
+
+    def _checkpoint():
+        # make sure everything written so far is on disk before recording it
+        if binary:
+            nbr_file.flush()
+            checkpoint.save()
+        else:
+            stream.flush()
+            os.fsync(stream.fileno())
+            checkpoint.save(offset=os.fstat(stream.fileno()).st_size)
 
-    total = len(node_IDs) if query_node_IDs is None else len(query_node_IDs)
+    if checkpoint:
+        _checkpoint()
 
+    progress = _ProgressTracker(total)
     result = nn_q.get()
-    log.track(message='  >> Processed {0}/{1:,} samples'.format('{0:,}', total), writeInterval=50)
     while result != _SIGNALS.HALT:
-        (ix, neighbors) = result
-        if with_distances:
-            mapped_neighbors = [
-                (node_IDs[nbr], dist)
-                    for (nbr, dist) in neighbors
-            ]
-        else:
-            mapped_neighbors = [
-                node_IDs[nbr]
-                    for nbr in neighbors
-            ]
+        (_, start, end, batch, neighbors, distances) = result
+        # map indices to node IDs for the whole batch (keeping any
+        # padding as -1)
+        mapped_neighbors = np.where(neighbors >= 0, node_IDs[neighbors], -1)
 
-        if query_node_IDs is None:
-            src_ID = node_IDs[ix]
+        if binary:
+            nbr_file.writeRows(batch, mapped_neighbors, distances)
         else:
-            src_ID = query_node_IDs[ix]
+            nn_io.writeNeighborFileLines(
+                stream,
+                query_node_IDs[batch],
+                mapped_neighbors,
+                distances=(distances if with_distances else None)
+            )
+        progress.update(len(batch))
+        if checkpoint:
+            checkpoint.addRange(start, end)
+            if checkpoint.due():
+                _checkpoint()
+        result = nn_q.get() 
+    if checkpoint:
+        _checkpoint()
+    if binary:
+        nbr_file.flush()
+    else:
+        stream.close()
+    progress.write()
+    # report back how much was written, to check the job finished
+    num_written.value = progress.processed
+
+def _shareTargets(emb_arrs, block_size, fused, approximate, ivf_lists, ivf_probes, recall_sample):
+    '''Prepares the target embedding matrices for the selected model, and
+    copies them into shared memory.
 
-        nn_io.writeNeighborFileLine(
-            stream,
-            src_ID,
-            mapped_neighbors,
-            with_distances=with_distances
+    Returns (list of SharedMatrices to release, settings for _attachModel,
+    (exact, approximate) models for a recall check or None).
+    '''
+    model_settings = {
+        'block_size': block_size,
+        'number_of_embeddings': len(emb_arrs),
+        'fused': fused,
+        'approximate': approximate,
+        'ivf_probes': ivf_probes,
+    }
+    recall_models = None
+    if approximate:
+        fused_matrix = model.fuseEmbeddings(emb_arrs)
+        if ivf_lists is None:
+            ivf_lists = int(np.sqrt(len(fused_matrix)))
+        t_sub = log.startTimer('  >> Building IVF index with {0:,} lists...'.format(ivf_lists))
+        index = model.IVFIndex.build(fused_matrix, ivf_lists, block_size=block_size)
+        log.stopTimer(t_sub, message='  >> Built index in {0:.2f}s')
+        shared = [
+            nn_io.SharedMatrices([fused_matrix]),
+            nn_io.SharedMatrices(index.arrays, dtype=None)
+        ]
+        model_settings['index_descriptors'] = shared[1].descriptors
+        if recall_sample > 0:
+            recall_models = (
+                model.FusedMultiNearestNeighbors(fused_matrix, len(emb_arrs),
+                    block_size=block_size),
+                model.IVFMultiNearestNeighbors(fused_matrix, len(emb_arrs), index,
+                    num_probes=ivf_probes, block_size=block_size)
+            )
+    elif fused:
+        shared = [nn_io.SharedMatrices([model.fuseEmbeddings(emb_arrs)])]
+    else:
+        shared = [nn_io.SharedMatrices(emb_arrs, unit_norm=True)]
+    model_settings['descriptors'] = shared[0].descriptors
+    return shared, model_settings, recall_models
+
+def _reportRecall(recall_models, sample_input, top_k, indices, no_self):
+    (exact_model, approximate_model) = recall_models
+    t_sub = log.startTimer('  >> Checking approximate recall@{0} on {1:,} samples...'.format(
+        top_k, len(sample_input if indices else sample_input[0])
+    ))
+    (exact, _) = exact_model.nearestNeighborArrays(sample_input, top_k,
+        indices=indices, no_self=no_self)
+    (approximate, _) = approximate_model.nearestNeighborArrays(sample_input, top_k,
+        indices=indices, no_self=no_self)
+    log.stopTimer(t_sub, message='  >> Recall@{0}: {1:.4f} ({2})'.format(
+        top_k, model.recallAtK(approximate, exact), '{0:.2f}s'
+    ))
+
+def _attachModel(model_settings):
+    (emb_blocks, emb_arrs) = nn_io.attachSharedMatrices(model_settings['descriptors'])
+    if model_settings['approximate']:
+        (index_blocks, index_arrs) = nn_io.attachSharedMatrices(model_settings['index_descriptors'])
+        emb_blocks.extend(index_blocks)
+        grph = model.IVFMultiNearestNeighbors(
+            emb_arrs[0],
+            model_settings['number_of_embeddings'],
+            model.IVFIndex(*index_arrs),
+            num_probes=model_settings['ivf_probes'],
+            block_size=model_settings['block_size']
         )
-        log.tick()
-        result = nn_q.get() 
-    log.flushTracker()
-
-def _threadedNeighbors(thread_indices, emb_arrs, batch_size, top_k, nn_q, with_distances):
-    sess = tf.Session()
-    grph = model.MultiNearestNeighbors(sess, emb_arrs)
-
-    ix = 0
-    while ix < len(thread_indices):
-        batch = thread_indices[ix:ix+batch_size]
-        nn = grph.nearestNeighbors(batch, indices=True, top_k=top_k, no_self=True, with_distances=with_distances)
-        for i in range(len(batch)):
-            nn_q.put((batch[i], nn[i]))
-        ix += batch_size
-
-def _threadedCrossSetNeighbors(thread_indices, src_emb_arrs, dest_emb_arrs, batch_size, top_k, nn_q, with_distances):
-    sess = tf.Session()
-    grph = model.MultiNearestNeighbors(sess, dest_emb_arrs)
-
-    ix = 0
-    while ix < len(thread_indices):
-        batch = thread_indices[ix:ix+batch_size]
-        nn = grph.nearestNeighbors(
+    elif model_settings['fused']:
+        grph = model.FusedMultiNearestNeighbors(
+            emb_arrs[0],
+            model_settings['number_of_embeddings'],
+            block_size=model_settings['block_size']
+        )
+    else:
+        grph = model.MultiNearestNeighbors(
+            emb_arrs,
+            block_size=model_settings['block_size'],
+            normed=True
+        )
+    return emb_blocks, grph
+
+def _queueBatchResult(nn_q, start, end, batch, neighbors, distances, with_distances):
+    # send the whole batch to the writer as compact arrays
+    nn_q.put((
+        _SIGNALS.COMPUTE,
+        start,
+        end,
+        np.array(batch, dtype=np.int32),
+        neighbors,
+        (distances if with_distances else None)
+    ))
+
+def _threadedNeighbors(task_q, model_settings, top_k, nn_q, with_distances):
+    (emb_blocks, grph) = _attachModel(model_settings)
+
+    task = task_q.get()
+    while task != _SIGNALS.HALT:
+        (start, end, batch) = task
+        (neighbors, distances) = grph.nearestNeighborArrays(batch, top_k, indices=True, no_self=True)
+        _queueBatchResult(nn_q, start, end, batch, neighbors, distances, with_distances)
+        task = task_q.get()
+
+def _threadedCrossSetNeighbors(task_q, src_emb_descriptors, model_settings, top_k, nn_q, with_distances):
+    (src_emb_blocks, src_emb_arrs) = nn_io.attachSharedMatrices(src_emb_descriptors)
+    (dest_emb_blocks, grph) = _attachModel(model_settings)
+
+    task = task_q.get()
+    while task != _SIGNALS.HALT:
+        (start, end, batch) = task
+        (neighbors, distances) = grph.nearestNeighborArrays(
             [src_emb_arr[batch] for src_emb_arr in src_emb_arrs],
+            top_k,
             indices=False,
-            top_k=top_k,
-            no_self=False,
-            with_distances=with_distances
+            no_self=False
         )
-        for i in range(len(batch)):
-            nn_q.put((batch[i], nn[i]))
-        ix += batch_size
+        _queueBatchResult(nn_q, start, end, batch, neighbors, distances, with_distances)
+        task = task_q.get()
+
+def _keyMask(lower_keys, key_set):
+    '''Boolean mask over lower_keys of membership in key_set.'''
+    return np.fromiter(
+        (k in key_set for k in lower_keys),
+        dtype=bool,
+        count=len(lower_keys)
+    )
+
+def _rowIndices(vocab, keys):
+    '''Row index in vocab of each of keys (matched after stripping, as in
+    node map files).
+    '''
+    index = {}
+    for i in range(len(vocab)):
+        index[vocab[i].strip()] = i
+    return np.array([
+        index[k] for k in keys
+    ], dtype=np.int64)
+
+def _selectRows(embed_sets, keys):
+    '''Slices the rows for keys out of each (vocab, matrix) embedding set;
+    row indices are only recalculated when the vocabulary changes.
+    '''
+    emb_arrs = []
+    prev_vocab, rows = None, None
+    for (vocab, matrix) in embed_sets:
+        if rows is None or not (vocab is prev_vocab or vocab == prev_vocab):
+            rows = _rowIndices(vocab, keys)
+            prev_vocab = vocab
+        emb_arrs.append(np.asarray(matrix[rows]))
+    return emb_arrs
 
 if __name__ == '__main__':
     def _cli():
@@ -173,15 +615,60 @@ if __name__ == '__main__':
         parser.add_option('--batch-size', dest='batch_size',
                 type='int', default=25,
                 help='number of points to process at once (default %default)')
+        parser.add_option('--block-size', dest='block_size',
+                type='int', default=50000,
+                help='number of vocabulary entries to compare each batch'
+                     ' against at once (default %default)')
+        parser.add_option('--fused', dest='fused',
+                action='store_true', default=False,
+                help='compute replicate-averaged similarity with a single matmul over'
+                     ' concatenated embeddings (faster, lower memory; distances may'
+                     ' differ in the last bits of floating point precision)')
+        parser.add_option('--approximate', dest='approximate',
+                action='store_true', default=False,
+                help='use an approximate (IVF) index over the fused replicate matrix'
+                     ' instead of exact search')
+        parser.add_option('--ivf-lists', dest='ivf_lists',
+                type='int', default=None,
+                help='number of k-means lists in the approximate index'
+                     ' (default: square root of vocabulary size)')
+        parser.add_option('--ivf-probes', dest='ivf_probes',
+                type='int', default=8,
+                help='number of closest lists to search per query in the approximate'
+                     ' index; higher is slower but more accurate (default: %default)')
+        parser.add_option('--recall-sample', dest='recall_sample',
+                type='int', default=1000,
+                help='number of queries to check approximate recall@k against exact'
+                     ' search on (0 to skip; default: %default)')
+        parser.add_option('--binary', dest='binary',
+                action='store_true', default=False,
+                help='write neighbors in fixed-width binary format (see'
+                     ' nn_io.BinaryNeighborFile) instead of text')
+        parser.add_option('--binary-distance-precision', dest='binary_distance_precision',
+                type='choice', choices=['float16', 'float32'], default='float32',
+                help='precision to store distances at in binary format (default: %default)')
         parser.add_option('--embedding-mode', dest='embedding_mode',
                 type='choice', choices=[pyemblib.Mode.Text, pyemblib.Mode.Binary], default=pyemblib.Mode.Binary,
                 help='embedding file is in text ({0}) or binary ({1}) format (default: %default)'.format(pyemblib.Mode.Text, pyemblib.Mode.Binary))
+        parser.add_option('--cache-dir', dest='cache_dir',
+            help='directory for caching embedding matrices in binary format;'
+                 ' cached matrices are memory-mapped on later runs instead'
+                 ' of re-parsing the embedding files',
+            default=None)
         parser.add_option('--draw-queries-from', dest='draw_queries_from',
                 help='comma-separated list of embedding files to use for neighborhood queries,'
                      ' instead of EMB1 EMB2 etc. Queries will still be compared to EMB1 EMB2 etc.'
                      ' If provided, must provide same number of embedding files as provided above.')
         parser.add_option('--partial-neighbors-file', dest='partial_neighbors_file',
-                help='file with partially calculated nearest neighbors (for resuming long-running job)')
+                help='file with partially calculated nearest neighbors (for resuming long-running job'
+                     ' without a checkpoint; otherwise, resuming is automatic)')
+        parser.add_option('--no-checkpoint', dest='checkpoint',
+                action='store_false', default=True,
+                help='do not write a checkpoint manifest for automatically resuming'
+                     ' an interrupted job')
+        parser.add_option('--checkpoint-interval', dest='checkpoint_interval',
+                type='float', default=60,
+                help='minimum number of seconds between checkpoints (default: %default)')
         parser.add_option('--shared-keys-with', dest='shared_keys_with',
                 help='another embedding file; if supplied, nearest neighbor computation'
                      ' will be constrained to those keys shared between EMB1 and this'
@@ -209,6 +696,9 @@ if __name__ == '__main__':
             if len(options.draw_queries_from) != len(args):
                 parser.error('If using --draw-queries-from, must provide same number'
                              ' of embedding files as given on command line!')
+        if options.binary and options.filtered_query_keys:
+            parser.error('--binary is not supported with --filtered-query-keys'
+                         ' (queries and targets are written to a single file)')
         if options.threads < 2:
             parser.print_help()
             parser.error('--threads must be at least 2')
@@ -226,13 +716,23 @@ if __name__ == '__main__':
                 for i in range(len(embedfs))
         ]),
         ('Input embedding file mode', options.embedding_mode),
+        ('Embedding cache directory', ('N/A' if not options.cache_dir else options.cache_dir)),
         ('Output neighbor file', options.outputf),
         ('Writing distance to neighbors', options.with_distances),
         ('Ordered vocabulary file', options.vocabf),
         ('Number of nearest neighbors', options.k),
         ('Batch size', options.batch_size),
+        ('Vocabulary block size', options.block_size),
+        ('Using fused replicate matrix', options.fused),
+        ('Approximate search', ('N/A' if not options.approximate else [
+            ('IVF lists', ('sqrt(vocab size)' if options.ivf_lists is None else options.ivf_lists)),
+            ('IVF probes', options.ivf_probes),
+            ('Recall check sample size', options.recall_sample),
+        ])),
+        ('Neighbor file format', ('binary ({0} distances)'.format(options.binary_distance_precision) if options.binary else 'text')),
         ('Number of threads', options.threads),
         ('Partial nearest neighbors file for resuming', options.partial_neighbors_file),
+        ('Checkpointing', ('every {0}s'.format(options.checkpoint_interval) if options.checkpoint else 'disabled')),
         ('Drawing queries from', ('N/A' if not options.draw_queries_from else [
             ('Query set %d' % (i+1), options.draw_queries_from[i])
                 for i in range(len(options.draw_queries_from))
@@ -243,26 +743,37 @@ if __name__ == '__main__':
     ], 'k Nearest Neighbor calculation with cosine similarity')
 
     ## TODO: convert to using an EmbeddingReplicates object
-    embeds = []
+    # each replicate is held as a (vocabulary, matrix) pair; filtering
+    # below only computes row selections, which are applied to the
+    # matrices once node IDs are assigned
+    embed_sets = []
     for i in range(len(embedfs)):
         t_sub = log.startTimer('Reading embeddings (set %d) from %s...' % (i, embedfs[i]))
-        these_embeds = pyemblib.read(embedfs[i], mode=options.embedding_mode, errors='replace')
+        these_embeds = nn_io.readEmbeddings(embedfs[i], options.embedding_mode, cache_dir=options.cache_dir)
+        embed_sets.append(nn_io.embeddingMatrix(these_embeds))
         log.stopTimer(t_sub, message='Read {0:,} embeddings in {1}s.\n'.format(len(these_embeds), '{0:.2f}'))
-        embeds.append(these_embeds)
+        these_embeds = None
 
     ## TODO: convert to using an EmbeddingReplicates object
-    query_embeds = None
+    query_embed_sets = None
     if options.draw_queries_from:
-        query_embeds = []
+        query_embed_sets = []
         for i in range(len(options.draw_queries_from)):
             t_sub = log.startTimer('Reading query embeddings (set %d) from %s...' % (i, options.draw_queries_from[i]))
-            these_embeds = pyemblib.read(options.draw_queries_from[i], mode=options.embedding_mode, errors='replace')
+            these_embeds = nn_io.readEmbeddings(options.draw_queries_from[i], options.embedding_mode, cache_dir=options.cache_dir)
+            query_embed_sets.append(nn_io.embeddingMatrix(these_embeds))
             log.stopTimer(t_sub, message='Read {0:,} embeddings in {1}s.\n'.format(len(these_embeds), '{0:.2f}'))
-            query_embeds.append(these_embeds)
+            these_embeds = None
+
+    # key selections are made against the vocabulary of the first replicate
+    vocab = embed_sets[0][0]
+    target_mask = np.ones(len(vocab), dtype=bool)
+    query_mask = np.zeros(len(vocab), dtype=bool)
 
     if options.filter_to:
         log.writeln('Reading list of keys to filter to from %s...' % options.filter_to)
         filter_set = nn_io.readSet(options.filter_to, to_lower=True)
+        lower_keys = [k.lower() for k in vocab]
 
         if options.filtered_query_keys:
             log.writeln('Reading list of keys to query with from %s...' % options.filtered_query_keys)
@@ -271,38 +782,33 @@ if __name__ == '__main__':
         else:
             filtered_query_keys = set()
 
-        filtered_embed_sets, filtered_query_embed_sets = [], []
-        for emb in embeds:
-            filtered_embs = pyemblib.Embeddings()
-            filtered_query_embs = pyemblib.Embeddings()
-            for (k,v) in emb.items():
-                if k.lower() in filter_set:
-                    filtered_embs[k] = v
-                elif k.lower() in filtered_query_keys:
-                    filtered_query_embs[k] = v
-            filtered_embed_sets.append(filtered_embs)
-            filtered_query_embed_sets.append(filtered_query_embs)
-        embeds = filtered_embed_sets
+        target_mask = _keyMask(lower_keys, filter_set)
+        if options.filtered_query_keys:
+            query_mask = _keyMask(lower_keys, filtered_query_keys) & (~target_mask)
+        lower_keys = None
         log.writeln('  Read set of {0:,} target keys'.format(len(filter_set)))
-        log.writeln('  Filtered to {0:,} target embeddings\n'.format(len(embeds[0])))
+        log.writeln('  Filtered to {0:,} target embeddings\n'.format(int(target_mask.sum())))
         if options.filtered_query_keys:
             log.writeln('  Read set of {0:,} query keys'.format(len(filtered_query_keys)))
-            log.writeln('  Filtered to {0:,} further query embeddings\n'.format(len(filtered_query_embed_sets[0])))
+            log.writeln('  Filtered to {0:,} further query embeddings\n'.format(int(query_mask.sum())))
 
     ## TODO: adjust this to better work with the new query filtering option above
-    if options.filter_queries_to and options.draw_queries_from:
-        log.writeln('Reading list of keys to filter queries to from %s...' % options.filter_queries_to)
-        filter_set = nn_io.readSet(options.filter_queries_to, to_lower=True)
-        filtered_query_embed_sets = []
-        for q_emb in query_embeds:
-            filtered_query_embs = pyemblib.Embeddings()
-            for (k,v) in q_emb.items():
-                if k.lower() in filter_set:
-                    filtered_query_embs[k] = v
-            filtered_query_embed_sets.append(filtered_query_embs)
-        query_embeds = filtered_query_embed_sets
-        log.writeln('  Read set of {0:,} query keys'.format(len(filter_set)))
-        log.writeln('  Filtered to {0:,} query embeddings\n'.format(len(query_embeds[0])))
+    if options.draw_queries_from:
+        query_vocab = query_embed_sets[0][0]
+        if options.filter_queries_to:
+            log.writeln('Reading list of keys to filter queries to from %s...' % options.filter_queries_to)
+            query_filter_set = nn_io.readSet(options.filter_queries_to, to_lower=True)
+            query_keys = [
+                query_vocab[ix]
+                    for ix in np.flatnonzero(_keyMask(
+                        [k.lower() for k in query_vocab],
+                        query_filter_set
+                    ))
+            ]
+            log.writeln('  Read set of {0:,} query keys'.format(len(query_filter_set)))
+            log.writeln('  Filtered to {0:,} query embeddings\n'.format(len(query_keys)))
+        else:
+            query_keys = query_vocab
 
     ## TODO: handle this for specified query embeddings
     if options.shared_keys_with:
@@ -310,29 +816,18 @@ if __name__ == '__main__':
         emb2 = pyemblib.read(options.shared_keys_with, errors='replace')
         log.stopTimer(t_sub, message='Read {0:,} embeddings in {1}s.\n'.format(len(emb2), '{0:.2f}'))
 
-        if options.filter_to:
-            log.writeln('Filtering reference embeddings to filter set...')
-            filtered_embs2 = pyemblib.Embeddings()
-            for (k,v) in emb2.items():
-                if k.lower() in filter_set:
-                    filtered_embs2[k] = v
-            emb2 = filtered_embs2
-            log.writeln('Filtered to {0:,} embeddings\n'.format(len(emb2)))
-
+        # any --filter-to restriction is already reflected in target_mask
         log.writeln('Filtering to shared key set...')
-        shared_keys = set(embeds[0].keys()).intersection(set(emb2.keys()))
-        filtered_embed_sets = []
-        for emb in embeds:
-            filtered_emb = pyemblib.Embeddings()
-            for key in shared_keys:
-                filtered_emb[key] = emb[key]
-            filtered_embed_sets.append(filtered_emb)
-            embeds = filtered_embed_sets
-        log.writeln('Filtered to {0:,} embeddings.\n'.format(len(embeds[0])))
+        target_mask &= _keyMask(vocab, set(emb2.keys()))
+        emb2 = None
+        log.writeln('Filtered to {0:,} embeddings.\n'.format(int(target_mask.sum())))
 
     if not os.path.isfile(options.vocabf):
         log.writeln('Writing node ID <-> vocab map to %s...\n' % options.vocabf)
-        nn_io.writeNodeMap(embeds[0], options.vocabf)
+        nn_io.writeKeyNodeMap(
+            [vocab[ix] for ix in np.flatnonzero(target_mask)],
+            options.vocabf
+        )
     else:
         log.writeln('Reading node ID <-> vocab map from %s...\n' % options.vocabf)
     node_map = nn_io.readNodeMap(options.vocabf)
@@ -362,8 +857,8 @@ if __name__ == '__main__':
         #     target-only map
         next_ix = max(master_node_map.keys()) + 1
         query_only_map = {}
-        for k in filtered_query_embed_sets[0].keys():
-            query_only_map[next_ix] = k
+        for ix in np.flatnonzero(query_mask):
+            query_only_map[next_ix] = vocab[ix]
             next_ix += 1
         # (iii) unify them
         for (k,v) in query_only_map.items():
@@ -390,7 +885,7 @@ if __name__ == '__main__':
         query_vocabf = '%s.query' % options.vocabf
         if not os.path.isfile(query_vocabf):
             log.writeln('Writing query node ID <-> vocab map to %s...\n' % query_vocabf)
-            nn_io.writeNodeMap(query_embeds[0], query_vocabf)
+            nn_io.writeKeyNodeMap(query_keys, query_vocabf)
         else:
             log.writeln('Reading query node ID <-> vocab map from %s...\n' % query_vocabf)
         query_node_map = nn_io.readNodeMap(query_vocabf)
@@ -404,13 +899,8 @@ if __name__ == '__main__':
             for node_ID in node_IDs
     ]
 
-    emb_arrs = []
-    for i in range(len(embeds)):
-        emb_arr = np.array([
-            embeds[i][v] for v in ordered_vocab
-        ])
-        emb_arrs.append(emb_arr)
-    
+    emb_arrs = _selectRows(embed_sets, ordered_vocab)
+
     # do the same setup for query embedding arrays
     if options.filtered_query_keys or options.draw_queries_from:
         query_node_IDs = list(query_node_map.keys())
@@ -420,30 +910,44 @@ if __name__ == '__main__':
                 for query_node_ID in query_node_IDs
         ]
 
-        query_emb_arrs = []
         if options.draw_queries_from:
-            for i in range(len(query_embeds)):
-                query_emb_arr = np.array([
-                    query_embeds[i][v] for v in ordered_query_vocab
-                ])
-                query_emb_arrs.append(query_emb_arr)
+            query_emb_arrs = _selectRows(query_embed_sets, ordered_query_vocab)
         elif options.filtered_query_keys:
-            for i in range(len(filtered_query_embed_sets)):
-                query_emb_arr = np.array([
-                    filtered_query_embed_sets[i][v] for v in ordered_query_vocab
-                ])
-                query_emb_arrs.append(query_emb_arr)
+            query_emb_arrs = _selectRows(embed_sets, ordered_query_vocab)
+    embed_sets, query_embed_sets = None, None
 
-    # TODO: what should this do if a query set is specified?
+    # node IDs listed in the partial neighbors file are mapped back to
+    # indices separately for queries and targets (they are written to
+    # the same file, with disjoint node IDs)
     if options.partial_neighbors_file:
-        completed_neighbors = set()
+        completed_node_IDs = set()
         with open(options.partial_neighbors_file, 'r') as stream:
             for line in stream:
                 if line[0] != '#':
                     (neighbor_id, _) = line.split(',', 1)
-                    completed_neighbors.add(int(neighbor_id))
+                    completed_node_IDs.add(int(neighbor_id))
     else:
-        completed_neighbors = set()
+        completed_node_IDs = set()
+    completed_neighbors = set([
+        ix for ix in range(len(node_IDs))
+            if node_IDs[ix] in completed_node_IDs
+    ])
+    if options.draw_queries_from or options.filtered_query_keys:
+        completed_query_neighbors = set([
+            ix for ix in range(len(query_node_IDs))
+                if query_node_IDs[ix] in completed_node_IDs
+        ])
+
+    # a checkpoint is only resumed against the same input files
+    checkpoint_inputs = embedfs + (options.draw_queries_from or [])
+    if options.filter_to:
+        checkpoint_inputs.append(options.filter_to)
+    if options.filtered_query_keys:
+        checkpoint_inputs.append(options.filtered_query_keys)
+    if options.filter_queries_to:
+        checkpoint_inputs.append(options.filter_queries_to)
+    if options.shared_keys_with:
+        checkpoint_inputs.append(options.shared_keys_with)
 
     log.writeln('Calculating k nearest neighbors.')
     if options.draw_queries_from or options.filtered_query_keys:
@@ -456,8 +960,19 @@ if __name__ == '__main__':
             options.outputf,
             threads=options.threads,
             batch_size=options.batch_size,
-            completed_neighbors=completed_neighbors,
-            with_distances=options.with_distances
+            completed_neighbors=completed_query_neighbors,
+            with_distances=options.with_distances,
+            block_size=options.block_size,
+            fused=options.fused,
+            binary=options.binary,
+            binary_distance_dtype=np.dtype(options.binary_distance_precision),
+            checkpoint=options.checkpoint,
+            checkpoint_interval=options.checkpoint_interval,
+            checkpoint_inputs=checkpoint_inputs,
+            approximate=options.approximate,
+            ivf_lists=options.ivf_lists,
+            ivf_probes=options.ivf_probes,
+            recall_sample=options.recall_sample
         )
     if not options.draw_queries_from:
         KNearestNeighbors(
@@ -469,8 +984,22 @@ if __name__ == '__main__':
             batch_size=options.batch_size,
             completed_neighbors=completed_neighbors,
             with_distances=options.with_distances,
-            neighbor_file_mode=('a' if options.filtered_query_keys else 'w')
+            neighbor_file_mode=('a' if options.filtered_query_keys else 'w'),
+            block_size=options.block_size,
+            fused=options.fused,
+            binary=options.binary,
+            binary_distance_dtype=np.dtype(options.binary_distance_precision),
+            checkpoint=options.checkpoint,
+            checkpoint_interval=options.checkpoint_interval,
+            checkpoint_inputs=checkpoint_inputs,
+            approximate=options.approximate,
+            ivf_lists=options.ivf_lists,
+            ivf_probes=options.ivf_probes,
+            recall_sample=options.recall_sample
         )
+    # both phases completed (any failure raises above, leaving the
+    # checkpoint to resume from), so nothing left to resume
+    _Checkpoint.remove(options.outputf)
     log.writeln('Done!\n')
 
     log.stop()
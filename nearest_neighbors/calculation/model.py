@@ -1,158 +1,388 @@
 '''
+NumPy implementation of cosine nearest neighbor search, averaged over
+one or more sets of embeddings
 '''
 
 import numpy as np
-import tensorflow as tf
-import multiprocessing as mp
 
 class MultiNearestNeighbors:
-    
-    def __init__(self, session, embed_arrays):
-        self._session = session
-        self._prints = []
 
-        embed_shapes = [embed_array.shape for embed_array in embed_arrays]
+    def __init__(self, embed_arrays, block_size=50000, normed=False):
         self._number_of_embeddings = len(embed_arrays)
-        self._build(embed_shapes)
-
-        self._session.run(tf.global_variables_initializer())
-
-        # fill the (static) embedding matrices
-        for i in range(len(embed_arrays)):
-            # unit norm the embedding array
-            embed_array = np.array([
-                vec / np.linalg.norm(vec)
-                    for vec in embed_arrays[i]
-            ])
-            self._session.run(
-                self._embed_matrices[i].assign(
-                    self._embed_phs[i]
-                ),
-                feed_dict={self._embed_phs[i]: embed_array}
+        self._block_size = block_size
+
+        # unit norm the (static) embedding matrices, unless they
+        # have been normed already (e.g., shared across processes)
+        if normed:
+            self._embed_matrices = list(embed_arrays)
+        else:
+            self._embed_matrices = [
+                _unitNorm(embed_array)
+                    for embed_array in embed_arrays
+            ]
+        self._vocab_size = self._embed_matrices[0].shape[0]
+
+    def _distance(self, a, b):
+        # both inputs are already unit-normed, so just
+        # get full pairwise distance matrix
+        pairwise_distance = 1 - np.matmul(a, b.T)
+        return pairwise_distance
+
+    def _blockDistances(self, sample_points, start, end):
+        '''Returns the distances from each sample point to vocabulary
+        entries [start, end), averaged across all sets of embeddings
+        '''
+        averaged_distances = np.zeros(
+            (len(sample_points[0]), end - start),
+            dtype=np.float32
+        )
+        for i in range(self._number_of_embeddings):
+            averaged_distances += self._distance(
+                sample_points[i],
+                self._embed_matrices[i][start:end]
             )
+        averaged_distances /= self._number_of_embeddings
+        return averaged_distances
+
+    def _blockCandidates(self, sample_points, num_candidates):
+        '''Scans the vocabulary block by block, keeping only the closest
+        num_candidates entries from each block for each sample point.
 
-    def _build(self, emb_shapes):
-        self._sample_indices = tf.placeholder(
-            shape=[None,],
-            dtype=tf.int32
+        Returns (candidate indices, candidate distances), as two
+        [batch size x total candidates] arrays.
+        '''
+        candidate_indices, candidate_distances = [], []
+        for start in range(0, self._vocab_size, self._block_size):
+            end = min(start + self._block_size, self._vocab_size)
+            block_distances = self._blockDistances(sample_points, start, end)
+            block_indices = _stableTopK(block_distances, num_candidates)
+            candidate_distances.append(np.take_along_axis(
+                block_distances,
+                block_indices,
+                axis=1
+            ))
+            candidate_indices.append(block_indices + start)
+        return (
+            np.concatenate(candidate_indices, axis=1),
+            np.concatenate(candidate_distances, axis=1)
         )
-        self._sample_embeds = [
-            tf.placeholder(
-                shape=[None,emb_shapes[i][1]],
-                dtype=tf.float32
-            ) for i in range(len(emb_shapes))
-        ]
 
-        self._embed_phs = [
-            tf.placeholder(
-                shape=emb_shapes[i],
-                dtype=tf.float32
-            ) for i in range(len(emb_shapes))
-        ]
-        self._embed_matrices = [
-            tf.Variable(
-                tf.constant(0.0, shape=emb_shapes[i]),
-                trainable=False
-            ) for i in range(len(emb_shapes))
-        ]
-        self._sample_points = [
-            tf.gather(
-                self._embed_matrices[i],
-                self._sample_indices
-            ) for i in range(len(emb_shapes))
-        ]
+    def _samplePoints(self, batch_input, indices):
+        '''Returns the (unit-normed) points for this batch for each set
+        of embeddings
+        '''
+        if indices:
+            return [
+                embed_matrix[batch_input]
+                    for embed_matrix in self._embed_matrices
+            ]
+        else:
+            return [
+                _unitNorm(sample_embeds)
+                    for sample_embeds in batch_input
+            ]
 
-        self._indexed_sample_distances = [
-            self._distance(self._sample_points[i], self._embed_matrices[i])
-                for i in range(len(emb_shapes))
-        ]
-        self._embed_sample_distances = [
-            self._distance(
-                tf.nn.l2_normalize(self._sample_embeds[i], 1),
-                self._embed_matrices[i]
-            )
-                for i in range(len(emb_shapes))
-        ]
+    def _sortedNeighbors(self, batch_input, indices, top_k, no_self):
+        '''Returns (sorted neighbors, sorted distances, offsets), where the
+        first two are [batch size x candidates] arrays ordered by distance
+        and offsets gives the position of the first non-query neighbor in
+        each row.
+        '''
+        sample_points = self._samplePoints(batch_input, indices)
 
-    def _distance(self, a, b):
-        # first, L2-norm both inputs
-        #normed_a = tf.nn.l2_normalize(a, 1)
-        #normed_b = tf.nn.l2_normalize(b, 1)
-        normed_a = a
-        normed_b = b   # already unit-normed
-        # get full pairwise distance matrix
-        pairwise_distance = 1 - tf.matmul(normed_a, normed_b, transpose_b=True)
-        return pairwise_distance
+        # get the averaged distances for the closest candidates in each block
+        # (if skipping the query, keep one extra in case it is among them)
+        if top_k is None:
+            num_candidates = self._vocab_size
+        else:
+            num_candidates = top_k + (1 if no_self else 0)
+        (candidate_indices, candidate_distances) = self._blockCandidates(
+            sample_points,
+            num_candidates
+        )
 
-    def _print(self, *nodes):
-        for n in nodes:
-            if type(n) is tuple and len(n) == 2:
-                self._prints.append(tf.Print(0, [n[0]], message=n[1], summarize=100))
-            else:
-                self._prints.append(tf.Print(0, [n], summarize=100))
+        # order all candidates for the batch at once, breaking ties in
+        # distance by vocabulary index (same as a stable full sort)
+        order = np.lexsort((candidate_indices, candidate_distances), axis=1)
+        sorted_neighbors = np.take_along_axis(candidate_indices, order, axis=1)
+        sorted_distances = np.take_along_axis(candidate_distances, order, axis=1)
 
-    def _exec(self, nodes, feed_dict=None):
-        all_nodes = [p for p in self._prints]
-        all_nodes.extend(nodes)
-        outputs = self._session.run(all_nodes, feed_dict=feed_dict)
-        return outputs[len(self._prints):]
+        # if skipping the query, remove it from the neighbor list
+        # (should be in the 0th position; if it's not, just move on)
+        if no_self:
+            offsets = (sorted_neighbors[:, 0] == np.asarray(batch_input)).astype(int)
+        else:
+            offsets = np.zeros(len(sorted_neighbors), dtype=int)
+
+        return sorted_neighbors, sorted_distances, offsets
 
     def nearestNeighbors(self, batch_input, indices=True, top_k=None, no_self=True, with_distances=False):
-        # get the pairwise distances for this batch for each set of embeddings
-        all_distances = []
-        for i in range(self._number_of_embeddings):
-            if indices:
-                (pairwise_distances,) = self._exec([
-                        self._indexed_sample_distances[i]
-                    ],
-                    feed_dict = {
-                        self._sample_indices: batch_input
-                    }
-                )
-            else:
-                (pairwise_distances,) = self._exec([
-                        self._embed_sample_distances[i]
-                    ],
-                    feed_dict = {
-                        self._sample_embeds[i]: batch_input[i]
-                            for i in range(len(self._sample_embeds))
-                    }
-                )
-            all_distances.append(pairwise_distances)
-
-        # average the distances across all sets of embeddings
-        all_distances = np.array(all_distances)
-        averaged_distances = np.mean(all_distances, axis=0)
-        assert len(averaged_distances) == len(pairwise_distances)
+        (sorted_neighbors, sorted_distances, offsets) = self._sortedNeighbors(
+            batch_input, indices, top_k, no_self
+        )
 
         nearest_neighbors = []
-        if indices:
-            itr = range(len(batch_input))
-        else:
-            itr = range(len(batch_input[0]))
-        for i in itr:
-            distance_vector = averaged_distances[i]
-            sorted_neighbors = np.argsort(distance_vector)
-            # if skipping the query, remove it from the neighbor list
-            # (should be in the 0th position; if it's not, just move on)
-            if no_self: 
-                if sorted_neighbors[0] == batch_input[i]: sorted_neighbors = sorted_neighbors[1:]
+        for i in range(len(sorted_neighbors)):
             # if restricting to top k, do so here
-            if top_k is None:
-                kept_neighbors = sorted_neighbors
-            else:
-                kept_neighbors = sorted_neighbors[:top_k]
+            end = None if top_k is None else offsets[i] + top_k
+            kept_neighbors = sorted_neighbors[i, offsets[i]:end]
+            kept_distances = sorted_distances[i, offsets[i]:end]
+            # drop any padding (index -1) from candidate selection that
+            # ran short of neighbors
+            valid = kept_neighbors >= 0
+            kept_neighbors = kept_neighbors[valid]
             # if including distance, pull those for the indices being kept
             if with_distances:
-                kept_neighbors = [
-                    (ix, distance_vector[ix])
-                        for ix in kept_neighbors
-                ]
+                kept_neighbors = list(zip(
+                    kept_neighbors,
+                    kept_distances[valid]
+                ))
             nearest_neighbors.append(kept_neighbors)
         return nearest_neighbors
 
+    def nearestNeighborArrays(self, batch_input, top_k, indices=True, no_self=True):
+        '''Same as nearestNeighbors, but returns the results for the whole
+        batch as a [batch size x top_k] int32 array of neighbor indices and
+        a matching float32 array of distances.
+
+        If fewer than top_k neighbors are available for a row, the row is
+        padded with index -1 (and distance NaN).
+        '''
+        (sorted_neighbors, sorted_distances, offsets) = self._sortedNeighbors(
+            batch_input, indices, top_k, no_self
+        )
+
+        columns = offsets[:, np.newaxis] + np.arange(top_k)
+        valid = columns < sorted_neighbors.shape[1]
+        columns = np.minimum(columns, sorted_neighbors.shape[1] - 1)
+        # candidate selection may itself have padded with index -1
+        # (e.g., approximate search probing too few rows)
+        kept_neighbors = np.take_along_axis(sorted_neighbors, columns, axis=1)
+        valid &= kept_neighbors >= 0
+
+        neighbors = np.where(
+            valid,
+            kept_neighbors,
+            -1
+        ).astype(np.int32)
+        distances = np.where(
+            valid,
+            np.take_along_axis(sorted_distances, columns, axis=1),
+            np.nan
+        ).astype(np.float32)
+        return neighbors, distances
+
 
 class NearestNeighbors(MultiNearestNeighbors):
-    
-    def __init__(self, session, embed_array):
-        super().__init__(session, [embed_array])
+
+    def __init__(self, embed_array, block_size=50000, normed=False):
+        super().__init__([embed_array], block_size=block_size, normed=normed)
+
+
+class FusedMultiNearestNeighbors(MultiNearestNeighbors):
+    '''Replicate-averaged nearest neighbors computed over a single fused
+    [vocab size x (number of embeddings * dimensionality)] matrix, as
+    produced by fuseEmbeddings().
+
+    The mean of R cosine similarities is the dot product of the
+    concatenated unit-normed vectors divided by R, so each block takes
+    one matmul instead of R.  (Distances may differ from
+    MultiNearestNeighbors in the last bits of floating point precision.)
+    '''
+
+    def __init__(self, fused_matrix, number_of_embeddings, block_size=50000):
+        self._number_of_embeddings = number_of_embeddings
+        self._block_size = block_size
+        self._fused_matrix = fused_matrix
+        self._vocab_size = fused_matrix.shape[0]
+
+    def _samplePoints(self, batch_input, indices):
+        if indices:
+            return self._fused_matrix[batch_input]
+        else:
+            return fuseEmbeddings(batch_input)
+
+    def _blockDistances(self, sample_points, start, end):
+        similarities = np.matmul(sample_points, self._fused_matrix[start:end].T)
+        return 1 - (similarities / self._number_of_embeddings)
+
+
+class IVFIndex:
+    '''Inverted file index over the rows of an embedding matrix: rows are
+    partitioned by their closest centroid (by cosine similarity), found
+    with spherical k-means.
+
+    Members of list i are list_members[list_offsets[i]:list_offsets[i+1]],
+    in increasing row order.
+    '''
+
+    def __init__(self, centroids, list_members, list_offsets):
+        self.centroids = centroids
+        self.list_members = list_members
+        self.list_offsets = list_offsets
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    @property
+    def arrays(self):
+        return [self.centroids, self.list_members, self.list_offsets]
+
+    @staticmethod
+    def build(embed_matrix, num_lists, iterations=10, sample_size=100000,
+            block_size=50000, seed=1):
+        centroids = _sphericalKMeans(
+            embed_matrix,
+            num_lists,
+            iterations=iterations,
+            sample_size=sample_size,
+            block_size=block_size,
+            seed=seed
+        )
+        assignments = _assignClusters(embed_matrix, centroids, block_size)
+        list_members = np.argsort(assignments, kind='stable').astype(np.int64)
+        list_offsets = np.concatenate([
+            [0],
+            np.cumsum(np.bincount(assignments, minlength=num_lists))
+        ]).astype(np.int64)
+        return IVFIndex(centroids, list_members, list_offsets)
+
+    def probe(self, sample_points, num_probes):
+        '''Returns, for each sample point, the sorted row indices in its
+        num_probes closest lists
+        '''
+        num_probes = min(num_probes, self.num_lists)
+        probed_lists = _stableTopK(
+            -np.matmul(sample_points, self.centroids.T),
+            num_probes
+        )
+        return [
+            np.sort(np.concatenate([
+                self.list_members[self.list_offsets[l]:self.list_offsets[l+1]]
+                    for l in lists
+            ]))
+                for lists in probed_lists
+        ]
+
+
+class IVFMultiNearestNeighbors(FusedMultiNearestNeighbors):
+    '''Approximate replicate-averaged nearest neighbors, comparing each
+    query only against the rows in the num_probes closest lists of an
+    IVFIndex built over the fused embedding matrix.
+
+    Recall increases (and speed decreases) with num_probes relative to
+    the number of lists in the index.
+    '''
+
+    def __init__(self, fused_matrix, number_of_embeddings, index, num_probes=8, block_size=50000):
+        super().__init__(fused_matrix, number_of_embeddings, block_size=block_size)
+        self._index = index
+        self._num_probes = num_probes
+
+    def _blockCandidates(self, sample_points, num_candidates):
+        # rows with fewer than num_candidates probed are padded with
+        # index -1 (at infinite distance)
+        candidate_indices = np.full((len(sample_points), num_candidates), -1, dtype=np.int64)
+        candidate_distances = np.full((len(sample_points), num_candidates), np.inf, dtype=np.float32)
+
+        probed_rows = self._index.probe(sample_points, self._num_probes)
+        for i in range(len(sample_points)):
+            similarities = np.matmul(self._fused_matrix[probed_rows[i]], sample_points[i])
+            distances = 1 - (similarities / self._number_of_embeddings)
+            kept = _stableTopK(distances[np.newaxis, :], num_candidates)[0]
+            candidate_indices[i, :len(kept)] = probed_rows[i][kept]
+            candidate_distances[i, :len(kept)] = distances[kept]
+        return candidate_indices, candidate_distances
+
+
+def _unitNorm(embed_array):
+    embed_array = np.asarray(embed_array, dtype=np.float32)
+    norms = np.linalg.norm(embed_array, axis=1, keepdims=True)
+    return embed_array / norms
+
+def fuseEmbeddings(embed_arrays):
+    '''Unit norms each of a set of embedding matrices (with shared row
+    order), and concatenates them horizontally.
+    '''
+    return np.concatenate([
+        _unitNorm(embed_array)
+            for embed_array in embed_arrays
+    ], axis=1)
+
+def recallAtK(approximate_neighbors, exact_neighbors):
+    '''Returns the mean fraction of each row of exact_neighbors (an [N x k]
+    array) found in the matching row of approximate_neighbors
+    '''
+    found = [
+        len(np.intersect1d(approximate_neighbors[i], exact_neighbors[i][exact_neighbors[i] >= 0]))
+            / max(1, np.sum(exact_neighbors[i] >= 0))
+            for i in range(len(exact_neighbors))
+    ]
+    return float(np.mean(found))
+
+def _assignClusters(data, centroids, block_size):
+    assignments = np.zeros(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        end = min(start + block_size, len(data))
+        assignments[start:end] = np.argmax(
+            np.matmul(data[start:end], centroids.T),
+            axis=1
+        )
+    return assignments
+
+def _sphericalKMeans(data, num_clusters, iterations=10, sample_size=100000,
+        block_size=50000, seed=1):
+    '''Clusters (a random sample of) the rows of data by cosine similarity,
+    returning the unit-normed centroids.
+    '''
+    random = np.random.RandomState(seed)
+    if len(data) > sample_size:
+        sample = data[np.sort(random.choice(len(data), sample_size, replace=False))]
+    else:
+        sample = np.asarray(data)
+    sample = _unitNorm(sample)
+    num_clusters = min(num_clusters, len(sample))
+
+    centroids = sample[random.choice(len(sample), num_clusters, replace=False)]
+    for _ in range(iterations):
+        assignments = _assignClusters(sample, centroids, block_size)
+        # sum the members of each cluster
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=num_clusters)
+        nonempty = np.nonzero(counts)[0]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        centroids = np.zeros_like(centroids)
+        centroids[nonempty] = np.add.reduceat(sample[order], starts, axis=0)
+        # re-seed any empty clusters with random sample points
+        empty = np.nonzero(counts == 0)[0]
+        centroids[empty] = sample[random.choice(len(sample), len(empty), replace=False)]
+        centroids = _unitNorm(centroids)
+    return centroids
+
+def _stableTopK(distances, k):
+    '''Returns the column indices of the k smallest values in each row of
+    distances, such that ties at the cutoff are resolved in favor of the
+    lowest column index (matching the first k of a stable argsort).
+
+    Selection uses np.argpartition, so is O(n) per row; the (rare) rows
+    where the partition split a run of tied values are redone with a
+    stable sort.
+    '''
+    if k >= distances.shape[1]:
+        return np.tile(
+            np.arange(distances.shape[1]),
+            (distances.shape[0], 1)
+        )
+
+    selected = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    selected_distances = np.take_along_axis(distances, selected, axis=1)
+
+    # check if any values tied with the cutoff were left out
+    cutoffs = selected_distances.max(axis=1, keepdims=True)
+    num_tied_selected = (selected_distances == cutoffs).sum(axis=1)
+    num_tied_total = (distances == cutoffs).sum(axis=1)
+    for i in np.nonzero(num_tied_total > num_tied_selected)[0]:
+        selected[i] = np.argsort(distances[i], kind='stable')[:k]
+
+    return selected
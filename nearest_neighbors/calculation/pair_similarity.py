@@ -33,6 +33,117 @@ def calculateAggregatePairwiseSimilarity(replicates, query, target, db):
 
     return sim
 
+def calculateBulkAggregatePairwiseSimilarity(replicates, pairs):
+    '''Calculate aggregate similarity for each (query, target) pair in pairs,
+    reading each replicate once and computing all pairs as dot products of
+    gathered rows.
+
+    Pairs with a key missing from any replicate are skipped.  Returns a list
+    of AggregatePairwiseSimilarity objects (not yet saved to the database).
+    '''
+    keys = set()
+    for (query, target) in pairs:
+        keys.add(query)
+        keys.add(target)
+
+    cos_sims = []
+    valid = np.ones(len(pairs), dtype=bool)
+    for these_embeds in replicates:
+        (vocab, matrix) = nn_io.embeddingMatrix(these_embeds)
+        these_embeds = None
+
+        key_rows = {}
+        for i in range(len(vocab)):
+            if vocab[i] in keys:
+                key_rows[vocab[i]] = i
+        query_ixes = np.array([key_rows.get(query, -1) for (query, _) in pairs], dtype=np.int64)
+        target_ixes = np.array([key_rows.get(target, -1) for (_, target) in pairs], dtype=np.int64)
+        valid &= (query_ixes >= 0) & (target_ixes >= 0)
+
+        query_vecs = np.asarray(matrix[query_ixes], dtype=np.float64)
+        target_vecs = np.asarray(matrix[target_ixes], dtype=np.float64)
+        query_vecs /= np.linalg.norm(query_vecs, axis=1, keepdims=True)
+        target_vecs /= np.linalg.norm(target_vecs, axis=1, keepdims=True)
+        cos_sims.append(np.einsum('ij,ij->i', query_vecs, target_vecs))
+    cos_sims = np.array(cos_sims)
+
+    mean_sims = cos_sims.mean(axis=0)
+    std_sims = cos_sims.std(axis=0)
+    sims = []
+    for i in np.flatnonzero(valid):
+        sims.append(AggregatePairwiseSimilarity(
+            source=replicates.ID,
+            key=pairs[i][0],
+            neighbor_key=pairs[i][1],
+            mean_similarity=mean_sims[i],
+            std_similarity=std_sims[i]
+        ))
+    return sims
+
+def calculateAllPairsAggregateSimilarity(replicates, keys, threshold,
+        block_size=1000):
+    '''Calculate aggregate similarity between all pairs of keys, keeping only
+    pairs whose mean similarity is at least threshold.
+
+    The (unit-normed) rows for keys are gathered from each replicate in one
+    pass; similarities are then calculated in blocks of block_size rows,
+    accumulating the mean and M2 across replicates with Welford's method so
+    that only one block of the Gram matrix is held per replicate.
+
+    Keys missing from any replicate are skipped.  Yields a list of
+    AggregatePairwiseSimilarity objects for each block of rows (both
+    orderings of each pair are included).
+    '''
+    key_subsets = []
+    valid = np.ones(len(keys), dtype=bool)
+    key_set = set(keys)
+    for these_embeds in replicates:
+        (vocab, matrix) = nn_io.embeddingMatrix(these_embeds)
+        these_embeds = None
+
+        key_rows = {}
+        for i in range(len(vocab)):
+            if vocab[i] in key_set:
+                key_rows[vocab[i]] = i
+        key_ixes = np.array([key_rows.get(k, -1) for k in keys], dtype=np.int64)
+        valid &= (key_ixes >= 0)
+
+        subset = np.array(matrix[key_ixes], dtype=np.float32)
+        subset /= np.linalg.norm(subset, axis=1, keepdims=True)
+        key_subsets.append(subset)
+
+    valid_ixes = np.flatnonzero(valid)
+    keys = [keys[i] for i in valid_ixes]
+    key_subsets = [
+        subset[valid_ixes]
+            for subset in key_subsets
+    ]
+
+    for start in range(0, len(keys), block_size):
+        end = min(start + block_size, len(keys))
+        mean = np.zeros((end-start, len(keys)), dtype=np.float64)
+        M2 = np.zeros((end-start, len(keys)), dtype=np.float64)
+        for (r, subset) in enumerate(key_subsets):
+            cos_sims = np.matmul(subset[start:end], subset.T).astype(np.float64)
+            delta = cos_sims - mean
+            mean += delta / (r+1)
+            M2 += delta * (cos_sims - mean)
+        std = np.sqrt(M2 / len(key_subsets))
+
+        # skip self-pairs
+        mean[np.arange(end-start), np.arange(start, end)] = -np.inf
+        (rows, cols) = np.nonzero(mean >= threshold)
+        yield [
+            AggregatePairwiseSimilarity(
+                source=replicates.ID,
+                key=keys[start+rows[i]],
+                neighbor_key=keys[cols[i]],
+                mean_similarity=mean[rows[i], cols[i]],
+                std_similarity=std[rows[i], cols[i]]
+            )
+                for i in range(len(rows))
+        ]
+
 
 if __name__ == '__main__':
     def _cli():
@@ -47,17 +158,46 @@ if __name__ == '__main__':
             help='(required) query key')
         parser.add_option('-t', '--target', dest='target_key',
             help='(required) target key')
+        parser.add_option('--pairs-file', dest='pairs_file',
+            help='file of tab-separated query/target key pairs to calculate'
+                 ' similarity for in bulk (instead of --query and --target)')
+        parser.add_option('--all-pairs-keys', dest='all_pairs_keys',
+            help='file listing keys (one per line) to calculate similarity'
+                 ' for all pairs of (instead of --query and --target)')
+        parser.add_option('--similarity-threshold', dest='similarity_threshold',
+            type='float', default=0.5,
+            help='with --all-pairs-keys, minimum mean similarity for a pair'
+                 ' to be saved (default: %default)')
+        parser.add_option('--block-size', dest='block_size',
+            type='int', default=1000,
+            help='with --all-pairs-keys, number of keys to calculate'
+                 ' similarities for at once (default: %default)')
+        parser.add_option('--cache-dir', dest='cache_dir',
+            help='directory for caching embedding matrices in binary format'
+                 ' (defaults to EmbeddingCacheDirectory in the'
+                 ' PairedNeighborhoodAnalysis config section, if set)',
+            default=None)
+        parser.add_option('--memory-budget', dest='memory_budget',
+            type='float', default=None,
+            help='memory budget (in GB) for holding replicates while reading;'
+                 ' the next replicate is read in the background while the'
+                 ' current one is used if both fit (default: no limit)')
         parser.add_option('-l', '--logfile', dest='logfile',
             help='name of file to write log contents to (empty for stdout)',
             default=None)
         (options, args) = parser.parse_args()
 
-        if not options.query_key:
-            parser.print_help()
-            parser.error('Must provide --query')
-        if not options.target_key:
-            parser.print_help()
-            parser.error('Must provide --target')
+        if options.pairs_file and options.all_pairs_keys:
+            parser.error('--pairs-file and --all-pairs-keys are mutually exclusive')
+        if not (options.pairs_file or options.all_pairs_keys):
+            if not options.query_key:
+                parser.print_help()
+                parser.error('Must provide --query (or --pairs-file or --all-pairs-keys)')
+            if not options.target_key:
+                parser.print_help()
+                parser.error('Must provide --target (or --pairs-file or --all-pairs-keys)')
+        if not (options.memory_budget is None):
+            options.memory_budget = int(options.memory_budget * (1024**3))
 
         return args, options
 
@@ -68,13 +208,30 @@ if __name__ == '__main__':
         ('Configuraiton file', options.configf),
         ('Query key', options.query_key),
         ('Target key', options.target_key),
+        ('Pairs file', ('N/A' if not options.pairs_file else options.pairs_file)),
+        ('All-pairs key file', ('N/A' if not options.all_pairs_keys else [
+            ('Key file', options.all_pairs_keys),
+            ('Similarity threshold', options.similarity_threshold),
+            ('Block size', options.block_size),
+        ])),
     ], 'Aggregate pairwise similarity calculation')
 
+    if options.pairs_file:
+        log.writeln('Reading key pairs from %s...' % options.pairs_file)
+        pairs = nn_io.readPairs(options.pairs_file)
+        log.writeln('Read {0:,} pairs.\n'.format(len(pairs)))
+    elif options.all_pairs_keys:
+        log.writeln('Reading keys from %s...' % options.all_pairs_keys)
+        all_pairs_keys = sorted(nn_io.readSet(options.all_pairs_keys))
+        log.writeln('Read {0:,} keys.\n'.format(len(all_pairs_keys)))
+
 
     log.writeln('Reading configuration file from %s...' % options.configf)
     config = configparser.ConfigParser()
     config.read(options.configf)
     analysis_config = config['PairedNeighborhoodAnalysis']
+    if options.cache_dir is None:
+        options.cache_dir = analysis_config.get('EmbeddingCacheDirectory', None)
     log.writeln('Done.\n')
 
     log.writeln('Loading embedding neighborhood database...')
@@ -84,18 +241,50 @@ if __name__ == '__main__':
     for src in options.src.split(','):
         src_config = config[src]
         log.writeln('Loading embedding replicates...')
-        replicates = nn_io.EmbeddingReplicates(src, src_config)
+        replicates = nn_io.EmbeddingReplicates(src, src_config,
+            cache_dir=options.cache_dir, memory_budget=options.memory_budget)
         log.writeln('Found {0:,} replicates.\n'.format(len(replicates)))
 
-        t = log.startTimer('Calculating aggregate pairwise similarity...')
-        sim = calculateAggregatePairwiseSimilarity(
-            replicates,
-            options.query_key,
-            options.target_key,
-            db
-        )
-        log.stopTimer(t, 'Done in {0:.2f}s.')
-        log.writeln('  Mean similarity: {0:.4f}'.format(sim.mean_similarity))
-        log.writeln('  Similarity std dev: {0:.4f}\n'.format(sim.std_similarity))
+        if options.pairs_file:
+            t = log.startTimer('Calculating aggregate pairwise similarity for {0:,} pairs...'.format(len(pairs)))
+            sims = calculateBulkAggregatePairwiseSimilarity(
+                replicates,
+                pairs
+            )
+            log.stopTimer(t, 'Done in {0:.2f}s.')
+            if len(sims) < len(pairs):
+                log.writeln('  Skipped {0:,} pairs with keys missing from some replicate'.format(len(pairs) - len(sims)))
+            if len(sims) > 0:
+                db.insertOrUpdate(sims)
+            log.writeln('  Saved similarity for {0:,} pairs\n'.format(len(sims)))
+        elif options.all_pairs_keys:
+            t = log.startTimer('Calculating aggregate similarity for all pairs of {0:,} keys...'.format(len(all_pairs_keys)))
+            num_saved = 0
+            for sims in calculateAllPairsAggregateSimilarity(
+                        replicates,
+                        all_pairs_keys,
+                        options.similarity_threshold,
+                        block_size=options.block_size
+                    ):
+                if len(sims) > 0:
+                    db.insertOrUpdate(sims)
+                num_saved += len(sims)
+            log.stopTimer(t, 'Done in {0:.2f}s.')
+            log.writeln('  Saved similarity for {0:,} pairs above threshold\n'.format(num_saved))
+        else:
+            t = log.startTimer('Calculating aggregate pairwise similarity...')
+            sim = calculateAggregatePairwiseSimilarity(
+                replicates,
+                options.query_key,
+                options.target_key,
+                db
+            )
+            log.stopTimer(t, 'Done in {0:.2f}s.')
+            log.writeln('  Mean similarity: {0:.4f}'.format(sim.mean_similarity))
+            log.writeln('  Similarity std dev: {0:.4f}\n'.format(sim.std_similarity))
+
+    ## mark the DB as changed (once for the whole run), invalidating
+    ## cached dashboard responses
+    db.bumpGeneration()
 
     log.stop()
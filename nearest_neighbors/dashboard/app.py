@@ -3,17 +3,54 @@ from flask import render_template
 from flask import request
 from flask import jsonify
 from flask import send_from_directory
+from flask import g
 app = Flask(__name__)
 
 import os
+import queue
 import configparser
 from nearest_neighbors.database import *
 from nearest_neighbors.dashboard import packaging
-from nearest_neighbors.dashboard import visualization
+from nearest_neighbors.dashboard import chart_data
+from nearest_neighbors.dashboard.caching import ResponseCache
 
 config = configparser.ConfigParser()
 config.read('config.ini')
 
+## create/migrate the schema once at startup; requests then use pooled
+## read-only connections
+EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile']).close()
+
+DB_POOL_SIZE = 8
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def getDatabase():
+    if not 'db' in g:
+        try:
+            g.db = _db_pool.get_nowait()
+        except queue.Empty:
+            g.db = EmbeddingNeighborhoodDatabase(
+                config['PairedNeighborhoodAnalysis']['DatabaseFile'],
+                read_only=True
+            )
+    return g.db
+
+@app.teardown_appcontext
+def releaseDatabase(exception):
+    db = g.pop('db', None)
+    if not (db is None):
+        try:
+            _db_pool.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+## rendered /info and /pairwise pages and JSON chart data, invalidated by
+## any DB load
+response_cache = ResponseCache(
+    max_size=config['PairedNeighborhoodAnalysis'].getint('DashboardCacheSize', fallback=256),
+    cache_dir=config['PairedNeighborhoodAnalysis'].get('DashboardCacheDirectory', fallback=None) or None
+)
+
 @app.route('/')
 def landingPage():
     return send_from_directory('diachronic-concept-viewer/public', 'index.html')
@@ -39,7 +76,7 @@ def showChanges(src=None, trg=None, filter_set=None, at_k=None):
     if at_k is None:
         at_k = getter('at_k', None)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDatabase()
 
     top_cwd, bottom_cwd = [], []
     rows = db.selectFromEntityOverlapAnalysis(
@@ -82,8 +119,6 @@ def showChanges(src=None, trg=None, filter_set=None, at_k=None):
             'CWD': packaging.prettify(row.CWD, decimals=2)
         })
 
-    db.close()
-
     return render_template(
         'showchanges.html',
         top_cwd=top_cwd,
@@ -109,7 +144,13 @@ def info(query_key=None):
     neighbor_type = getter('neighbor_type', 'ENTITY')
     neighbor_type = EmbeddingType.parse(neighbor_type)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDatabase()
+    generation = db.getGeneration()
+    cache_key = ('info', query_key, neighbor_type)
+    response = response_cache.get(generation, cache_key)
+    if not (response is None):
+        return response
+
     corpora = config['PairedNeighborhoodAnalysis']['CorpusOrdering'].split(',')
     hc_threshold = float(config['PairedNeighborhoodAnalysis']['HighConfidenceThreshold'])
     num_neighbors = int(config['PairedNeighborhoodAnalysis']['NumNeighborsToShow'])
@@ -142,49 +183,16 @@ def info(query_key=None):
         query_key
     )
 
-    ## (4) get its change history
-    cwds = []
-    for i in range(len(corpora)-1):
-        change_src = corpora[i]
-        change_trg = corpora[i+1]
-        filter_set = '.HC_Union_{0}_{1}'.format(change_src, change_trg)  ## TODO HARD CODED
-        at_k = 5  ## TODO HARD CODED
-
-        rows = db.selectFromEntityOverlapAnalysis(
-            change_src,
-            change_trg,
-            filter_set=filter_set,
-            at_k=at_k,
-            entity_key=query_key
-        )
-        rows = list(rows)
-        if len(rows) == 1:
-            cwds.append(rows[0].CWD)
-        else:
-            cwds.append(None)
-
-    entity_change_analysis_base64 = packaging.renderImage(
-        visualization.entityChangeAnalysis,
-        args=(corpora, cwds),
-        kwargs={'figsize': (11,3), 'font_size': 14}
-    )
-
-    confidence_analysis_base64 = packaging.renderImage(
-        visualization.internalConfidenceAnalysis,
-        args=(corpora, [confidences.get(c, None) for c in corpora], hc_threshold),
-        kwargs={'figsize': (6,2), 'font_size': 14}
-    )
-
-    return render_template(
+    response = render_template(
         'info.html',
         query_key=query_key,
         preferred_term=preferred_term,
         all_terms=sorted(term_list),
         all_definitions=sorted(definition_list),
-        tables=tables,
-        entity_change_analysis_base64=entity_change_analysis_base64,
-        confidence_analysis_base64=confidence_analysis_base64
+        tables=tables
     )
+    response_cache.put(generation, cache_key, response)
+    return response
 
 
 @app.route('/terms', methods=['POST'])
@@ -198,7 +206,7 @@ def terms(query_key=None):
     if query_key is None:
         query_key = getter('query_key', None)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDatabase()
 
     rows = db.selectFromEntityTerms(
         query_key
@@ -217,6 +225,8 @@ def terms(query_key=None):
     )
 
 
+SEARCH_PAGE_SIZE = 50
+
 @app.route('/search', methods=['POST'])
 @app.route('/search/<query>', methods=['GET', 'POST'])
 def search(query=None):
@@ -227,11 +237,18 @@ def search(query=None):
 
     if query is None:
         query = getter('query', None)
+    try:
+        page = max(1, int(getter('page', 1)))
+    except ValueError:
+        page = 1
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDatabase()
 
+    ## fetch one extra result to tell whether there is a next page
     rows = db.searchInEntityTerms(
-        query
+        query,
+        limit=SEARCH_PAGE_SIZE+1,
+        offset=(page-1)*SEARCH_PAGE_SIZE
     )
 
     table_rows = []
@@ -240,11 +257,15 @@ def search(query=None):
             'Key': row.entity_key,
             'Term': row.term,
         })
+    has_next_page = len(table_rows) > SEARCH_PAGE_SIZE
+    table_rows = table_rows[:SEARCH_PAGE_SIZE]
 
     return render_template(
         'search.html',
         query=query,
         rows=table_rows,
+        page=page,
+        has_next_page=has_next_page,
         corpora='2020-03-27,2020-04-03'  ## hard-coded value for now
     )
 
@@ -256,7 +277,7 @@ def getAggregateNearestNeighborsMembership():
 
     current_corpora = set(current_corpora.split(','))
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDatabase()
 
     rows = db.findAggregateNearestNeighborsMembership(query_key)
 
@@ -270,6 +291,55 @@ def getAggregateNearestNeighborsMembership():
     return jsonify(table_rows)
 
 
+@app.route('/_get_entity_change_analysis')
+def getEntityChangeAnalysis():
+    query_key = request.args.get('query_key', None)
+    corpora = config['PairedNeighborhoodAnalysis']['CorpusOrdering'].split(',')
+
+    return cachedJSON(
+        ('entity_change', query_key, tuple(corpora)),
+        lambda db: chart_data.entityChangeSeries(
+            db,
+            corpora,
+            query_key
+        )
+    )
+
+
+@app.route('/_get_internal_confidence_analysis')
+def getInternalConfidenceAnalysis():
+    query_key = request.args.get('query_key', None)
+    corpora = config['PairedNeighborhoodAnalysis']['CorpusOrdering'].split(',')
+    hc_threshold = float(config['PairedNeighborhoodAnalysis']['HighConfidenceThreshold'])
+
+    return cachedJSON(
+        ('internal_confidence', query_key, tuple(corpora), hc_threshold),
+        lambda db: chart_data.internalConfidenceSeries(
+            db,
+            corpora,
+            query_key,
+            hc_threshold
+        )
+    )
+
+
+@app.route('/_get_pairwise_similarity_analysis')
+def getPairwiseSimilarityAnalysis():
+    query = request.args.get('query', None)
+    target = request.args.get('target', None)
+    corpora = config['PairedNeighborhoodAnalysis']['CorpusOrdering'].split(',')
+
+    return cachedJSON(
+        ('pairwise_similarity', query, target, tuple(corpora)),
+        lambda db: chart_data.pairwiseSimilaritySeries(
+            db,
+            corpora,
+            query,
+            target
+        )
+    )
+
+
 @app.route('/pairwise', methods=['POST'])
 @app.route('/pairwise/<query>/<target>', methods=['GET', 'POST'])
 def pairwise(query=None, target=None):
@@ -283,19 +353,16 @@ def pairwise(query=None, target=None):
     if target is None:
         target = getter('target', None)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
-    num_neighbors = int(config['PairedNeighborhoodAnalysis']['NumNeighborsToShow'])
+    db = getDatabase()
+    generation = db.getGeneration()
+    cache_key = ('pairwise', query, target)
+    response = response_cache.get(generation, cache_key)
+    if not (response is None):
+        return response
 
-    ## (1) get pairwise similarity data
-    rows = db.selectFromAggregatePairwiseSimilarity(query, target)
-    rows = sorted(rows, key=lambda item: item.source)
-    corpora, means, stds = [], [], []
-    for row in rows:
-        corpora.append(row.source)
-        means.append(row.mean_similarity)
-        stds.append(row.std_similarity)
+    num_neighbors = int(config['PairedNeighborhoodAnalysis']['NumNeighborsToShow'])
 
-    ## (2) get terms for each entity
+    ## (1) get terms for each entity
     query_term_list, query_preferred_term = getTerms(
         db,
         query
@@ -305,7 +372,7 @@ def pairwise(query=None, target=None):
         target
     )
 
-    ## (3) get neighbors for each entity
+    ## (2) get neighbors for each entity
     corpora = config['PairedNeighborhoodAnalysis']['CorpusOrdering'].split(',')
     neighbor_type = EmbeddingType.parse('ENTITY')
     query_confidences = getConfidences(
@@ -335,7 +402,7 @@ def pairwise(query=None, target=None):
         limit=num_neighbors,
     )
 
-    ## (4) reconfigure table layout to have paired columnar browsing
+    ## (3) reconfigure table layout to have paired columnar browsing
     paired_tables = []
     for i in range(len(query_tables)):
         query_tables[i]['IsGridRowStart'] = True
@@ -347,14 +414,7 @@ def pairwise(query=None, target=None):
         paired_tables.append(query_tables[i])
         paired_tables.append(target_tables[i])
 
-    ## (5) draw the pairwise similarity graph
-    pairwise_similarity_analysis_base64 = packaging.renderImage(
-        visualization.pairwiseSimilarityAnalysis,
-        args=(corpora, means, stds),
-        kwargs={'figsize': (13,3), 'font_size': 14}
-    )
-
-    return render_template(
+    response = render_template(
         'pairwise.html',
         query=query,
         query_preferred_term=query_preferred_term,
@@ -362,32 +422,50 @@ def pairwise(query=None, target=None):
         target=target,
         target_preferred_term=target_preferred_term,
         target_terms=sorted(target_term_list),
-        paired_tables=paired_tables,
-        pairwise_similarity_analysis_base64=pairwise_similarity_analysis_base64
+        paired_tables=paired_tables
     )
+    response_cache.put(generation, cache_key, response)
+    return response
+
 
 
 
+def cachedJSON(cache_key, getData):
+    '''Returns a JSON response of getData(db), cached (as serialized JSON)
+    under cache_key for the current DB generation.
+    '''
+    db = getDatabase()
+    generation = db.getGeneration()
+    response = response_cache.get(generation, cache_key)
+    if response is None:
+        response = jsonify(getData(db)).get_data(as_text=True)
+        response_cache.put(generation, cache_key, response)
+    return app.response_class(response, mimetype='application/json')
 
-## TODO: change to single query
 def getNeighborTables(db, corpora, query_key, neighbor_type, confidences,
         limit=10, high_confidence_threshold=0.5):
+    rows_by_corpus = {}
+    rows = db.selectFromAggregateNearestNeighborsForKey(
+        query_key,
+        [
+            (corpus, corpus, '.HC_{0}'.format(corpus))
+                for corpus in corpora
+        ],
+        neighbor_type=neighbor_type,
+        limit=limit
+    )
+    for row in rows:
+        if not row.source in rows_by_corpus:
+            rows_by_corpus[row.source] = []
+        rows_by_corpus[row.source].append(row)
+
     tables = []
     TABLES_PER_ROW = 3
     for i in range(len(corpora)):
         corpus = corpora[i]
-        filter_set='.HC_{0}'.format(corpus)
-        rows = db.selectFromAggregateNearestNeighbors(
-            corpus,
-            corpus,
-            filter_set,
-            query_key,
-            neighbor_type=neighbor_type,
-            limit=limit
-        )
 
         table_rows = []
-        for row in rows:
+        for row in rows_by_corpus.get(corpus, []):
             table_rows.append({
                 'QueryKey': query_key,
                 'NeighborKey': row.neighbor_key,
@@ -417,17 +495,15 @@ def getNeighborTables(db, corpora, query_key, neighbor_type, confidences,
         })
     return tables
 
-## TODO: change to single query
 def getConfidences(db, corpora, query_key):
     confidences = {}
-    for corpus in corpora:
-        rows = db.selectFromInternalConfidence(
-            src=corpus,
-            at_k=5,
-            key=query_key
-        )
-        for row in rows:
-            confidences[corpus] = row.confidence
+    rows = db.selectFromInternalConfidenceForKey(
+        query_key,
+        corpora,
+        at_k=5
+    )
+    for row in rows:
+        confidences[row.source] = row.confidence
     return confidences
 
 def getTerms(db, query_key):
@@ -0,0 +1,112 @@
+'''
+Bounded cache of rendered dashboard responses.
+
+Entries are keyed on the DB generation (see
+EmbeddingNeighborhoodDatabase.getGeneration) plus a view-specific key, so
+any load into the DB invalidates everything cached before it.
+'''
+
+import os
+import re
+import shutil
+import hashlib
+import threading
+import collections
+
+## on-disk generation directories, named for bumpGeneration tokens
+_GENERATION_DIR = re.compile(r'^g[0-9a-f]{16}-[0-9a-f]{32}$')
+
+class ResponseCache:
+    '''Thread-safe LRU cache of response strings, held in memory and
+    (if cache_dir is given) also written to disk, so that they survive
+    restarts of the dashboard.
+
+    On disk, each generation is kept in its own subdirectory of cache_dir;
+    directories for older generations are removed when a newer one is first
+    written to.
+    '''
+    def __init__(self, max_size=256, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def get(self, generation, key):
+        with self._lock:
+            self._setGeneration(generation)
+            value = self._entries.get((generation, key), None)
+            if not (value is None):
+                self._entries.move_to_end((generation, key))
+
+        if (value is None) and (not (self.cache_dir is None)):
+            value = self._readFromDisk(generation, key)
+            if not (value is None):
+                self._store(generation, key, value)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, generation, key, value):
+        stored = self._store(generation, key, value)
+        if stored and (not (self.cache_dir is None)):
+            self._writeToDisk(generation, key, value)
+
+    def _store(self, generation, key, value):
+        with self._lock:
+            self._setGeneration(generation)
+            ## responses rendered from an older generation are not kept
+            if generation != self._generation:
+                return False
+            self._entries[(generation, key)] = value
+            self._entries.move_to_end((generation, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def _setGeneration(self, generation):
+        '''Drops all in-memory entries when a newer generation is seen
+        (callers hold self._lock).
+        '''
+        if (self._generation is None) or (generation > self._generation):
+            self._entries.clear()
+            self._generation = generation
+
+    def _diskPath(self, generation, key):
+        key_hash = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'g{0}'.format(generation), key_hash)
+
+    def _readFromDisk(self, generation, key):
+        try:
+            with open(self._diskPath(generation, key), 'r', encoding='utf-8') as stream:
+                return stream.read()
+        except FileNotFoundError:
+            return None
+
+    def _writeToDisk(self, generation, key, value):
+        fpath = self._diskPath(generation, key)
+        gen_dir = os.path.dirname(fpath)
+        if not os.path.isdir(gen_dir):
+            os.makedirs(gen_dir, exist_ok=True)
+            self._pruneDisk(generation)
+
+        ## write to a temporary file and rename, so concurrent readers never
+        ## see a partial response
+        tmp_fpath = '{0}.{1}.tmp'.format(fpath, threading.get_ident())
+        with open(tmp_fpath, 'w', encoding='utf-8') as stream:
+            stream.write(value)
+        os.replace(tmp_fpath, fpath)
+
+    def _pruneDisk(self, generation):
+        ## removes older generations, and any directory left from an
+        ## earlier generation format
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith('g') or name == 'g{0}'.format(generation):
+                continue
+            if (not _GENERATION_DIR.match(name)) or name[1:] < generation:
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
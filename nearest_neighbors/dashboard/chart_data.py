@@ -0,0 +1,78 @@
+'''
+Data series behind the dashboard charts, aligned to the corpus ordering
+(None wherever a corpus has no data).  Served as JSON for client-side
+drawing, and used by export_charts for offline matplotlib rendering.
+'''
+
+def entityChangeSeries(db, corpora, query_key, at_k=5):
+    '''Confidence-weighted delta (CWD) for each consecutive pair of corpora.
+    '''
+    change_subsets = []
+    for i in range(len(corpora)-1):
+        change_src = corpora[i]
+        change_trg = corpora[i+1]
+        filter_set = '.HC_Union_{0}_{1}'.format(change_src, change_trg)  ## TODO HARD CODED
+        change_subsets.append((change_src, change_trg, filter_set))
+
+    rows_by_subset = {}
+    rows = db.selectFromEntityOverlapAnalysisForKey(
+        query_key,
+        change_subsets,
+        at_k
+    )
+    for row in rows:
+        subset = (row.source, row.target, row.filter_set)
+        if not subset in rows_by_subset:
+            rows_by_subset[subset] = []
+        rows_by_subset[subset].append(row)
+
+    cwds = []
+    for subset in change_subsets:
+        rows = rows_by_subset.get(subset, [])
+        if len(rows) == 1:
+            cwds.append(rows[0].CWD)
+        else:
+            cwds.append(None)
+
+    return {
+        'corpora': corpora,
+        'cwds': cwds
+    }
+
+def internalConfidenceSeries(db, corpora, query_key, threshold, at_k=5):
+    confidences = {}
+    rows = db.selectFromInternalConfidenceForKey(
+        query_key,
+        corpora,
+        at_k
+    )
+    for row in rows:
+        confidences[row.source] = row.confidence
+
+    return {
+        'corpora': corpora,
+        'confidences': [confidences.get(c, None) for c in corpora],
+        'threshold': threshold
+    }
+
+def pairwiseSimilaritySeries(db, corpora, query, target):
+    similarities = {}
+    rows = db.selectFromAggregatePairwiseSimilarity(query, target)
+    for row in rows:
+        similarities[row.source] = row
+
+    means, stds = [], []
+    for corpus in corpora:
+        row = similarities.get(corpus, None)
+        if row is None:
+            means.append(None)
+            stds.append(None)
+        else:
+            means.append(row.mean_similarity)
+            stds.append(row.std_similarity)
+
+    return {
+        'corpora': corpora,
+        'means': means,
+        'stds': stds
+    }
@@ -0,0 +1,113 @@
+'''
+Offline export of the dashboard charts for an entity (or pair of
+entities) as PNG files, rendered with matplotlib from the same data
+series served by the dashboard's JSON endpoints.
+'''
+
+import configparser
+from hedgepig_logger import log
+from ..database import EmbeddingNeighborhoodDatabase
+from . import chart_data
+from . import visualization
+
+def exportCharts(db, corpora, query_key, outf_prefix, hc_threshold=0.5, target=None):
+    exported = []
+
+    series = chart_data.entityChangeSeries(db, corpora, query_key)
+    if len([cwd for cwd in series['cwds'] if not (cwd is None)]) > 0:
+        outf = '{0}.entity_change.png'.format(outf_prefix)
+        visualization.entityChangeAnalysis(
+            series['corpora'],
+            series['cwds'],
+            outf=outf,
+            figsize=(11,3),
+            font_size=14
+        )
+        exported.append(outf)
+
+    series = chart_data.internalConfidenceSeries(db, corpora, query_key, hc_threshold)
+    outf = '{0}.internal_confidence.png'.format(outf_prefix)
+    visualization.internalConfidenceAnalysis(
+        series['corpora'],
+        series['confidences'],
+        series['threshold'],
+        outf=outf,
+        figsize=(6,2),
+        font_size=14
+    )
+    exported.append(outf)
+
+    if not (target is None):
+        series = chart_data.pairwiseSimilaritySeries(db, corpora, query_key, target)
+        outf = '{0}.pairwise_similarity.png'.format(outf_prefix)
+        visualization.pairwiseSimilarityAnalysis(
+            series['corpora'],
+            series['means'],
+            series['stds'],
+            outf=outf,
+            figsize=(13,3),
+            font_size=14
+        )
+        exported.append(outf)
+
+    return exported
+
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog')
+        parser.add_option('-q', '--query-key', dest='query_key',
+            help='(required) entity key to export charts for')
+        parser.add_option('-t', '--target-key', dest='target_key',
+            help='(optional) second entity key, to export the pairwise'
+                 ' similarity chart for query/target')
+        parser.add_option('-o', '--output', dest='outf_prefix',
+            help='(required) prefix of PNG files to write')
+        parser.add_option('-c', '--config', dest='configf',
+            default='config.ini')
+        parser.add_option('-l', '--logfile', dest='logfile',
+            help='name of file to write log contents to (empty for stdout)',
+            default=None)
+        (options, args) = parser.parse_args()
+        if not options.query_key:
+            parser.print_help()
+            parser.error('Must provide --query-key')
+        if not options.outf_prefix:
+            parser.print_help()
+            parser.error('Must provide --output')
+        return options
+
+    options = _cli()
+    log.start(options.logfile)
+    log.writeConfig([
+        ('Query key', options.query_key),
+        ('Target key', options.target_key),
+        ('Output prefix', options.outf_prefix),
+        ('Configuration file', options.configf),
+    ], 'Dashboard chart export')
+
+    log.writeln('Reading configuration file from %s...' % options.configf)
+    config = configparser.ConfigParser()
+    config.read(options.configf)
+    config = config['PairedNeighborhoodAnalysis']
+    log.writeln('Done.\n')
+
+    log.writeln('Loading embedding neighborhood database...')
+    db = EmbeddingNeighborhoodDatabase(config['DatabaseFile'], read_only=True)
+    log.writeln('Database ready.\n')
+
+    log.writeln('Rendering charts...')
+    exported = exportCharts(
+        db,
+        config['CorpusOrdering'].split(','),
+        options.query_key,
+        options.outf_prefix,
+        hc_threshold=float(config['HighConfidenceThreshold']),
+        target=options.target_key
+    )
+    for outf in exported:
+        log.writeln('  Wrote {0}'.format(outf))
+    log.writeln('Done.')
+
+    log.stop()
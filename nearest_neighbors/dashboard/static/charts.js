@@ -0,0 +1,232 @@
+// Draws the dashboard charts as inline SVG from the /_get_*_analysis JSON
+// endpoints.  Any element with a data-chart attribute is filled in from its
+// data-url on page load.
+var SVG_NS = "http://www.w3.org/2000/svg";
+
+function svgElement(name, attrs) {
+    var el = document.createElementNS(SVG_NS, name);
+    for (var key in attrs)
+        el.setAttribute(key, attrs[key]);
+    return el;
+}
+
+// spec fields:
+//   width, height    -- SVG viewBox size
+//   ticks            -- x positions of the corpus ticks
+//   tickLabels       -- labels for ticks
+//   xMin, xMax       -- x axis range
+//   yMax             -- y axis upper bound (lower bound is 0)
+//   xs, ys, errs     -- points to plot (errs optional)
+//   marker           -- "x" or "dot"
+//   threshold        -- optional y value of a horizontal reference line
+//   rotateLabels     -- if true, tick labels are slanted
+//   xLabel, yLabel
+function plotSeries(container, spec) {
+    var margin = {
+        left: 70,
+        right: 20,
+        top: 10,
+        bottom: spec.rotateLabels ? 110 : 50
+    };
+    var plotWidth = spec.width - margin.left - margin.right;
+    var plotHeight = spec.height - margin.top - margin.bottom;
+    var xScale = function(x) {
+        return margin.left + ((x - spec.xMin) / (spec.xMax - spec.xMin)) * plotWidth;
+    };
+    var yScale = function(y) {
+        return margin.top + (1 - (y / spec.yMax)) * plotHeight;
+    };
+
+    var svg = svgElement("svg", {
+        "viewBox": "0 0 " + spec.width + " " + spec.height,
+        "width": "100%",
+        "class": "chart_svg"
+    });
+
+    // axes box
+    svg.appendChild(svgElement("rect", {
+        "x": margin.left, "y": margin.top,
+        "width": plotWidth, "height": plotHeight,
+        "fill": "none", "stroke": "black"
+    }));
+
+    // y ticks at quarters of the range
+    for (var i = 0; i <= 4; i++) {
+        var y = spec.yMax * i / 4;
+        svg.appendChild(svgElement("line", {
+            "x1": margin.left - 5, "x2": margin.left,
+            "y1": yScale(y), "y2": yScale(y),
+            "stroke": "black"
+        }));
+        var label = svgElement("text", {
+            "x": margin.left - 8, "y": yScale(y) + 4,
+            "text-anchor": "end", "font-size": 12
+        });
+        label.textContent = y.toFixed(2);
+        svg.appendChild(label);
+    }
+
+    // x ticks at each corpus
+    for (var i = 0; i < spec.ticks.length; i++) {
+        var x = xScale(spec.ticks[i]);
+        svg.appendChild(svgElement("line", {
+            "x1": x, "x2": x,
+            "y1": margin.top + plotHeight, "y2": margin.top + plotHeight + 5,
+            "stroke": "black"
+        }));
+        var label;
+        if (spec.rotateLabels) {
+            label = svgElement("text", {
+                "x": x, "y": margin.top + plotHeight + 16,
+                "text-anchor": "start", "font-size": 12,
+                "transform": "rotate(60 " + x + " " + (margin.top + plotHeight + 16) + ")"
+            });
+        } else {
+            label = svgElement("text", {
+                "x": x, "y": margin.top + plotHeight + 20,
+                "text-anchor": "middle", "font-size": 12
+            });
+        }
+        label.textContent = spec.tickLabels[i];
+        svg.appendChild(label);
+    }
+
+    // axis labels
+    var xLabel = svgElement("text", {
+        "x": margin.left + (plotWidth / 2), "y": spec.height - 5,
+        "text-anchor": "middle", "font-size": 14
+    });
+    xLabel.textContent = spec.xLabel;
+    svg.appendChild(xLabel);
+    var yLabelX = 15, yLabelY = margin.top + (plotHeight / 2);
+    var yLabel = svgElement("text", {
+        "x": yLabelX, "y": yLabelY,
+        "text-anchor": "middle", "font-size": 14,
+        "transform": "rotate(-90 " + yLabelX + " " + yLabelY + ")"
+    });
+    yLabel.textContent = spec.yLabel;
+    svg.appendChild(yLabel);
+
+    // reference line
+    if (spec.threshold !== undefined) {
+        svg.appendChild(svgElement("line", {
+            "x1": xScale(spec.ticks[0]), "x2": xScale(spec.ticks[spec.ticks.length - 1]),
+            "y1": yScale(spec.threshold), "y2": yScale(spec.threshold),
+            "stroke": "#dddddd", "stroke-dasharray": "6,4"
+        }));
+    }
+
+    // error bars
+    if (spec.errs !== undefined) {
+        for (var i = 0; i < spec.xs.length; i++) {
+            svg.appendChild(svgElement("line", {
+                "x1": xScale(spec.xs[i]), "x2": xScale(spec.xs[i]),
+                "y1": yScale(Math.max(0, spec.ys[i] - spec.errs[i])),
+                "y2": yScale(Math.min(spec.yMax, spec.ys[i] + spec.errs[i])),
+                "stroke": "red"
+            }));
+        }
+    }
+
+    // dashed line through the points
+    var points = [];
+    for (var i = 0; i < spec.xs.length; i++)
+        points.push(xScale(spec.xs[i]) + "," + yScale(spec.ys[i]));
+    svg.appendChild(svgElement("polyline", {
+        "points": points.join(" "),
+        "fill": "none", "stroke": "red", "stroke-dasharray": "6,4"
+    }));
+
+    // markers
+    for (var i = 0; i < spec.xs.length; i++) {
+        var x = xScale(spec.xs[i]), y = yScale(spec.ys[i]);
+        if (spec.marker == "x") {
+            svg.appendChild(svgElement("path", {
+                "d": "M" + (x-4) + "," + (y-4) + " L" + (x+4) + "," + (y+4)
+                    + " M" + (x-4) + "," + (y+4) + " L" + (x+4) + "," + (y-4),
+                "stroke": "blue"
+            }));
+        } else {
+            svg.appendChild(svgElement("circle", {
+                "cx": x, "cy": y, "r": 3, "fill": "blue"
+            }));
+        }
+    }
+
+    $(container).empty().append(svg);
+}
+
+// collects the non-null points of a series aligned to corpora, at
+// position offset + index
+function nonNullPoints(values, errs, offset) {
+    var xs = [], ys = [], es = [];
+    for (var i = 0; i < values.length; i++) {
+        if (values[i] !== null) {
+            xs.push(i + offset);
+            ys.push(values[i]);
+            if (errs !== null)
+                es.push(errs[i]);
+        }
+    }
+    return {xs: xs, ys: ys, errs: es};
+}
+
+var CHARTS = {
+    entityChange: function(container, data) {
+        var points = nonNullPoints(data.cwds, null, 1.5);
+        var maxY = Math.max.apply(null, points.ys.concat([0])), yMax = 1.0;
+        var limits = [0.25, 0.5, 0.75, 1.0];
+        for (var i = 0; i < limits.length; i++) {
+            yMax = limits[i];
+            if (limits[i] > maxY)
+                break;
+        }
+        var ticks = [];
+        for (var i = 0; i < data.corpora.length; i++)
+            ticks.push(i + 1);
+        plotSeries(container, {
+            width: 1100, height: 300,
+            ticks: ticks, tickLabels: data.corpora,
+            xMin: 0.5, xMax: data.corpora.length + 0.5, yMax: yMax,
+            xs: points.xs, ys: points.ys, marker: "x",
+            xLabel: "Corpus versions", yLabel: "Confidence-weighted delta"
+        });
+    },
+    internalConfidence: function(container, data) {
+        var points = nonNullPoints(data.confidences, null, 0);
+        var ticks = [];
+        for (var i = 0; i < data.corpora.length; i++)
+            ticks.push(i);
+        plotSeries(container, {
+            width: 600, height: 260,
+            ticks: ticks, tickLabels: data.corpora,
+            xMin: -0.5, xMax: data.corpora.length - 0.5, yMax: 1.0,
+            xs: points.xs, ys: points.ys, marker: "dot",
+            threshold: data.threshold, rotateLabels: true,
+            xLabel: "Corpus versions", yLabel: "Confidence"
+        });
+    },
+    pairwiseSimilarity: function(container, data) {
+        var points = nonNullPoints(data.means, data.stds, 0);
+        var ticks = [];
+        for (var i = 0; i < data.corpora.length; i++)
+            ticks.push(i);
+        plotSeries(container, {
+            width: 1300, height: 360,
+            ticks: ticks, tickLabels: data.corpora,
+            xMin: -0.5, xMax: data.corpora.length - 0.5, yMax: 1.0,
+            xs: points.xs, ys: points.ys, errs: points.errs, marker: "dot",
+            rotateLabels: true,
+            xLabel: "Corpus versions", yLabel: "Agg. Cos. Sim."
+        });
+    }
+};
+
+$(function() {
+    $("[data-chart]").each(function() {
+        var container = this;
+        $.getJSON($(container).data("url"), function(data) {
+            CHARTS[$(container).data("chart")](container, data);
+        });
+    });
+});
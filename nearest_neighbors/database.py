@@ -1,6 +1,10 @@
 import sqlite3
 import os
+import re
 import math
+import time
+import uuid
+from urllib.request import pathname2url
 from .data_models import *
 
 class EmbeddingType:
@@ -22,12 +26,97 @@ class EmbeddingType:
         else:
             raise ValueError('EmbeddingType "%s" not known' % string)
 
+class _QueryPlanRecorder:
+    '''Stands in for a cursor: records the EXPLAIN QUERY PLAN details of
+    each executed query instead of running it.
+    '''
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.plans = []
+
+    def execute(self, query, args=()):
+        self._cursor.execute('EXPLAIN QUERY PLAN {0}'.format(query), args)
+        self.plans.append([row[3] for row in self._cursor.fetchall()])
+
+    def __iter__(self):
+        return iter(())
+
+def _usesIndex(plan, index):
+    '''True if any line of EXPLAIN QUERY PLAN output looks rows up with
+    index; for an FTS5 table, index is the table itself, and it is used
+    when the query has a MATCH constraint (marked with M in the virtual
+    table's index string).
+    '''
+    for detail in plan:
+        if re.search(r'\bINDEX {0}\b'.format(re.escape(index)), detail):
+            return True
+        if re.match(r'SCAN {0} VIRTUAL TABLE INDEX [^:]*:\S*M'.format(re.escape(index)), detail):
+            return True
+    return False
+
+def _valuesList(rows):
+    '''Placeholder VALUES list for matching row values with IN, e.g.
+    "VALUES (?, ?), (?, ?)" for two pairs.
+    '''
+    return 'VALUES {0}'.format(', '.join([
+        '({0})'.format(', '.join(['?' for _ in row]))
+            for row in rows
+    ]))
+
 class EmbeddingNeighborhoodDatabase:
-    
-    def __init__(self, fpath):
-        self._connection = sqlite3.connect(fpath)
-        self._cursor = self._connection.cursor()
-        self._build()
+
+    ## incremented whenever _migrate adds to the schema
+    SCHEMA_VERSION = 5
+
+    ## (method, args, kwargs, expected index) for each select issued by
+    ## the dashboard, where the expected index is the one the query's
+    ## main lookup should use (see checkQueryPlans)
+    DASHBOARD_QUERIES = [
+        ('selectFromEntityOverlapAnalysis', ('src', 'trg', 'filter', 5), {
+            'source_confidence_threshold': 0.5,
+            'target_confidence_threshold': 0.5,
+            'order_by': 'ConfidenceWeightedDelta DESC',
+            'limit': 50
+        }, 'sqlite_autoindex_EntityOverlapAnalysis_1'),
+        ('selectFromEntityOverlapAnalysisForKey', ('key', [('src', 'trg', 'filter'), ('trg', 'src', 'filter')], 5), {},
+            'EntityOverlapAnalysisByKey'),
+        ('selectFromInternalConfidenceForKey', ('key', ['src', 'trg'], 5), {},
+            'InternalConfidenceByKey'),
+        ('selectFromAggregateNearestNeighborsForKey', ('key', [('src', 'src', 'filter'), ('trg', 'trg', 'filter')]), {},
+            'AggregateNearestNeighborsByKey'),
+        ('findAggregateNearestNeighborsMembership', ('key',), {},
+            'AggregateNearestNeighborsByKey'),
+        ('selectFromEntityTerms', ('key',), {},
+            'EntityTermsByKey'),
+        ('selectFromEntityDefinitions', ('key',), {},
+            'sqlite_autoindex_EntityDefinitions_1'),
+        ('selectFromAggregatePairwiseSimilarity', ('key', 'neighbor'), {},
+            'AggregatePairwiseSimilarityByKey'),
+        ('searchInEntityTerms', ('query',), {},
+            'EntityTermsSearch'),
+    ]
+
+    def __init__(self, fpath, read_only=False):
+        '''If read_only is True, opens an existing database without
+        checking the schema; such connections may be shared between threads
+        (one at a time), e.g. in a connection pool.
+        '''
+        if read_only:
+            self._connection = sqlite3.connect(
+                'file:{0}?mode=ro'.format(pathname2url(os.path.abspath(fpath))),
+                uri=True,
+                isolation_level=None,
+                check_same_thread=False
+            )
+            self._cursor = self._connection.cursor()
+            self._cursor.execute('PRAGMA query_only = ON')
+        else:
+            self._connection = sqlite3.connect(fpath)
+            self._cursor = self._connection.cursor()
+            ## WAL mode is stored in the DB file, and lets read-only
+            ## connections continue reading while data are loaded
+            self._cursor.execute('PRAGMA journal_mode = WAL')
+            self._build()
 
     def close(self):
         self._connection.close()
@@ -103,9 +192,12 @@ class EmbeddingNeighborhoodDatabase:
 
 
         ## the EntityTerms table maps entity keys to string terms
+        ## (ID is the row ID referenced by the EntityTermsSearch index;
+        ##  declaring it keeps it stable under VACUUM)
         self._cursor.execute('''
         CREATE TABLE IF NOT EXISTS EntityTerms
         (
+            ID INTEGER PRIMARY KEY,
             EntityKey text,
             Term text,
             Preferred int,
@@ -140,25 +232,223 @@ class EmbeddingNeighborhoodDatabase:
         )
         ''')
 
+        ## the DatabaseGeneration table holds a single generation token,
+        ## replaced after every load, for invalidating cached dashboard
+        ## responses (see bumpGeneration)
+        self._cursor.execute('''
+        CREATE TABLE IF NOT EXISTS DatabaseGeneration
+        (
+            Generation text
+        )
+        ''')
+        self._cursor.execute('SELECT Generation FROM DatabaseGeneration')
+        rows = self._cursor.fetchall()
+        if len(rows) != 1 or not isinstance(rows[0][0], str):
+            self.bumpGeneration()
+
         ## flush all changes to DB
         self._connection.commit()
 
+        self._migrate()
+
+    def _migrate(self):
+        self._cursor.execute('PRAGMA user_version')
+        (version,) = self._cursor.fetchone()
+        if version >= self.SCHEMA_VERSION:
+            return
+
+        ## EntityTerms created before schema version 4 used implicit rowids,
+        ## which VACUUM may renumber; copy it into a table with a declared
+        ## ID (the search index over it is rebuilt below)
+        self._cursor.execute('PRAGMA table_info(EntityTerms)')
+        if not 'ID' in [row[1] for row in self._cursor.fetchall()]:
+            self._cursor.execute('DROP TABLE IF EXISTS EntityTermsSearch')
+            self._cursor.execute('''
+            CREATE TABLE EntityTermsWithID
+            (
+                ID INTEGER PRIMARY KEY,
+                EntityKey text,
+                Term text,
+                Preferred int,
+                UNIQUE(EntityKey, Term)
+            )
+            ''')
+            self._cursor.execute('''
+            INSERT INTO EntityTermsWithID
+                (
+                    EntityKey, Term, Preferred
+                )
+            SELECT
+                EntityKey, Term, Preferred
+            FROM
+                EntityTerms
+            ORDER BY rowid
+            ''')
+            self._cursor.execute('DROP TABLE EntityTerms')
+            self._cursor.execute('ALTER TABLE EntityTermsWithID RENAME TO EntityTerms')
+
+        ## DatabaseGeneration was declared with an int column before schema
+        ## version 5, though it has always held text tokens; copy the
+        ## current token into a text column (keeping cached responses valid)
+        self._cursor.execute('PRAGMA table_info(DatabaseGeneration)')
+        if [row[2].lower() for row in self._cursor.fetchall()] != ['text']:
+            self._cursor.execute('ALTER TABLE DatabaseGeneration RENAME TO DatabaseGenerationInt')
+            self._cursor.execute('''
+            CREATE TABLE DatabaseGeneration
+            (
+                Generation text
+            )
+            ''')
+            self._cursor.execute('''
+            INSERT INTO DatabaseGeneration
+            SELECT
+                CAST(Generation AS text)
+            FROM
+                DatabaseGenerationInt
+            ''')
+            self._cursor.execute('DROP TABLE DatabaseGenerationInt')
+
+        ## secondary indexes matching the dashboard's access patterns
+        ## (the UNIQUE constraints above all lead with Source)
+        self._cursor.execute('''
+        CREATE INDEX IF NOT EXISTS EntityTermsByKey
+        ON EntityTerms(EntityKey, Preferred, Term)
+        ''')
+        self._cursor.execute('''
+        CREATE INDEX IF NOT EXISTS InternalConfidenceByKey
+        ON InternalConfidence(EntityKey, AtK, Source, Confidence)
+        ''')
+        self._cursor.execute('''
+        CREATE INDEX IF NOT EXISTS AggregateNearestNeighborsByKey
+        ON AggregateNearestNeighbors(EntityKey, Source, NeighborType, MeanDistance, NeighborKey)
+        ''')
+        self._cursor.execute('''
+        CREATE INDEX IF NOT EXISTS AggregateNearestNeighborSubsetsByNeighbor
+        ON AggregateNearestNeighborSubsets(NeighborID, Target, FilterSet)
+        ''')
+        self._cursor.execute('''
+        CREATE INDEX IF NOT EXISTS AggregatePairwiseSimilarityByKey
+        ON AggregatePairwiseSimilarity(EntityKey, NeighborKey, Source, MeanSimilarity, StdDevSimilarity)
+        ''')
+        self._cursor.execute('''
+        CREATE INDEX IF NOT EXISTS EntityOverlapAnalysisByKey
+        ON EntityOverlapAnalysis(EntityKey, AtK, Source, Target, FilterSet, ENSimilarity)
+        ''')
+
+        ## full-text index of entity keys and terms, for dashboard search
+        ## (external content: the text itself is read from EntityTerms)
+        self._cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS EntityTermsSearch
+        USING fts5(
+            EntityKey,
+            Term,
+            Preferred UNINDEXED,
+            content='EntityTerms',
+            content_rowid='ID'
+        )
+        ''')
+
+        self._cursor.execute('PRAGMA user_version = {0:d}'.format(self.SCHEMA_VERSION))
+        self._connection.commit()
+        self.rebuildSearchIndex()
+        self.analyze()
+
+    def analyze(self):
+        '''Refreshes the query planner's table statistics; should be re-run
+        after large loads.
+        '''
+        self._cursor.execute('ANALYZE')
+        self._connection.commit()
+
+    def rebuildSearchIndex(self):
+        '''Re-indexes all of EntityTerms for full-text search (e.g., if
+        EntityTerms was modified without going through insertOrUpdate or
+        deleteFromEntityTerms).
+        '''
+        self._cursor.execute(
+            "INSERT INTO EntityTermsSearch(EntityTermsSearch) VALUES ('rebuild')"
+        )
+        self._connection.commit()
+
+    def checkQueryPlans(self, min_rows=1000):
+        '''Runs EXPLAIN QUERY PLAN over each of DASHBOARD_QUERIES, and checks
+        that each uses its expected index.
+
+        On small tables SQLite may rightly choose to scan the table
+        instead, so a missing index is only an error if the table has at
+        least min_rows rows (or the index does not exist).
+
+        Returns (errors, warnings), as lists of (method name, expected
+        index, plan details).
+        '''
+        errors, warnings = [], []
+        cursor = self._cursor
+        try:
+            for (method, args, kwargs, index) in self.DASHBOARD_QUERIES:
+                self._cursor = _QueryPlanRecorder(cursor)
+                list(getattr(self, method)(*args, **kwargs))
+                plan = [detail for plan in self._cursor.plans for detail in plan]
+                self._cursor = cursor
+                if not _usesIndex(plan, index):
+                    if self._indexedRows(index, min_rows) < min_rows:
+                        warnings.append((method, index, plan))
+                    else:
+                        errors.append((method, index, plan))
+        finally:
+            self._cursor = cursor
+        return errors, warnings
+
+    def _indexedRows(self, index, limit):
+        '''Number of rows (counting at most limit) in the table index is
+        on, or limit if there is no such index.
+        '''
+        self._cursor.execute(
+            "SELECT tbl_name FROM sqlite_master WHERE name=? AND type IN ('index', 'table')",
+            (index,)
+        )
+        row = self._cursor.fetchone()
+        if row is None:
+            return limit
+        self._cursor.execute('SELECT COUNT(*) FROM (SELECT 1 FROM "{0}" LIMIT ?)'.format(row[0]), (limit,))
+        return self._cursor.fetchone()[0]
+
+    def getGeneration(self):
+        self._cursor.execute('SELECT Generation FROM DatabaseGeneration')
+        rows = self._cursor.fetchall()
+        if len(rows) == 0:
+            return ''
+        return str(rows[0][0])
+
+    def bumpGeneration(self):
+        '''Marks the DB contents as changed; called once at the end of each
+        load (after its data are committed, so that no reader can see the
+        new generation with the old data).
+
+        Generations are tokens of a hex timestamp and a random UUID, so they
+        sort in load order, and are never reused (even if the DB file is
+        deleted and rebuilt).
+        '''
+        generation = '{0:016x}-{1}'.format(time.time_ns(), uuid.uuid4().hex)
+        self._cursor.execute('DELETE FROM DatabaseGeneration')
+        self._cursor.execute('INSERT INTO DatabaseGeneration VALUES (?)', (generation,))
+        self._connection.commit()
+
     def insertOrUpdate(self, objects, *args, **kwargs):
         if (not type(objects) is list) and (not type(objects) is tuple):
             objects = [objects]
 
         if type(objects[0]) is EntityOverlapAnalysis:
-            self.insertOrUpdateIntoEntityOverlapAnalysis(objects, *args, **kwargs)
+            return self.insertOrUpdateIntoEntityOverlapAnalysis(objects, *args, **kwargs)
         elif type(objects[0]) is InternalConfidence:
-            self.insertOrUpdateIntoInternalConfidence(objects, *args, **kwargs)
+            return self.insertOrUpdateIntoInternalConfidence(objects, *args, **kwargs)
         elif type(objects[0]) is AggregateNearestNeighbor:
-            self.insertOrUpdateIntoAggregateNearestNeighbors(objects, *args, **kwargs)
+            return self.insertOrUpdateIntoAggregateNearestNeighbors(objects, *args, **kwargs)
         elif type(objects[0]) is EntityTerm:
-            self.insertOrUpdateIntoEntityTerms(objects, *args, **kwargs)
+            return self.insertOrUpdateIntoEntityTerms(objects, *args, **kwargs)
         elif type(objects[0]) is EntityDefinition:
-            self.insertOrUpdateIntoEntityDefinitions(objects, *args, **kwargs)
+            return self.insertOrUpdateIntoEntityDefinitions(objects, *args, **kwargs)
         elif type(objects[0]) is AggregatePairwiseSimilarity:
-            self.insertOrUpdateIntoAggregatePairwiseSimilarity(objects, *args, **kwargs)
+            return self.insertOrUpdateIntoAggregatePairwiseSimilarity(objects, *args, **kwargs)
 
     def insertOrUpdateIntoEntityOverlapAnalysis(self, overlaps):
         if (not type(overlaps) is list) and (not type(overlaps) is tuple):
@@ -205,79 +495,155 @@ class EmbeddingNeighborhoodDatabase:
 
         self._connection.commit()
 
-    def insertOrUpdateIntoAggregateNearestNeighbors(self, nbrs, neighbor_type=EmbeddingType.ENTITY):
+    def insertOrUpdateIntoAggregateNearestNeighbors(self, nbrs, neighbor_type=EmbeddingType.ENTITY,
+            on_conflict='warn'):
+        '''Adds neighbors to AggregateNearestNeighbors (if not already
+        present) and links them to their source/target/filter set in
+        AggregateNearestNeighborSubsets.
+
+        Rows are staged in a temporary table and resolved with set-based
+        queries.  A conflict is a neighbor already saved with a different
+        distance (or neighbor type); conflicts are handled according to
+        on_conflict:
+          'warn'     keep the saved values, and print a summary of conflicts
+          'replace'  overwrite the saved distance with the new one
+          'abort'    roll back all changes and raise a ValueError
+        Returns the list of conflicts, as (source, key, neighbor key,
+        saved distance, new distance) tuples.
+        '''
         if (not type(nbrs) is list) and (not type(nbrs) is tuple):
             nbrs = [nbrs]
-        
-        ## since each neighbor relationship may or may not need to be added to
-        ## the AggregateNearestNeighbors table as well as to
-        ## AggregateNearestNeighborSubsets, process rows one by one
-        for nbr in nbrs:
-            
-            ## (1) check if it's already in AggregateNearestNeighbors
-            query = '''
-            SELECT ID, MeanDistance FROM AggregateNearestNeighbors
-            WHERE
-                Source=?
-                AND EntityKey=?
-                AND NeighborKey=?
-                AND NeighborType=?
+        if not on_conflict in ('warn', 'replace', 'abort'):
+            raise ValueError('Unknown conflict policy "%s"' % on_conflict)
+
+        ## (1) stage all rows in a temporary table
+        self._cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS StagedNearestNeighbors
+        (
+            Source text,
+            Target text,
+            FilterSet text,
+            EntityKey text,
+            NeighborKey text,
+            NeighborType int,
+            MeanDistance real
+        )
+        ''')
+        self._cursor.execute('DELETE FROM StagedNearestNeighbors')
+        self._cursor.executemany(
             '''
-            args = [nbr.source, nbr.key, nbr.neighbor_key, neighbor_type]
-            self._cursor.execute(query, args)
+            INSERT INTO StagedNearestNeighbors VALUES (
+                ?, ?, ?, ?, ?, ?, ?
+            )
+            ''',
+            [
+                (
+                    nbr.source, nbr.target, nbr.filter_set, nbr.key,
+                    nbr.neighbor_key, neighbor_type, nbr.mean_distance
+                )
+                    for nbr in nbrs
+            ]
+        )
 
-            nbr_info = self._cursor.fetchone()
+        ## (2) add any new neighbors to AggregateNearestNeighbors (the first
+        ##     staged copy is used, if a neighbor is staged more than once)
+        self._cursor.execute('''
+        INSERT INTO AggregateNearestNeighbors
+            (
+                Source, EntityKey, NeighborKey, NeighborType, MeanDistance
+            )
+        SELECT
+            Source, EntityKey, NeighborKey, NeighborType, MeanDistance
+        FROM
+            StagedNearestNeighbors
+        WHERE true
+        ORDER BY rowid
+        ON CONFLICT DO NOTHING
+        ''')
+
+        ## (3) find staged neighbors that disagree with the saved copy
+        ##     (fuzzy equality check to account for floating point errors)
+        self._cursor.execute('''
+        SELECT
+            a.ID,
+            s.Source,
+            s.EntityKey,
+            s.NeighborKey,
+            a.NeighborType,
+            s.NeighborType,
+            a.MeanDistance,
+            s.MeanDistance
+        FROM
+            StagedNearestNeighbors AS s
+            INNER JOIN AggregateNearestNeighbors AS a
+                ON a.Source=s.Source
+                AND a.EntityKey=s.EntityKey
+                AND a.NeighborKey=s.NeighborKey
+        WHERE
+            a.NeighborType != s.NeighborType
+            OR abs(a.MeanDistance - s.MeanDistance) > 0.001
+        ''')
+        conflict_rows = [
+            row
+                for row in self._cursor.fetchall()
+                if row[4] != row[5]
+                or not math.isclose(row[6], row[7], abs_tol=0.001)
+        ]
+        conflicts = [
+            (source, key, neighbor_key, saved_dist, new_dist)
+                for (_, source, key, neighbor_key, _, _, saved_dist, new_dist) in conflict_rows
+        ]
 
-            ## (2.1) if it isn't, add it to AggregateNearestNeighbors
-            if nbr_info is None:
-                row = (nbr.source, nbr.key, nbr.neighbor_key, neighbor_type, nbr.mean_distance)
-                self._cursor.execute(
+        if len(conflicts) > 0:
+            if on_conflict == 'abort':
+                self._connection.rollback()
+                raise ValueError('{0:,} conflicts with saved nearest neighbors (e.g., {1} <-> {2} in {3}: saved {4}, provided {5})'.format(
+                    len(conflicts), conflicts[0][1], conflicts[0][2],
+                    conflicts[0][0], conflicts[0][3], conflicts[0][4]
+                ))
+            elif on_conflict == 'replace':
+                self._cursor.executemany(
                     '''
-                    INSERT INTO
-                        AggregateNearestNeighbors
-                        (
-                            Source, EntityKey, NeighborKey, NeighborType, MeanDistance
-                        )
-                    VALUES (
-                        ?, ?, ?, ?, ?
-                    )
+                    UPDATE AggregateNearestNeighbors
+                    SET MeanDistance=?
+                    WHERE ID=?
                     ''',
-                    row
+                    [
+                        (row[7], row[0])
+                            for row in conflict_rows
+                    ]
                 )
-
-                # pull the ID of the new row
-                nbr_ID = self._cursor.lastrowid
-
-            ## (2.2) if it is, just make sure the distance is the same, as a sanity check
             else:
-                (nbr_ID, mean_dist) = nbr_info
-                # fuzzy equality check to account for floating point errors
-                if not math.isclose(mean_dist, nbr.mean_distance, abs_tol=0.001):
-                    print('[WARNING] Conflict in record for {0} <-> {1} in {2}'.format(nbr.key, nbr.neighbor_key, nbr.source))
-                    print('  Saved distance: {0}'.format(mean_dist))
-                    print('  Distance provided: {0}'.format(nbr.mean_distance))
-                    yn, acceptable = '', set(['y', 'n'])
-                    while not yn.strip().lower() in acceptable:
-                        yn = input('Proceed? [y/n] ')
-                    if yn.strip().lower() == 'n':
-                        print('Rolling back and aborting.')
-                        self._connection.rollback()
-                        exit(1)
-
-            ## (3) finally, add the source/target relationship to
-            ##     AggregateNearestNeighborSubsets
-            row = (nbr.source, nbr.target, nbr.filter_set, nbr_ID)
-            self._cursor.execute(
-                '''
-                REPLACE INTO AggregateNearestNeighborSubsets VALUES (
-                    ?, ?, ?, ?
-                )
-                ''',
-                row
-            )
+                print('[WARNING] {0:,} conflicts with saved nearest neighbors (saved distances kept)'.format(len(conflicts)))
+                for (source, key, neighbor_key, saved_dist, new_dist) in conflicts[:10]:
+                    print('  {0} <-> {1} in {2}  Saved distance: {3}  Distance provided: {4}'.format(
+                        key, neighbor_key, source, saved_dist, new_dist
+                    ))
+                if len(conflicts) > 10:
+                    print('  ...')
+
+        ## (4) finally, add the source/target relationships to
+        ##     AggregateNearestNeighborSubsets
+        self._cursor.execute('''
+        REPLACE INTO AggregateNearestNeighborSubsets
+        SELECT
+            s.Source,
+            s.Target,
+            s.FilterSet,
+            a.ID
+        FROM
+            StagedNearestNeighbors AS s
+            INNER JOIN AggregateNearestNeighbors AS a
+                ON a.Source=s.Source
+                AND a.EntityKey=s.EntityKey
+                AND a.NeighborKey=s.NeighborKey
+        ''')
+        self._cursor.execute('DELETE FROM StagedNearestNeighbors')
 
         self._connection.commit()
 
+        return conflicts
+
     def insertOrUpdateIntoEntityTerms(self, ent_terms):
         if (not type(ent_terms) is list) and (not type(ent_terms) is tuple):
             ent_terms = [ent_terms]
@@ -289,15 +655,107 @@ class EmbeddingNeighborhoodDatabase:
                 for et in ent_terms
         ]
 
+        ## (1) stage all rows in a temporary table
+        self._cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS StagedEntityTerms
+        (
+            EntityKey text,
+            Term text,
+            Preferred int
+        )
+        ''')
+        self._cursor.execute('DELETE FROM StagedEntityTerms')
         self._cursor.executemany(
             '''
-            REPLACE INTO EntityTerms VALUES (
+            INSERT INTO StagedEntityTerms VALUES (
                 ?, ?, ?
             )
             ''',
             rows
         )
 
+        ## (2) remove the terms about to be replaced from the search index
+        self._cursor.execute('''
+        INSERT INTO EntityTermsSearch
+            (
+                EntityTermsSearch, rowid, EntityKey, Term, Preferred
+            )
+        SELECT DISTINCT
+            'delete', et.ID, et.EntityKey, et.Term, et.Preferred
+        FROM
+            StagedEntityTerms AS s
+            INNER JOIN
+                EntityTerms AS et
+                ON
+                    et.EntityKey = s.EntityKey
+                    AND et.Term = s.Term
+        ''')
+
+        ## (3) replace the terms themselves (in staged order, so the last
+        ##     copy of a repeated term is kept)
+        self._cursor.execute('''
+        REPLACE INTO EntityTerms
+            (
+                EntityKey, Term, Preferred
+            )
+        SELECT
+            EntityKey, Term, Preferred
+        FROM
+            StagedEntityTerms
+        ORDER BY rowid
+        ''')
+
+        ## (4) index the new versions
+        self._cursor.execute('''
+        INSERT INTO EntityTermsSearch
+            (
+                rowid, EntityKey, Term, Preferred
+            )
+        SELECT DISTINCT
+            et.ID, et.EntityKey, et.Term, et.Preferred
+        FROM
+            StagedEntityTerms AS s
+            INNER JOIN
+                EntityTerms AS et
+                ON
+                    et.EntityKey = s.EntityKey
+                    AND et.Term = s.Term
+        ''')
+
+        self._connection.commit()
+
+    def deleteFromEntityTerms(self, key, term=None):
+        '''Removes all terms for key (or only term, if supplied) from
+        EntityTerms and from the search index.
+        '''
+        condition = 'EntityKey=?'
+        args = [key]
+        if not (term is None):
+            condition = '{0} AND Term=?'.format(condition)
+            args.append(term)
+
+        ## (1) remove the terms from the search index (which needs their
+        ##     current values)
+        self._cursor.execute('''
+        INSERT INTO EntityTermsSearch
+            (
+                EntityTermsSearch, rowid, EntityKey, Term, Preferred
+            )
+        SELECT
+            'delete', ID, EntityKey, Term, Preferred
+        FROM
+            EntityTerms
+        WHERE
+            {0}
+        '''.format(condition), args)
+
+        ## (2) remove the terms themselves
+        self._cursor.execute('''
+        DELETE FROM EntityTerms
+        WHERE
+            {0}
+        '''.format(condition), args)
+
         self._connection.commit()
 
     def insertOrUpdateIntoEntityDefinitions(self, ent_defns):
@@ -455,6 +913,83 @@ class EmbeddingNeighborhoodDatabase:
             yield ret_obj
 
 
+    def selectFromEntityOverlapAnalysisForKey(self, key, subsets, at_k):
+        '''Fetches the overlap analysis of a single entity for every
+        (src, trg, filter_set) in subsets with one query.
+        '''
+        subsets = list(subsets)
+        if len(subsets) == 0:
+            return
+
+        query = '''
+        SELECT
+            eoa.*,
+            ic_src.Confidence AS SourceInternalConfidence,
+            ic_trg.Confidence AS TargetInternalConfidence,
+            (
+                ic_src.Confidence
+                * ic_trg.Confidence
+                * (1 - eoa.ENSimilarity)
+            ) AS ConfidenceWeightedDelta,
+            et.Term
+        FROM
+            EntityOverlapAnalysis AS eoa
+        INNER JOIN
+            EntityTerms AS et
+        ON
+            et.EntityKey = eoa.EntityKey
+        INNER JOIN
+            InternalConfidence AS ic_src
+        ON
+            ic_src.EntityKey = eoa.EntityKey
+            AND ic_src.AtK = eoa.AtK
+            AND ic_src.Source = eoa.Source
+        INNER JOIN
+            InternalConfidence AS ic_trg
+        ON
+            ic_trg.EntityKey = eoa.EntityKey
+            AND ic_trg.AtK = eoa.AtK
+            AND ic_trg.Source = eoa.Target
+        WHERE
+            eoa.EntityKey=?
+            AND eoa.AtK=?
+            AND et.Preferred=1
+            AND (eoa.Source, eoa.Target, eoa.FilterSet) IN ({0})
+        '''.format(_valuesList(subsets))
+
+        args = [key, at_k]
+        for subset in subsets:
+            args.extend(subset)
+
+        self._cursor.execute(query, args)
+        for row in self._cursor:
+            (
+                source,
+                target,
+                filter_set,
+                at_k,
+                key,
+                EN_similarity,
+                source_confidence,
+                target_confidence,
+                CWD,
+                preferred_term
+            ) = row
+            ret_obj = EntityOverlapAnalysis(
+                source=source,
+                target=target,
+                filter_set=filter_set,
+                at_k=at_k,
+                key=key,
+                source_confidence=source_confidence,
+                target_confidence=target_confidence,
+                EN_similarity=EN_similarity,
+                CWD=CWD,
+                string=preferred_term
+            )
+            yield ret_obj
+
+
     def selectFromInternalConfidence(self, src=None, at_k=None, key=None):
         query = '''
         SELECT
@@ -501,6 +1036,47 @@ class EmbeddingNeighborhoodDatabase:
             yield ret_obj
 
 
+    def selectFromInternalConfidenceForKey(self, key, sources, at_k):
+        '''Fetches the internal confidence of a single entity in each of
+        sources with one query.
+        '''
+        sources = list(sources)
+        if len(sources) == 0:
+            return
+
+        query = '''
+        SELECT
+            Source,
+            AtK,
+            EntityKey,
+            Confidence
+        FROM
+            InternalConfidence
+        WHERE
+            EntityKey=?
+            AND AtK=?
+            AND Source IN ({0})
+        '''.format(', '.join(['?' for _ in sources]))
+
+        args = [key, at_k] + sources
+
+        self._cursor.execute(query, args)
+        for row in self._cursor:
+            (
+                source,
+                at_k,
+                entity_key,
+                confidence
+            ) = row
+            ret_obj = InternalConfidence(
+                source=source,
+                at_k=at_k,
+                key=entity_key,
+                confidence=confidence
+            )
+            yield ret_obj
+
+
     def selectFromAggregateNearestNeighbors(self, src, trg, filter_set, key,
             neighbor_type=EmbeddingType.ENTITY, limit=10):
 
@@ -573,6 +1149,97 @@ class EmbeddingNeighborhoodDatabase:
             yield ret_obj
 
 
+    def selectFromAggregateNearestNeighborsForKey(self, key, subsets,
+            neighbor_type=EmbeddingType.ENTITY, limit=10):
+        '''Fetches the nearest neighbors of a single entity for every
+        (src, trg, filter_set) in subsets with one query; yields up to limit
+        neighbors per subset, grouped by subset and in increasing distance.
+        '''
+        subsets = list(subsets)
+        if len(subsets) == 0:
+            return
+
+        query = '''
+        SELECT
+            Source,
+            Target,
+            FilterSet,
+            EntityKey,
+            NeighborKey,
+            MeanDistance,
+            QueryTerm,
+            NeighborTerm
+        FROM
+        (
+            SELECT
+                ann.Source,
+                anns.Target,
+                anns.FilterSet,
+                ann.EntityKey,
+                ann.NeighborKey,
+                ann.MeanDistance,
+                et_query.Term as QueryTerm,
+                et_nbr.Term as NeighborTerm,
+                ROW_NUMBER() OVER (
+                    PARTITION BY ann.Source, anns.Target, anns.FilterSet
+                    ORDER BY ann.MeanDistance ASC
+                ) AS NeighborRank
+            FROM
+                AggregateNearestNeighbors AS ann
+                INNER JOIN
+                    AggregateNearestNeighborSubsets AS anns
+                    ON
+                        anns.NeighborID = ann.ID
+                INNER JOIN
+                    EntityTerms AS et_query
+                    ON
+                        et_query.EntityKey = ann.EntityKey
+                        AND et_query.Preferred = 1
+                LEFT OUTER JOIN
+                    EntityTerms AS et_nbr
+                    ON
+                        et_nbr.EntityKey = ann.NeighborKey
+                        AND et_nbr.Preferred = 1
+            WHERE
+                ann.EntityKey=?
+                AND ann.NeighborType=?
+                AND (ann.Source, anns.Target, anns.FilterSet) IN ({0})
+        )
+        WHERE
+            NeighborRank <= ?
+        ORDER BY Source, Target, FilterSet, NeighborRank
+        '''.format(_valuesList(subsets))
+
+        args = [key, neighbor_type]
+        for subset in subsets:
+            args.extend(subset)
+        args.append(limit)
+
+        self._cursor.execute(query, args)
+        for row in self._cursor:
+            (
+                source,
+                target,
+                filter_set,
+                entity_key,
+                neighbor_key,
+                mean_distance,
+                query_term,
+                neighbor_term
+            ) = row
+            ret_obj = AggregateNearestNeighbor(
+                source=source,
+                target=target,
+                filter_set=filter_set,
+                key=entity_key,
+                string=query_term,
+                neighbor_key=neighbor_key,
+                neighbor_string=neighbor_term,
+                mean_distance=mean_distance
+            )
+            yield ret_obj
+
+
     def findAggregateNearestNeighborsMembership(self, key,
             neighbor_type=EmbeddingType.ENTITY):
         query = '''
@@ -594,7 +1261,9 @@ class EmbeddingNeighborhoodDatabase:
     def selectFromEntityTerms(self, key, preferred=False):
         query = '''
         SELECT
-            *
+            EntityKey,
+            Term,
+            Preferred
         FROM
             EntityTerms
         WHERE
@@ -649,18 +1318,40 @@ class EmbeddingNeighborhoodDatabase:
             yield ret_obj
 
 
-    def searchInEntityTerms(self, query_string):
+    def searchInEntityTerms(self, query_string, prefix=True, limit=50, offset=0):
+        '''Full-text search over entity keys and terms.  Every word in
+        query_string must match (as a prefix of a word, if prefix is True);
+        results are ranked by BM25 relevance, with preferred terms first
+        among equally relevant results.
+        '''
+        tokens = re.findall(r'\w+', query_string or '')
+        if len(tokens) == 0:
+            return
+
+        ## quote each token so that user input is never parsed as FTS5
+        ## query syntax
+        match_string = ' '.join([
+            '"{0}"{1}'.format(token, '*' if prefix else '')
+                for token in tokens
+        ])
+
         query = '''
         SELECT
-            *
+            EntityKey,
+            Term,
+            Preferred
         FROM
-            EntityTerms
+            EntityTermsSearch
         WHERE
-            EntityKey LIKE ?
-            OR Term LIKE ?
+            EntityTermsSearch MATCH ?
+        ORDER BY
+            rank,
+            Preferred DESC
+        LIMIT ?
+        OFFSET ?
         '''
 
-        args = [query_string, query_string]
+        args = [match_string, limit, offset]
 
         self._cursor.execute(query, args)
         for row in self._cursor:
@@ -4,48 +4,319 @@ I/O methods for embedding sets, neighbor files, and node map files
 
 import os
 import glob
+import array
 import codecs
+import collections
+import hashlib
+import shutil
+import struct
+import threading
+import numpy as np
+from multiprocessing import shared_memory
 import pyemblib
 
 class EmbeddingReplicates:
-    def __init__(self, ID, src_config, lazy=True):
+    '''Embedding replicates for one source, as listed by its ReplicateTemplate.
+
+    When lazy, iterating streams the replicates one at a time, reading the
+    next replicate on a background thread while the current one is in use
+    (see prefetchEmbeddings).  memory_budget (in bytes, or None for no
+    limit) bounds how much may be held at once for prefetching and for
+    stacked().
+    '''
+    def __init__(self, ID, src_config, lazy=True, cache_dir=None, memory_budget=None):
         self.ID = ID
+        self._cache_dir = cache_dir
+        self._memory_budget = memory_budget
 
         # detect number of replicates
-        self._embedfs = glob.glob(
+        self._embedfs = sorted(glob.glob(
             src_config['ReplicateTemplate'].format(REPL='*')
-        )
+        ))
         self._mode = src_config['EmbeddingFormat']
-        self._embedf_index = 0
 
-        self._lazy = True
-        if not lazy:
-            self._embeddings = list(self)
         self._lazy = lazy
+        if not lazy:
+            self._embeddings = [
+                readEmbeddings(embedf, self._mode, cache_dir=self._cache_dir)
+                    for embedf in self._embedfs
+            ]
 
     def __iter__(self):
         if self._lazy:
-            self._embedf_index = 0
-            return self
+            return prefetchEmbeddings(
+                self._embedfs,
+                self._mode,
+                cache_dir=self._cache_dir,
+                memory_budget=self._memory_budget
+            )
         else:
-            self._embeddings
+            return iter(self._embeddings)
 
-    def __next__(self):
-        if self._embedf_index == len(self._embedfs):
-            raise StopIteration
+    def __len__(self):
+        return len(self._embedfs)
+
+    def stacked(self):
+        '''Returns (vocab, matrix), where matrix is an (R, V, d) float32 array
+        of all replicates.  All replicates must have the same vocabulary, in
+        the same order; raises ValueError otherwise.
+
+        With a cache directory, the stack is stored next to the cached
+        matrices and returned as a read-only memmap.  Otherwise it is built
+        in memory, and None is returned if it would exceed the memory budget.
+        '''
+        stack_path, tmp_path, vocab = None, None, None
+        if not (self._cache_dir is None):
+            stack_hash = hashlib.sha1()
+            for embedf in self._embedfs:
+                stack_hash.update(_cachedFileHash(embedf, self._mode, self._cache_dir).encode('utf-8'))
+            stack_path = os.path.join(
+                self._cache_dir,
+                '%s.stack.npy' % stack_hash.hexdigest()
+            )
+            if os.path.isfile(stack_path):
+                vocab = readEmbeddings(self._embedfs[0], self._mode, cache_dir=self._cache_dir).vocab
+                return vocab, np.load(stack_path, mmap_mode='r')
+
+        matrix = None
+        try:
+            for (i, embeds) in enumerate(self):
+                (these_vocab, these_rows) = embeddingMatrix(embeds)
+                embeds = None
+                if matrix is None:
+                    vocab = these_vocab
+                    shape = (len(self), these_rows.shape[0], these_rows.shape[1])
+                    if stack_path is None:
+                        size = np.prod(shape) * np.dtype(np.float32).itemsize
+                        if not (self._memory_budget is None) and size > self._memory_budget:
+                            return None
+                        matrix = np.empty(shape, dtype=np.float32)
+                    else:
+                        tmp_path = '%s.tmp%d.npy' % (stack_path[:-len('.npy')], os.getpid())
+                        matrix = np.lib.format.open_memmap(tmp_path, mode='w+',
+                            dtype=np.float32, shape=shape)
+                if not (these_vocab is vocab or these_vocab == vocab):
+                    raise ValueError('Replicate {0} of {1} ({2}) does not have the same vocabulary as {3}'.format(
+                        i+1, self.ID, self._embedfs[i], self._embedfs[0]
+                    ))
+                matrix[i] = these_rows
+        except Exception:
+            matrix = None
+            if not (tmp_path is None) and os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if not (stack_path is None):
+            matrix.flush()
+            matrix = None
+            os.replace(tmp_path, stack_path)
+            matrix = np.load(stack_path, mmap_mode='r')
+        return vocab, matrix
+
+def prefetchEmbeddings(embedfs, mode, cache_dir=None, memory_budget=None):
+    '''Generator over the embeddings read from each of embedfs in turn.
+
+    While one set of embeddings is being used, the next is read on a
+    background thread, provided that both fit in memory_budget bytes
+    (estimated from file sizes; None for no limit).  Embeddings read through
+    a cache directory are memory-mapped, and are always prefetched.
+
+    Parsing embedding files holds the GIL, so reading only overlaps with
+    work on the current embeddings that releases it (e.g., numpy matrix
+    products, as in pair_similarity).
+    '''
+    def _read(embedf, result):
+        try:
+            result.append(readEmbeddings(embedf, mode, cache_dir=cache_dir))
+        except Exception as e:
+            result.append(e)
+
+    pending = None
+    for i in range(len(embedfs)):
+        if pending is None:
+            embeds = readEmbeddings(embedfs[i], mode, cache_dir=cache_dir)
         else:
-            embedf = self._embedfs[self._embedf_index]
-            embeds = pyemblib.read(embedf, mode=self._mode, errors='replace')
-            self._embedf_index += 1
-            return embeds
+            (thread, result) = pending
+            thread.join()
+            embeds = result[0]
+            if isinstance(embeds, Exception):
+                raise embeds
+            pending = None
+
+        if (i+1) < len(embedfs) and _fitsMemoryBudget(
+                    embedfs[i:i+2], cache_dir, memory_budget):
+            result = []
+            thread = threading.Thread(target=_read, args=(embedfs[i+1], result))
+            thread.daemon = True
+            thread.start()
+            pending = (thread, result)
+
+        yield embeds
+        embeds = None
+
+def _fitsMemoryBudget(embedfs, cache_dir, memory_budget):
+    # cached matrices are memory-mapped, so are not counted
+    if memory_budget is None or not (cache_dir is None):
+        return True
+    size = sum([
+        os.path.getsize(embedf)
+            for embedf in embedfs
+    ])
+    return size <= memory_budget
+
+class CachedEmbeddings:
+    '''Read-only embeddings backed by a vocabulary list and a (memory-mapped)
+    float32 matrix with precomputed row norms, as stored by readEmbeddings
+    in an embedding cache.
+
+    Supports the dictionary-style access used on pyemblib.Embeddings.
+    '''
+
+    def __init__(self, vocab, matrix, norms):
+        self.vocab = vocab
+        self.matrix = matrix
+        self.norms = norms
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {
+                self.vocab[i]: i
+                    for i in range(len(self.vocab))
+            }
+        return self._index
+
+    def normalized(self):
+        return self.matrix / self.norms[:, np.newaxis]
+
+    def __getitem__(self, key):
+        return self.matrix[self.index[key]]
+
+    def __contains__(self, key):
+        return key in self.index
 
     def __len__(self):
-        return len(self._embedfs)
+        return len(self.vocab)
+
+    def __iter__(self):
+        return iter(self.vocab)
+
+    def keys(self):
+        return list(self.vocab)
+
+    def items(self):
+        for i in range(len(self.vocab)):
+            yield (self.vocab[i], self.matrix[i])
+
+def embeddingMatrix(embeds):
+    '''Returns (vocabulary list, embedding matrix) for a set of embeddings,
+    using the stored matrix directly for cached embeddings.
+    '''
+    if isinstance(embeds, CachedEmbeddings):
+        return embeds.vocab, embeds.matrix
+    vocab = list(embeds.keys())
+    matrix = np.array([
+        embeds[k] for k in vocab
+    ], dtype=np.float32)
+    return vocab, matrix
+
+def readEmbeddings(f, mode, cache_dir=None):
+    '''Read embeddings from f with pyemblib.
+
+    If cache_dir is supplied, embeddings are instead loaded (memory-mapped)
+    from a cache directory keyed on the content hash of f, which is
+    created on the first read.  Returns a CachedEmbeddings in this case.
+    '''
+    if cache_dir is None:
+        return pyemblib.read(f, mode=mode, errors='replace')
+
+    cache_path = os.path.join(cache_dir, _cachedFileHash(f, mode, cache_dir))
+    if not os.path.isdir(cache_path):
+        embeds = pyemblib.read(f, mode=mode, errors='replace')
+        _writeEmbeddingCache(embeds, cache_path)
+    return _readEmbeddingCache(cache_path)
+
+def _cachedFileHash(f, mode, cache_dir):
+    '''Content hash of f (see _fileHash), remembered in cache_dir against
+    the path, size and modification time of f, so that the full file is
+    only re-hashed after it changes.
+    '''
+    stat = os.stat(f)
+    stat_key = hashlib.sha1('{0}\0{1}\0{2}\0{3}'.format(
+        os.path.abspath(f), stat.st_size, stat.st_mtime_ns, mode
+    ).encode('utf-8')).hexdigest()
+    stat_path = os.path.join(cache_dir, 'stat', stat_key)
+    if os.path.isfile(stat_path):
+        with open(stat_path, 'r') as stream:
+            return stream.read().strip()
+
+    file_hash = _fileHash(f, mode)
+    os.makedirs(os.path.dirname(stat_path), exist_ok=True)
+    tmp_path = '%s.tmp%d' % (stat_path, os.getpid())
+    with open(tmp_path, 'w') as stream:
+        stream.write(file_hash)
+    os.replace(tmp_path, stat_path)
+    return file_hash
+
+def _fileHash(f, mode, chunk_size=2**24):
+    file_hash = hashlib.sha1(mode.encode('utf-8'))
+    with open(f, 'rb') as stream:
+        chunk = stream.read(chunk_size)
+        while chunk:
+            file_hash.update(chunk)
+            chunk = stream.read(chunk_size)
+    return file_hash.hexdigest()
+
+def _writeEmbeddingCache(embeds, cache_path):
+    vocab = list(embeds.keys())
+    matrix = np.array([
+        embeds[k] for k in vocab
+    ], dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+
+    # write to a temporary directory and then move into place, so an
+    # interrupted write never leaves a partial cache entry
+    tmp_path = '%s.tmp%d' % (cache_path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    # vocab is stored one key per line, and read back splitting only on
+    # '\n' (other line boundaries such as '\x85' or '\u2028' may appear
+    # within keys)
+    with open(os.path.join(tmp_path, 'vocab.txt'), 'w', encoding='utf-8', newline='\n') as stream:
+        for k in vocab:
+            if '\n' in k:
+                shutil.rmtree(tmp_path)
+                raise ValueError('Cannot cache embedding key containing a newline: %r' % k)
+            stream.write('%s\n' % k)
+    np.save(os.path.join(tmp_path, 'matrix.npy'), matrix)
+    np.save(os.path.join(tmp_path, 'norms.npy'), norms)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process finished caching the same file first
+        shutil.rmtree(tmp_path)
+
+def _readEmbeddingCache(cache_path):
+    with open(os.path.join(cache_path, 'vocab.txt'), 'r', encoding='utf-8', newline='\n') as stream:
+        vocab = [line.rstrip('\n') for line in stream]
+    matrix = np.load(os.path.join(cache_path, 'matrix.npy'), mmap_mode='r')
+    norms = np.load(os.path.join(cache_path, 'norms.npy'))
+    if len(vocab) != matrix.shape[0]:
+        raise ValueError('Embedding cache {0} is inconsistent ({1:,} vocabulary'
+            ' entries for {2:,} matrix rows); remove it to rebuild'.format(
+                cache_path, len(vocab), matrix.shape[0]
+            ))
+    return CachedEmbeddings(vocab, matrix, norms)
 
 def writeNodeMap(emb, f):
+    writeKeyNodeMap(emb.keys(), f)
+
+def writeKeyNodeMap(keys, f):
     ordered = tuple([
         k.strip()
-            for k in emb.keys()
+            for k in keys
             if len(k.strip()) > 0
     ])
     node_id = 1  # start from 1 in case 0 is reserved in node2vec
@@ -95,6 +366,36 @@ def writeNeighborFileLine(stream, node_ID, neighbors, with_distances=False):
         ]
     ]))
 
+def writeNeighborFileLines(stream, node_IDs, neighbors, distances=None):
+    '''Write a batch of neighbor file lines at once.
+
+    neighbors is a [batch size x k] array of neighbor IDs for each of
+    node_IDs, and distances (if supplied) a matching array of distances.
+    Negative neighbor IDs are treated as padding and skipped.
+    '''
+    node_IDs = [str(node_ID) for node_ID in node_IDs]
+    neighbors = neighbors.tolist()
+    lines = []
+    if distances is None:
+        for (node_ID, nbrs) in zip(node_IDs, neighbors):
+            lines.append(','.join([
+                node_ID,
+                *[str(d) for d in nbrs if d >= 0]
+            ]))
+    else:
+        distances = distances.tolist()
+        for (node_ID, nbrs, dists) in zip(node_IDs, neighbors, distances):
+            lines.append(','.join([
+                node_ID,
+                *[
+                    '%s||%.6f' % (str(d), dist)
+                        for (d, dist) in zip(nbrs, dists)
+                        if d >= 0
+                ]
+            ]))
+    if len(lines) > 0:
+        stream.write('%s\n' % '\n'.join(lines))
+
 def readNeighborFile(f, k=None, node_map=None, with_distances=False, query_node_map=None):
     '''Read a neighbor file into a dictionary mapping
     { node: [neighbor list] }
@@ -104,39 +405,129 @@ def readNeighborFile(f, k=None, node_map=None, with_distances=False, query_node_
 
     If node_map is supplied (as a dict), maps node IDs
     to labels in node_map.
+
+    Reads either text or binary (BinaryNeighborFile) format.
+    For large files, use NeighborTable.read instead.
     '''
-    neighbors = {}
+    return NeighborTable.read(
+        f,
+        k=k,
+        node_map=node_map,
+        with_distances=with_distances,
+        query_node_map=query_node_map
+    ).toDict()
 
-    if node_map:
-        remap = lambda key: node_map.get(key, key)
-        if query_node_map:
-            query_remap = lambda key: query_node_map.get(key, key)
-        else: query_remap = remap
-    else:
-        remap = lambda key: key
-        query_remap = remap
+class BinaryNeighborFile:
+    '''Fixed-width binary neighbor file, accessed via np.memmap so that
+    any node's neighbors can be looked up without loading the file.
 
-    with codecs.open(f, 'r', 'utf-8') as stream:
-        for line in stream:
-            if line[0] != '#':
-                (node_ID, *neighbor_info_strs) = line.split(',')
-                node_ID = query_remap(int(node_ID))
-                if with_distances:
-                    neighbor_info = []
-                    for nbr_info in neighbor_info_strs:
-                        nbr_ID, dist = nbr_info.split('||')
-                        neighbor_info.append((
-                            remap(int(nbr_ID)), float(dist)
-                        ))
-                else:
-                    neighbor_info = [
-                        remap(int(nbr_ID))
-                            for nbr_ID in neighbor_info
-                   ]
-                if k:
-                    neighbor_info = neighbor_info[:k]
-                neighbors[node_ID] = neighbor_info
-    return neighbors
+    Layout is a 32-byte header, followed by
+      node IDs:      [N] int32
+      neighbor IDs:  [N x k] int32 (-1 for rows not computed yet)
+      distances:     [N x k] float16 or float32 (only if stored)
+    where row i holds the neighbors of node_IDs[i].
+    '''
+    MAGIC = b'NBRB'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQII8x')
+    DISTANCE_DTYPES = {
+        0: None,
+        2: np.float16,
+        4: np.float32,
+    }
+
+    def __init__(self, f, mode='r'):
+        with open(f, 'rb') as stream:
+            (magic, version, num_rows, k, dtype_code) = \
+                BinaryNeighborFile.HEADER.unpack(stream.read(BinaryNeighborFile.HEADER.size))
+        if magic != BinaryNeighborFile.MAGIC:
+            raise ValueError('%s is not a binary neighbor file' % f)
+        if version != BinaryNeighborFile.VERSION:
+            raise ValueError('Binary neighbor file version %d not supported' % version)
+
+        self.k = k
+        distance_dtype = BinaryNeighborFile.DISTANCE_DTYPES[dtype_code]
+        self.with_distances = not (distance_dtype is None)
+
+        offset = BinaryNeighborFile.HEADER.size
+        self.node_IDs = np.memmap(f, dtype=np.int32, mode=mode,
+            offset=offset, shape=(num_rows,))
+        offset += self.node_IDs.nbytes
+        self.neighbors = np.memmap(f, dtype=np.int32, mode=mode,
+            offset=offset, shape=(num_rows, k))
+        offset += self.neighbors.nbytes
+        if self.with_distances:
+            self.distances = np.memmap(f, dtype=distance_dtype, mode=mode,
+                offset=offset, shape=(num_rows, k))
+        else:
+            self.distances = None
+
+        # dense node ID -> row lookup, for O(1) access by node ID
+        self._rows = np.full(int(self.node_IDs.max(initial=0)) + 1, -1, dtype=np.int64)
+        self._rows[self.node_IDs] = np.arange(num_rows)
+
+    @staticmethod
+    def isBinary(f):
+        with open(f, 'rb') as stream:
+            return stream.read(len(BinaryNeighborFile.MAGIC)) == BinaryNeighborFile.MAGIC
+
+    @staticmethod
+    def create(f, node_IDs, k, distance_dtype=None):
+        '''Create a new (empty) binary neighbor file for the rows in
+        node_IDs, and return it opened for writing.
+        '''
+        num_rows = len(node_IDs)
+        dtype_code = 0 if distance_dtype is None else np.dtype(distance_dtype).itemsize
+        row_bytes = 4 * k + dtype_code * k
+        with open(f, 'wb') as stream:
+            stream.write(BinaryNeighborFile.HEADER.pack(
+                BinaryNeighborFile.MAGIC,
+                BinaryNeighborFile.VERSION,
+                num_rows,
+                k,
+                dtype_code
+            ))
+            stream.truncate(BinaryNeighborFile.HEADER.size + (4 * num_rows) + (row_bytes * num_rows))
+
+        offset = BinaryNeighborFile.HEADER.size
+        node_ID_arr = np.memmap(f, dtype=np.int32, mode='r+', offset=offset, shape=(num_rows,))
+        node_ID_arr[:] = node_IDs
+        offset += node_ID_arr.nbytes
+        neighbors = np.memmap(f, dtype=np.int32, mode='r+', offset=offset, shape=(num_rows, k))
+        neighbors[:] = -1
+        node_ID_arr.flush()
+        neighbors.flush()
+        del node_ID_arr, neighbors
+
+        return BinaryNeighborFile(f, mode='r+')
+
+    def row(self, node_ID):
+        '''Returns the row index for node_ID, or -1 if not present'''
+        if node_ID < 0 or node_ID >= len(self._rows):
+            return -1
+        return int(self._rows[node_ID])
+
+    def neighborsOf(self, node_ID, k=None):
+        '''Returns (neighbor IDs, distances) arrays for node_ID, restricted
+        to the first k if supplied (distances is None if not stored)
+        '''
+        row = self.row(node_ID)
+        if row < 0:
+            raise KeyError(node_ID)
+        nbrs = self.neighbors[row, :k]
+        valid = nbrs >= 0
+        dists = None if self.distances is None else self.distances[row, :k][valid]
+        return nbrs[valid], dists
+
+    def writeRows(self, rows, neighbors, distances=None):
+        self.neighbors[rows] = neighbors
+        if not (self.distances is None or distances is None):
+            self.distances[rows] = distances
+
+    def flush(self):
+        self.neighbors.flush()
+        if not (self.distances is None):
+            self.distances.flush()
 
 def readStringMap(f, lower_keys=False):
     _map = {}
@@ -156,9 +547,24 @@ def readSet(f, to_lower=False):
             _set.add(line)
     return _set
 
-def loadPairedNeighbors(src, i, trg, config, k, aggregate=False,
-        with_distances=True, different_types=False, spec='',
-        filter_spec='', query_spec='', vocab_spec=''):
+def readPairs(f):
+    '''Read tab-separated (key1, key2) pairs, one per line; lines starting
+    with # are ignored.
+    '''
+    pairs = []
+    with codecs.open(f, 'r', 'utf-8') as stream:
+        for line in stream:
+            if line[0] == '#' or len(line.strip()) == 0:
+                continue
+            (key1, key2) = [s.strip() for s in line.split('\t')[:2]]
+            pairs.append((key1, key2))
+    return pairs
+
+def _pairedNeighborFiles(src, i, trg, config, aggregate=False,
+        different_types=False, spec='', filter_spec='', query_spec='',
+        vocab_spec=''):
+    '''Returns (neighbor file, node map file, query node map file or None)'''
+    query_vocab = None
     if not aggregate:
         neighbor_file = config['NeighborFilePattern'].format(
             SRC=src, SRC_RUN=i, TRG=trg, SPEC=spec, FILSPEC=filter_spec 
@@ -184,17 +590,336 @@ def loadPairedNeighbors(src, i, trg, config, k, aggregate=False,
                 SRC=src, SRC_RUN=i, TRG=trg, SPEC=spec, FILSPEC=filter_spec
             )
 
+    return neighbor_file, neighbor_vocab, query_vocab
+
+def loadPairedNeighbors(src, i, trg, config, k, aggregate=False,
+        with_distances=True, different_types=False, spec='',
+        filter_spec='', query_spec='', vocab_spec='', vocab=None):
+    '''Load the neighbor file for a source/target pairing as a NeighborTable
+    (using vocab as its SharedVocabulary, if supplied).
+    '''
+    (neighbor_file, neighbor_vocab, query_vocab) = _pairedNeighborFiles(
+        src, i, trg, config, aggregate=aggregate,
+        different_types=different_types, spec=spec, filter_spec=filter_spec,
+        query_spec=query_spec, vocab_spec=vocab_spec
+    )
+
     node_map = readNodeMap(neighbor_vocab)
     if different_types:
         query_node_map = readNodeMap(query_vocab)
     else: query_node_map = None
 
-    neighbors = readNeighborFile(
+    neighbors = NeighborTable.read(
         neighbor_file,
         k=k,
         node_map=node_map,
         with_distances=with_distances,
-        query_node_map=query_node_map
+        query_node_map=query_node_map,
+        vocab=vocab
     )
 
     return neighbors
+
+def loadPairedNeighborArrays(src, i, trg, config, k, vocab, aggregate=False,
+        different_types=False, spec='', filter_spec='', query_spec='',
+        vocab_spec=''):
+    '''Array equivalent of loadPairedNeighbors (without distances).
+
+    Returns (keys, neighbors), where keys is an (N,) array and neighbors an
+    (N, k) array (padded with -1) of IDs in the SharedVocabulary vocab.
+    '''
+    (neighbor_file, neighbor_vocab, query_vocab) = _pairedNeighborFiles(
+        src, i, trg, config, aggregate=aggregate,
+        different_types=different_types, spec=spec, filter_spec=filter_spec,
+        query_spec=query_spec, vocab_spec=vocab_spec
+    )
+
+    node_map = readNodeMap(neighbor_vocab)
+    if different_types:
+        query_node_map = readNodeMap(query_vocab)
+    else: query_node_map = node_map
+
+    (node_IDs, neighbor_IDs) = readNeighborArrays(neighbor_file, k=k)
+    keys = vocab.lookup(node_IDs, query_node_map)
+    neighbors = vocab.lookup(neighbor_IDs, node_map)
+    return keys, neighbors
+
+class NeighborArrayCache:
+    '''LRU cache of neighbor arrays from loadPairedNeighborArrays, keyed on
+    the paths and modification times of the neighbor and node map files.
+
+    Arrays are cached with all neighbors listed in the file, so the same
+    entry is used for any k.  All arrays share the cache's vocab.
+    '''
+
+    def __init__(self, max_size=40):
+        self.vocab = SharedVocabulary()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def loadPairedNeighborArrays(self, src, i, trg, config, k, **kwargs):
+        files = _pairedNeighborFiles(src, i, trg, config, **kwargs)
+        cache_key = tuple([
+            (f, os.path.getmtime(f))
+                for f in files
+                if not (f is None)
+        ])
+
+        if cache_key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(cache_key)
+            (keys, neighbors) = self._cache[cache_key]
+        else:
+            self.misses += 1
+            (keys, neighbors) = loadPairedNeighborArrays(src, i, trg, config,
+                None, self.vocab, **kwargs)
+            self._cache[cache_key] = (keys, neighbors)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        return keys, neighbors[:, :k]
+
+def readNeighborArrays(f, k=None):
+    '''Read the node IDs in a neighbor file, without remapping.
+
+    Returns (node_IDs, neighbors), where node_IDs is an (N,) int32 array and
+    neighbors is an (N, k) int32 array of the first k neighbors of each
+    node, padded with -1.  Reads either text or binary format.
+    '''
+    (node_IDs, neighbors, _) = _readNeighborArrays(f, k=k, with_distances=False)
+    return node_IDs, neighbors
+
+def _readNeighborArrays(f, k=None, with_distances=False):
+    '''As readNeighborArrays, but also returns an (N, k) float32 array of
+    distances (NaN for padding) if with_distances, otherwise None.
+    '''
+    if BinaryNeighborFile.isBinary(f):
+        nbr_file = BinaryNeighborFile(f)
+        if with_distances and not nbr_file.with_distances:
+            raise ValueError('Neighbor file {0} does not include distances'.format(f))
+        computed = nbr_file.neighbors[:, 0] >= 0  # skip rows not computed
+        neighbors = np.array(nbr_file.neighbors[computed, :k])
+        distances = None
+        if with_distances:
+            distances = np.array(nbr_file.distances[computed, :k], dtype=np.float32)
+            distances[neighbors < 0] = np.nan
+        return np.array(nbr_file.node_IDs[computed]), neighbors, distances
+
+    # neighbors are read into flat typed arrays and padded afterwards, to
+    # avoid holding Python objects for every neighbor
+    node_IDs = array.array('i')
+    row_lengths = array.array('i')
+    flat_neighbors = array.array('i')
+    flat_distances = array.array('f')
+    with codecs.open(f, 'r', 'utf-8') as stream:
+        for line in stream:
+            if line[0] != '#':
+                (node_ID, *neighbor_info_strs) = line.split(',')
+                if k:
+                    neighbor_info_strs = neighbor_info_strs[:k]
+                node_IDs.append(int(node_ID))
+                row_lengths.append(len(neighbor_info_strs))
+                for nbr_info in neighbor_info_strs:
+                    if with_distances:
+                        if not '||' in nbr_info:
+                            raise ValueError('Neighbor file {0} does not include distances'.format(f))
+                        (nbr_ID, dist) = nbr_info.split('||')
+                        flat_distances.append(float(dist))
+                    else:
+                        nbr_ID = nbr_info.split('||')[0]
+                    flat_neighbors.append(int(nbr_ID))
+
+    row_lengths = np.frombuffer(row_lengths, dtype=np.int32)
+    width = int(row_lengths.max(initial=0))
+    rows = np.repeat(np.arange(len(row_lengths)), row_lengths)
+    row_starts = np.cumsum(row_lengths) - row_lengths
+    cols = np.arange(len(rows)) - np.repeat(row_starts, row_lengths)
+
+    neighbors = np.full((len(row_lengths), width), -1, dtype=np.int32)
+    neighbors[rows, cols] = np.frombuffer(flat_neighbors, dtype=np.int32)
+    distances = None
+    if with_distances:
+        distances = np.full((len(row_lengths), width), np.nan, dtype=np.float32)
+        distances[rows, cols] = np.frombuffer(flat_distances, dtype=np.float32)
+    return np.array(node_IDs, dtype=np.int32), neighbors, distances
+
+class NeighborTable:
+    '''Array-backed neighbor set, holding
+      keys:       [N] int32 IDs in vocab
+      neighbors:  [N x k] int32 IDs in vocab (-1 for padding)
+      distances:  [N x k] float32 (NaN for padding), or None
+    where vocab is a SharedVocabulary, which may be shared between tables.
+
+    Keys are only decoded to strings on access; the dictionary-style
+    methods return the same values as the dict from readNeighborFile.
+    '''
+
+    def __init__(self, keys, neighbors, vocab, distances=None):
+        # as in a dict, a repeated key keeps its first position and
+        # its last neighbor list
+        (_, first) = np.unique(keys, return_index=True)
+        if len(first) < len(keys):
+            (_, last) = np.unique(keys[::-1], return_index=True)
+            rows = (len(keys) - 1 - last)[np.argsort(first)]
+            keys, neighbors = keys[rows], neighbors[rows]
+            if not (distances is None):
+                distances = distances[rows]
+
+        self.keys_array = keys
+        self.neighbors = neighbors
+        self.distances = distances
+        self.vocab = vocab
+        self._rows = None
+
+    @staticmethod
+    def read(f, k=None, node_map=None, with_distances=False, query_node_map=None,
+            vocab=None):
+        '''Read a neighbor file (text or binary) into a NeighborTable;
+        arguments are as for readNeighborFile.  A new SharedVocabulary is
+        used unless one is supplied.
+        '''
+        if vocab is None:
+            vocab = SharedVocabulary()
+        if not query_node_map:
+            query_node_map = node_map
+        (node_IDs, neighbor_IDs, distances) = _readNeighborArrays(
+            f, k=k, with_distances=with_distances
+        )
+        return NeighborTable(
+            vocab.lookup(node_IDs, query_node_map),
+            vocab.lookup(neighbor_IDs, node_map),
+            vocab,
+            distances=distances
+        )
+
+    def _row(self, key):
+        if self._rows is None:
+            self._rows = {
+                ID: row
+                    for (row, ID) in enumerate(self.keys_array.tolist())
+            }
+        return self._rows.get(self.vocab.find(key), None)
+
+    def _decodeRow(self, row):
+        nbr_IDs = self.neighbors[row]
+        valid = nbr_IDs >= 0
+        nbr_keys = [self.vocab.keys[ID] for ID in nbr_IDs[valid].tolist()]
+        if self.distances is None:
+            return nbr_keys
+        # shortest float32 representation recovers the distance as written
+        dists = [float(d) for d in self.distances[row][valid].astype(str)]
+        return list(zip(nbr_keys, dists))
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def __contains__(self, key):
+        return not (self._row(key) is None)
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        if row is None:
+            raise KeyError(key)
+        return self._decodeRow(row)
+
+    def get(self, key, default=None):
+        row = self._row(key)
+        if row is None:
+            return default
+        return self._decodeRow(row)
+
+    def keys(self):
+        return [self.vocab.keys[ID] for ID in self.keys_array.tolist()]
+
+    def items(self):
+        for row in range(len(self.keys_array)):
+            yield (self.vocab.keys[int(self.keys_array[row])], self._decodeRow(row))
+
+    def toDict(self):
+        return dict(self.items())
+
+class SharedVocabulary:
+    '''Assigns consecutive integer IDs to keys, so that neighbor arrays read
+    from files with different node maps can be compared directly.
+
+    Keys are node map strings, or the node ID itself for IDs missing from
+    the node map (as in readNeighborFile).
+    '''
+
+    def __init__(self):
+        self.keys = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, key):
+        '''Returns the ID of key, or None if it has not been assigned one'''
+        return self._index.get(key, None)
+
+    def ID(self, key):
+        ID = self._index.get(key, None)
+        if ID is None:
+            ID = len(self.keys)
+            self._index[key] = ID
+            self.keys.append(key)
+        return ID
+
+    def lookup(self, node_IDs, node_map=None):
+        '''Map an array of node IDs (negative for padding) to shared IDs'''
+        node_IDs = np.asarray(node_IDs)
+        unique_IDs = np.unique(node_IDs[node_IDs >= 0])
+        table = np.full(int(unique_IDs.max(initial=-1)) + 1, -1, dtype=np.int32)
+        for node_ID in unique_IDs.tolist():
+            key = node_map.get(node_ID, node_ID) if node_map else node_ID
+            table[node_ID] = self.ID(key)
+        shared = np.full(node_IDs.shape, -1, dtype=np.int32)
+        valid = node_IDs >= 0
+        shared[valid] = table[node_IDs[valid]]
+        return shared
+
+class SharedMatrices:
+    '''Copies a set of matrices (as float32, unless dtype is given) once
+    into shared memory, so that worker processes can attach to them
+    (without copying) using attachSharedMatrices(shared.descriptors).
+
+    The owning process must call release() once all workers are done.
+    '''
+
+    def __init__(self, arrays, unit_norm=False, dtype=np.float32):
+        self._blocks = []
+        self.descriptors = []
+        for array in arrays:
+            if unit_norm:
+                array = np.asarray(array, dtype=np.float32)
+                array = array / np.linalg.norm(array, axis=1, keepdims=True)
+            else:
+                array = np.ascontiguousarray(array, dtype=dtype)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared_array[:] = array
+            del shared_array
+            self._blocks.append(block)
+            self.descriptors.append((block.name, array.shape, array.dtype.str))
+
+    def release(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+def attachSharedMatrices(descriptors):
+    '''Attaches to matrices created by SharedMatrices.
+
+    Returns (blocks, arrays); blocks must stay referenced for as long
+    as arrays are in use.
+    '''
+    blocks, arrays = [], []
+    for (name, shape, dtype) in descriptors:
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    return blocks, arrays
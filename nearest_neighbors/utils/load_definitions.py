@@ -75,4 +75,8 @@ if __name__ == '__main__':
     )
     log.writeln('Done.')
 
+    ## mark the DB as changed (once for the whole run), invalidating
+    ## cached dashboard responses
+    db.bumpGeneration()
+
     log.stop()
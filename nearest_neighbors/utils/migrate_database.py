@@ -0,0 +1,74 @@
+'''
+Brings an existing neighborhood database up to the current schema
+(secondary indexes, term search index), rebuilds the term search index,
+refreshes the query planner statistics, and checks that the dashboard's
+queries use their expected indexes.
+'''
+
+import sys
+import configparser
+from hedgepig_logger import log
+from ..database import EmbeddingNeighborhoodDatabase
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog')
+        parser.add_option('-c', '--config', dest='configf',
+            default='config.ini')
+        parser.add_option('--min-rows', dest='min_rows',
+            type='int', default=1000,
+            help='tables smaller than this may be scanned instead of using an'
+                 ' index without failing the query plan check (default: %default)')
+        parser.add_option('-l', '--logfile', dest='logfile',
+            help='name of file to write log contents to (empty for stdout)',
+            default=None)
+        (options, args) = parser.parse_args()
+        return options
+
+    options = _cli()
+    log.start(options.logfile)
+    log.writeConfig([
+        ('Configuration file', options.configf),
+        ('Minimum rows for index check', options.min_rows),
+    ], 'Migrating neighborhood DB schema')
+
+    log.writeln('Reading configuration file from %s...' % options.configf)
+    config = configparser.ConfigParser()
+    config.read(options.configf)
+    config = config['PairedNeighborhoodAnalysis']
+    log.writeln('Done.\n')
+
+    log.writeln('Loading embedding neighborhood database...')
+    db = EmbeddingNeighborhoodDatabase(config['DatabaseFile'])
+    log.writeln('Database ready (schema version {0}).\n'.format(
+        EmbeddingNeighborhoodDatabase.SCHEMA_VERSION
+    ))
+
+    log.writeln('Rebuilding term search index...')
+    db.rebuildSearchIndex()
+    log.writeln('Done.\n')
+
+    log.writeln('Analyzing tables...')
+    db.analyze()
+    log.writeln('Done.\n')
+
+    log.writeln('Checking query plans for dashboard queries...')
+    (errors, warnings) = db.checkQueryPlans(min_rows=options.min_rows)
+    for (label, results) in (('MISSING INDEX', errors), ('SMALL TABLE', warnings)):
+        for (method, index, plan) in results:
+            log.writeln('  [{0}] {1} does not use {2}: {3}'.format(
+                label, method, index, '; '.join(plan)
+            ))
+    log.writeln('Checked {0:,} queries, found {1:,} missing indexes ({2:,} more on tables under {3:,} rows).\n'.format(
+        len(EmbeddingNeighborhoodDatabase.DASHBOARD_QUERIES),
+        len(errors),
+        len(warnings),
+        options.min_rows
+    ))
+    db.close()
+
+    log.stop()
+
+    if len(errors) > 0:
+        sys.exit(1)
@@ -0,0 +1,273 @@
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from nearest_neighbors.database import EmbeddingNeighborhoodDatabase
+from nearest_neighbors.data_models import AggregateNearestNeighbor, EntityTerm
+
+class AggregateNearestNeighborsConflictTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbf = os.path.join(self.tmpdir, 'test.db')
+        self.db = EmbeddingNeighborhoodDatabase(self.dbf)
+        self.db.insertOrUpdate([
+            AggregateNearestNeighbor('s', 's', 'f', 'a', 'b', 0.5),
+            AggregateNearestNeighbor('s', 's', 'f', 'a', 'c', 0.7),
+        ])
+        # one conflicting neighbor, one new neighbor, for a new target
+        self.update = [
+            AggregateNearestNeighbor('s', 't', 'f', 'a', 'b', 0.9),
+            AggregateNearestNeighbor('s', 't', 'f', 'a', 'd', 0.8),
+        ]
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _saved(self):
+        '''Returns ({neighbor key: distance}, set of (target, neighbor key)
+        links), as read through a separate connection.
+        '''
+        connection = sqlite3.connect(self.dbf)
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT NeighborKey, MeanDistance FROM AggregateNearestNeighbors')
+            distances = dict(cursor.fetchall())
+            cursor.execute('''
+            SELECT s.Target, a.NeighborKey
+            FROM AggregateNearestNeighborSubsets AS s
+                INNER JOIN AggregateNearestNeighbors AS a ON a.ID=s.NeighborID
+            ''')
+            links = set(cursor.fetchall())
+        finally:
+            connection.close()
+        return distances, links
+
+    def testWarn(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            conflicts = self.db.insertOrUpdate(self.update, on_conflict='warn')
+        self.assertEqual(conflicts, [('s', 'a', 'b', 0.5, 0.9)])
+        self.assertIn('[WARNING] 1 conflicts', output.getvalue())
+
+        (distances, links) = self._saved()
+        self.assertEqual(distances, {'b': 0.5, 'c': 0.7, 'd': 0.8})
+        self.assertEqual(links, {('s', 'b'), ('s', 'c'), ('t', 'b'), ('t', 'd')})
+
+    def testReplace(self):
+        conflicts = self.db.insertOrUpdate(self.update, on_conflict='replace')
+        self.assertEqual(conflicts, [('s', 'a', 'b', 0.5, 0.9)])
+
+        (distances, links) = self._saved()
+        self.assertEqual(distances, {'b': 0.9, 'c': 0.7, 'd': 0.8})
+        self.assertEqual(links, {('s', 'b'), ('s', 'c'), ('t', 'b'), ('t', 'd')})
+
+    def testAbort(self):
+        with self.assertRaises(ValueError):
+            self.db.insertOrUpdate(self.update, on_conflict='abort')
+
+        # nothing from the aborted load is kept
+        (distances, links) = self._saved()
+        self.assertEqual(distances, {'b': 0.5, 'c': 0.7})
+        self.assertEqual(links, {('s', 'b'), ('s', 'c')})
+
+        # and the connection is still usable
+        self.assertEqual(self.db.insertOrUpdate(self.update[1:], on_conflict='abort'), [])
+        (distances, links) = self._saved()
+        self.assertEqual(distances, {'b': 0.5, 'c': 0.7, 'd': 0.8})
+
+    def testNoConflicts(self):
+        conflicts = self.db.insertOrUpdate([
+            AggregateNearestNeighbor('s', 't', 'f', 'a', 'b', 0.5004),
+        ], on_conflict='abort')
+        self.assertEqual(conflicts, [])
+        (distances, links) = self._saved()
+        self.assertEqual(distances, {'b': 0.5, 'c': 0.7})
+        self.assertIn(('t', 'b'), links)
+
+    def testUnknownPolicy(self):
+        with self.assertRaises(ValueError):
+            self.db.insertOrUpdate(self.update, on_conflict='ignore')
+
+class EntityTermsSearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbf = os.path.join(self.tmpdir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _search(self, db, query_string):
+        return sorted(
+            (et.entity_key, et.term, et.preferred)
+                for et in db.searchInEntityTerms(query_string)
+        )
+
+    def _assertIndexConsistent(self, db):
+        # the external content index agrees with EntityTerms
+        db._cursor.execute("INSERT INTO EntityTermsSearch(EntityTermsSearch, rank) VALUES ('integrity-check', 1)")
+
+    def testInsertUpdateDelete(self):
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        try:
+            db.insertOrUpdate([
+                EntityTerm('C01', 'heart attack', 0),
+                EntityTerm('C01', 'myocardial infarction', 1),
+                EntityTerm('C02', 'heart failure', 1),
+            ])
+            self.assertEqual(self._search(db, 'heart'), [
+                ('C01', 'heart attack', 0),
+                ('C02', 'heart failure', 1),
+            ])
+            self._assertIndexConsistent(db)
+
+            # updating a term replaces its indexed copy
+            db.insertOrUpdate([
+                EntityTerm('C01', 'heart attack', 1),
+                EntityTerm('C02', 'cardiac failure', 0),
+            ])
+            self.assertEqual(self._search(db, 'heart'), [
+                ('C01', 'heart attack', 1),
+                ('C02', 'heart failure', 1),
+            ])
+            self.assertEqual(self._search(db, 'cardiac'), [
+                ('C02', 'cardiac failure', 0),
+            ])
+            self._assertIndexConsistent(db)
+
+            db.deleteFromEntityTerms('C01', term='heart attack')
+            self.assertEqual(self._search(db, 'heart'), [
+                ('C02', 'heart failure', 1),
+            ])
+            self.assertEqual(self._search(db, 'C01'), [
+                ('C01', 'myocardial infarction', 1),
+            ])
+            db.deleteFromEntityTerms('C02')
+            self.assertEqual(self._search(db, 'failure'), [])
+            self._assertIndexConsistent(db)
+        finally:
+            db.close()
+
+    def testMigratedBaselineDatabase(self):
+        # EntityTerms as created before it had an ID column or search index
+        connection = sqlite3.connect(self.dbf)
+        connection.execute('''
+        CREATE TABLE EntityTerms
+        (
+            EntityKey text,
+            Term text,
+            Preferred int,
+            UNIQUE(EntityKey, Term)
+        )
+        ''')
+        connection.executemany('INSERT INTO EntityTerms VALUES (?, ?, ?)', [
+            ('C01', 'heart attack', 0),
+            ('C02', 'heart failure', 1),
+        ])
+        connection.execute('DELETE FROM EntityTerms WHERE EntityKey=?', ('C01',))
+        connection.execute('INSERT INTO EntityTerms VALUES (?, ?, ?)', ('C03', 'heart murmur', 1))
+        connection.commit()
+        connection.close()
+
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        try:
+            self.assertEqual(self._search(db, 'heart'), [
+                ('C02', 'heart failure', 1),
+                ('C03', 'heart murmur', 1),
+            ])
+            self._assertIndexConsistent(db)
+
+            db.insertOrUpdate([EntityTerm('C02', 'heart failure', 0)])
+            db.deleteFromEntityTerms('C03')
+            self.assertEqual(self._search(db, 'heart'), [
+                ('C02', 'heart failure', 0),
+            ])
+            self._assertIndexConsistent(db)
+        finally:
+            db.close()
+
+        # and the migration is not repeated on reopening
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        try:
+            self.assertEqual(self._search(db, 'heart'), [
+                ('C02', 'heart failure', 0),
+            ])
+        finally:
+            db.close()
+
+class QueryPlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = EmbeddingNeighborhoodDatabase(os.path.join(self.tmpdir, 'test.db'))
+        self.db.insertOrUpdate([EntityTerm('key', 'term', 1)])
+        self.db.insertOrUpdate([AggregateNearestNeighbor('src', 'src', 'filter', 'key', 'nbr', 0.5)])
+        self.db.analyze()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testSmallTablesOnlyWarn(self):
+        (errors, warnings) = self.db.checkQueryPlans()
+        self.assertEqual(errors, [])
+        # scans of tiny tables are reported, but only as warnings
+        (errors, _) = self.db.checkQueryPlans(min_rows=1)
+        self.assertEqual(
+            sorted((method, index) for (method, index, _) in errors),
+            sorted((method, index) for (method, index, _) in warnings)
+        )
+
+    def testMissingIndex(self):
+        self.db._cursor.execute('DROP INDEX InternalConfidenceByKey')
+        (errors, _) = self.db.checkQueryPlans()
+        self.assertEqual(
+            [(method, index) for (method, index, _) in errors],
+            [('selectFromInternalConfidenceForKey', 'InternalConfidenceByKey')]
+        )
+
+class DatabaseGenerationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbf = os.path.join(self.tmpdir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testBumpGeneration(self):
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        try:
+            generation = db.getGeneration()
+            self.assertNotEqual(generation, '')
+            db.bumpGeneration()
+            self.assertGreater(db.getGeneration(), generation)
+        finally:
+            db.close()
+
+    def testIntDeclaredGenerationMigrated(self):
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        db.close()
+        connection = sqlite3.connect(self.dbf)
+        connection.execute('DROP TABLE DatabaseGeneration')
+        connection.execute('CREATE TABLE DatabaseGeneration (Generation int)')
+        connection.execute('INSERT INTO DatabaseGeneration VALUES (?)', ('0123456789abcdef-' + ('0' * 32),))
+        connection.execute('PRAGMA user_version = 4')
+        connection.commit()
+        connection.close()
+
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        try:
+            self.assertEqual(db.getGeneration(), '0123456789abcdef-' + ('0' * 32))
+            db._cursor.execute('PRAGMA table_info(DatabaseGeneration)')
+            self.assertEqual([row[2].lower() for row in db._cursor.fetchall()], ['text'])
+        finally:
+            db.close()
+
+if __name__ == '__main__':
+    unittest.main()
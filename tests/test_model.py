@@ -0,0 +1,113 @@
+import unittest
+import numpy as np
+from nearest_neighbors.calculation import model
+
+def _signedBasisRows(rs, vocab_size, dim):
+    '''Rows that are each +/- a standard basis vector, so all similarities
+    (and averaged distances) are exact, and many of them tie.
+    '''
+    rows = np.zeros((vocab_size, dim), dtype=np.float32)
+    rows[np.arange(vocab_size), rs.randint(dim, size=vocab_size)] = rs.choice([-1, 1], size=vocab_size)
+    return rows
+
+def _bruteForce(emb_arrs, query, top_k):
+    '''Neighbors of row query by a stable full sort of averaged distances,
+    dropping the query itself if it sorts first.
+    '''
+    distances = np.mean([
+        1 - np.matmul(emb_arr, emb_arr[query])
+            for emb_arr in emb_arrs
+    ], axis=0)
+    order = np.argsort(distances, kind='stable')
+    if order[0] == query:
+        order = order[1:]
+    if not (top_k is None):
+        order = order[:top_k]
+    return order, distances[order]
+
+class NearestNeighborsTiesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.vocab_size = 14
+        self.emb_arrs = [_signedBasisRows(rs, self.vocab_size, 3) for _ in range(2)]
+        fused = model.fuseEmbeddings(self.emb_arrs)
+        index = model.IVFIndex.build(fused, 4, block_size=4)
+        self.engines = [
+            model.MultiNearestNeighbors(self.emb_arrs, block_size=4),
+            model.FusedMultiNearestNeighbors(fused, 2, block_size=4),
+            model.IVFMultiNearestNeighbors(fused, 2, index,
+                num_probes=index.num_lists, block_size=4),
+        ]
+        self.batch = list(range(self.vocab_size))
+
+    def testNearestNeighborsMatchStableSort(self):
+        for engine in self.engines:
+            for top_k in (1, 5, None):
+                results = engine.nearestNeighbors(self.batch, top_k=top_k, with_distances=True)
+                for query in self.batch:
+                    (expected, expected_distances) = _bruteForce(self.emb_arrs, query, top_k)
+                    self.assertEqual([n for (n, _) in results[query]], expected.tolist())
+                    self.assertEqual([d for (_, d) in results[query]], expected_distances.tolist())
+
+    def testNearestNeighborArraysMatchStableSort(self):
+        for engine in self.engines:
+            for top_k in (1, 5):
+                (neighbors, distances) = engine.nearestNeighborArrays(self.batch, top_k)
+                self.assertEqual(neighbors.shape, (self.vocab_size, top_k))
+                for query in self.batch:
+                    (expected, expected_distances) = _bruteForce(self.emb_arrs, query, top_k)
+                    self.assertEqual(neighbors[query].tolist(), expected.tolist())
+                    self.assertEqual(distances[query].tolist(), expected_distances.tolist())
+
+    def testPaddingPastVocabulary(self):
+        top_k = self.vocab_size + 2
+        for engine in self.engines:
+            (neighbors, distances) = engine.nearestNeighborArrays(self.batch, top_k)
+            self.assertEqual(neighbors.shape, (self.vocab_size, top_k))
+            results = engine.nearestNeighbors(self.batch, top_k=top_k)
+            for query in self.batch:
+                (expected, expected_distances) = _bruteForce(self.emb_arrs, query, None)
+                num_found = len(expected)
+                self.assertEqual(neighbors[query, :num_found].tolist(), expected.tolist())
+                self.assertEqual(distances[query, :num_found].tolist(), expected_distances.tolist())
+                self.assertTrue(np.all(neighbors[query, num_found:] == -1))
+                self.assertTrue(np.all(np.isnan(distances[query, num_found:])))
+                # list results carry no padding
+                self.assertEqual(list(results[query]), expected.tolist())
+
+class FusedAndApproximateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(1)
+        self.emb_arrs = [rs.randn(200, 16).astype(np.float32) for _ in range(3)]
+        self.queries = [rs.randn(10, 16).astype(np.float32) for _ in range(3)]
+        self.fused = model.fuseEmbeddings(self.emb_arrs)
+        self.exact = model.MultiNearestNeighbors(self.emb_arrs, block_size=64)
+        self.batch = list(range(0, 200, 7))
+
+    def _assertSameNeighbors(self, engine, reference):
+        for (batch_input, indices, no_self) in ((self.batch, True, True), (self.queries, False, False)):
+            (neighbors, distances) = engine.nearestNeighborArrays(batch_input, 10,
+                indices=indices, no_self=no_self)
+            (expected, expected_distances) = reference.nearestNeighborArrays(batch_input, 10,
+                indices=indices, no_self=no_self)
+            np.testing.assert_array_equal(neighbors, expected)
+            np.testing.assert_allclose(distances, expected_distances, atol=1e-5)
+
+    def testFusedMatchesExact(self):
+        fused = model.FusedMultiNearestNeighbors(self.fused, 3, block_size=64)
+        self._assertSameNeighbors(fused, self.exact)
+
+    def testIVFAllListsProbedMatchesExact(self):
+        index = model.IVFIndex.build(self.fused, 8, block_size=64)
+        ivf = model.IVFMultiNearestNeighbors(self.fused, 3, index,
+            num_probes=index.num_lists, block_size=64)
+        self._assertSameNeighbors(ivf, self.exact)
+        self.assertEqual(model.recallAtK(
+            ivf.nearestNeighborArrays(self.batch, 10)[0],
+            self.exact.nearestNeighborArrays(self.batch, 10)[0]
+        ), 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from nearest_neighbors import nn_io
+from nearest_neighbors.analysis.neighborhood_chronology import analyzeChronology
+
+class _RecordingDatabase:
+    def __init__(self):
+        self.rows = []
+
+    def insertOrUpdate(self, rows):
+        self.rows.extend(rows)
+
+class AnalyzeChronologyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {
+            'NeighborFilePattern': os.path.join(self.tmpdir, '{SRC}.r{SRC_RUN}.{TRG}.neighbors'),
+            'NeighborVocabFilePattern': os.path.join(self.tmpdir, '{SRC}.r{SRC_RUN}.{TRG}.vocab'),
+        }
+        self.corpora = ['c1', 'c2', 'c3']
+
+        keys = ['k%d' % i for i in range(12)]
+        rs = np.random.RandomState(0)
+        for i in range(len(self.corpora)):
+            pairs = [(self.corpora[i], self.corpora[i])]
+            if i > 0:
+                pairs.append((self.corpora[i-1], self.corpora[i]))
+                pairs.append((self.corpora[i], self.corpora[i-1]))
+            for (src, trg) in pairs:
+                for run in range(1, 11):
+                    fmt = dict(SRC=src, SRC_RUN=run, TRG=trg)
+                    nn_io.writeKeyNodeMap(keys, self.config['NeighborVocabFilePattern'].format(**fmt))
+                    with open(self.config['NeighborFilePattern'].format(**fmt), 'w') as stream:
+                        stream.write('# File format is:\n# <word vocab index>,<NN 1>,<NN 2>,...\n')
+                        for node_ID in range(1, len(keys)+1):
+                            neighbors = rs.choice(len(keys), 10, replace=False) + 1
+                            stream.write('%s\n' % ','.join([str(node_ID)] + [str(n) for n in neighbors]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testNeighborFilesReusedAcrossK(self):
+        db = _RecordingDatabase()
+        cache = nn_io.NeighborArrayCache(max_size=30)
+        analyzeChronology(self.corpora, self.config, db, ks=(5, 10),
+            neighbor_cache=cache)
+
+        # 10 self-paired files per corpus, plus 20 cross-paired files per
+        # consecutive pair, each read once and reused for the second k
+        num_files = (10 * len(self.corpora)) + (20 * (len(self.corpora) - 1))
+        self.assertEqual(cache.misses, num_files)
+        self.assertEqual(cache.hits, num_files)
+        self.assertGreater(len(db.rows), 0)
+
+if __name__ == '__main__':
+    unittest.main()
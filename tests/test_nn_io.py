@@ -0,0 +1,181 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pyemblib
+from nearest_neighbors import nn_io
+
+def _writeEmbeddings(f, vocab, matrix):
+    with open(f, 'w') as stream:
+        stream.write('%d %d\n' % matrix.shape)
+        for (key, row) in zip(vocab, matrix):
+            stream.write('%s %s\n' % (key, ' '.join('%.6f' % v for v in row)))
+
+class EmbeddingReplicatesStackedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.config = {
+            'ReplicateTemplate': os.path.join(self.tmpdir, 'emb.{REPL}.txt'),
+            'EmbeddingFormat': pyemblib.Mode.Text,
+        }
+        rs = np.random.RandomState(0)
+        self.vocab = ['k%d' % i for i in range(6)]
+        self.matrices = [
+            rs.randn(len(self.vocab), 4).round(4).astype(np.float32)
+                for _ in range(3)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _writeReplicates(self, vocabs):
+        for i in range(len(vocabs)):
+            _writeEmbeddings(self.config['ReplicateTemplate'].format(REPL=i+1),
+                vocabs[i], self.matrices[i])
+
+    def testStacked(self):
+        self._writeReplicates([self.vocab] * 3)
+        for cache_dir in (None, self.cache_dir, self.cache_dir):
+            replicates = nn_io.EmbeddingReplicates('src', self.config, cache_dir=cache_dir)
+            (vocab, matrix) = replicates.stacked()
+            self.assertEqual(list(vocab), self.vocab)
+            self.assertEqual(matrix.shape, (3, len(self.vocab), 4))
+            np.testing.assert_allclose(matrix, np.stack(self.matrices), atol=1e-6)
+
+    def testStackedOverMemoryBudget(self):
+        self._writeReplicates([self.vocab] * 3)
+        replicates = nn_io.EmbeddingReplicates('src', self.config, memory_budget=16)
+        self.assertIsNone(replicates.stacked())
+
+    def testStackedMismatchedVocabularies(self):
+        self._writeReplicates([self.vocab, self.vocab, self.vocab[::-1]])
+        for cache_dir in (None, self.cache_dir):
+            replicates = nn_io.EmbeddingReplicates('src', self.config, cache_dir=cache_dir)
+            with self.assertRaises(ValueError):
+                replicates.stacked()
+        # no partial stack is left in the cache
+        self.assertEqual(glob.glob(os.path.join(self.cache_dir, '*.npy')), [])
+
+class EmbeddingCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.embf = os.path.join(self.tmpdir, 'emb.txt')
+        self.vocab = ['k%d' % i for i in range(5)]
+        self.matrix = np.random.RandomState(0).randn(5, 4).round(4).astype(np.float32)
+        _writeEmbeddings(self.embf, self.vocab, self.matrix)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _assertSameEmbeddings(self, cached, fresh):
+        (cached_vocab, cached_matrix) = nn_io.embeddingMatrix(cached)
+        (fresh_vocab, fresh_matrix) = nn_io.embeddingMatrix(fresh)
+        self.assertEqual(list(cached_vocab), fresh_vocab)
+        np.testing.assert_array_equal(cached_matrix, fresh_matrix)
+
+    def testCacheHit(self):
+        fresh = nn_io.readEmbeddings(self.embf, pyemblib.Mode.Text)
+        cached = nn_io.readEmbeddings(self.embf, pyemblib.Mode.Text, cache_dir=self.cache_dir)
+        self.assertIsInstance(cached, nn_io.CachedEmbeddings)
+        self._assertSameEmbeddings(cached, fresh)
+
+        # a second read comes from the cache, without parsing the file
+        with mock.patch.object(nn_io.pyemblib, 'read', side_effect=AssertionError):
+            cached = nn_io.readEmbeddings(self.embf, pyemblib.Mode.Text, cache_dir=self.cache_dir)
+        self._assertSameEmbeddings(cached, fresh)
+        np.testing.assert_allclose(cached.norms, np.linalg.norm(nn_io.embeddingMatrix(fresh)[1], axis=1), rtol=1e-6)
+
+    def testChangedFileInvalidatesCache(self):
+        nn_io.readEmbeddings(self.embf, pyemblib.Mode.Text, cache_dir=self.cache_dir)
+
+        # same size and vocabulary, new values and modification time
+        self.matrix = self.matrix[::-1].copy()
+        _writeEmbeddings(self.embf, self.vocab, self.matrix)
+        stat = os.stat(self.embf)
+        os.utime(self.embf, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        cached = nn_io.readEmbeddings(self.embf, pyemblib.Mode.Text, cache_dir=self.cache_dir)
+        fresh = nn_io.readEmbeddings(self.embf, pyemblib.Mode.Text)
+        self._assertSameEmbeddings(cached, fresh)
+        np.testing.assert_allclose(cached.matrix, self.matrix, atol=1e-6)
+
+class BinaryNeighborFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.node_IDs = [5, 2, 9, 7]
+        # rows written out of order, with padding; row 3 is never computed
+        self.rows = [2, 0, 1]
+        self.neighbors = np.array([[5, 2, -1], [2, 9, 7], [9, 5, 7]], dtype=np.int32)
+        self.distances = np.array([[0.125, 0.5, np.nan], [0.25, 0.375, 1.5], [0.0625, 0.75, 1.0]],
+            dtype=np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _writeBinary(self, distance_dtype):
+        f = os.path.join(self.tmpdir, 'neighbors.bin')
+        nbr_file = nn_io.BinaryNeighborFile.create(f, self.node_IDs, 3,
+            distance_dtype=distance_dtype)
+        nbr_file.writeRows(self.rows, self.neighbors, self.distances)
+        nbr_file.flush()
+        nbr_file = None
+        return f
+
+    def _writeText(self, with_distances):
+        f = os.path.join(self.tmpdir, 'neighbors.csv')
+        order = np.argsort(self.rows)
+        with open(f, 'w') as stream:
+            nn_io.writeNeighborFileLines(
+                stream,
+                np.array(self.node_IDs)[np.array(self.rows)[order]],
+                self.neighbors[order],
+                distances=(self.distances[order] if with_distances else None)
+            )
+        return f
+
+    def testRoundTrip(self):
+        for distance_dtype in (None, np.float16, np.float32):
+            with_distances = not (distance_dtype is None)
+            f = self._writeBinary(distance_dtype)
+            self.assertTrue(nn_io.BinaryNeighborFile.isBinary(f))
+
+            nbr_file = nn_io.BinaryNeighborFile(f)
+            self.assertEqual(nbr_file.k, 3)
+            self.assertEqual(nbr_file.with_distances, with_distances)
+            for (row, neighbors, distances) in zip(self.rows, self.neighbors, self.distances):
+                (nbrs, dists) = nbr_file.neighborsOf(self.node_IDs[row])
+                self.assertEqual(nbrs.tolist(), neighbors[neighbors >= 0].tolist())
+                if with_distances:
+                    np.testing.assert_array_equal(dists,
+                        distances[neighbors >= 0].astype(distance_dtype))
+                else:
+                    self.assertIsNone(dists)
+            self.assertEqual(nbr_file.neighborsOf(7)[0].tolist(), [])
+            with self.assertRaises(KeyError):
+                nbr_file.neighborsOf(3)
+            nbr_file = None
+
+            # reads the same as the equivalent text file
+            (binary_IDs, binary_neighbors, binary_distances) = nn_io._readNeighborArrays(
+                f, with_distances=with_distances)
+            (text_IDs, text_neighbors, text_distances) = nn_io._readNeighborArrays(
+                self._writeText(with_distances), with_distances=with_distances)
+            np.testing.assert_array_equal(binary_IDs, text_IDs)
+            np.testing.assert_array_equal(binary_neighbors, text_neighbors)
+            if with_distances:
+                np.testing.assert_allclose(binary_distances, text_distances, atol=1e-3)
+            else:
+                self.assertIsNone(binary_distances)
+                with self.assertRaises(ValueError):
+                    nn_io._readNeighborArrays(f, with_distances=True)
+
+if __name__ == '__main__':
+    unittest.main()
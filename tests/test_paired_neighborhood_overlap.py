@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from nearest_neighbors.analysis import paired_neighborhood_overlap as pno
+
+def _asDict(keys, neighbors):
+    return {
+        key: [(nbr, None) for nbr in row if nbr >= 0]
+            for (key, row) in zip(keys.tolist(), neighbors.tolist())
+    }
+
+class NeighborhoodOverlapArraysTestCase(unittest.TestCase):
+
+    def testMatchesDictOverlap(self):
+        keys_1 = np.array([0, 1, 2], dtype=np.int32)
+        neighbors_1 = np.array([[1, 2, 3], [0, 2, -1], [5, 5, 4]], dtype=np.int32)
+        keys_2 = np.array([0, 2, 3], dtype=np.int32)
+        neighbors_2 = np.array([[2, 3, 4], [4, 5, 6], [1, -1, -1]], dtype=np.int32)
+
+        (keys, overlaps) = pno.neighborhoodOverlapArrays(keys_1, neighbors_1,
+            keys_2, neighbors_2)
+        expected = pno.getNeighborhoodOverlap(_asDict(keys_1, neighbors_1),
+            _asDict(keys_2, neighbors_2))
+
+        self.assertEqual(keys.tolist(), sorted(expected.keys()))
+        for (key, overlap) in zip(keys.tolist(), overlaps.tolist()):
+            self.assertAlmostEqual(overlap, expected[key])
+
+    def testNoNeighborsInEitherSet(self):
+        keys_1 = np.array([0, 1], dtype=np.int32)
+        neighbors_1 = np.array([[1, 2], [-1, -1]], dtype=np.int32)
+        keys_2 = np.array([0, 1], dtype=np.int32)
+        neighbors_2 = np.array([[2, 3], [-1, -1]], dtype=np.int32)
+
+        with self.assertRaises(ZeroDivisionError):
+            pno.getNeighborhoodOverlap(_asDict(keys_1, neighbors_1),
+                _asDict(keys_2, neighbors_2))
+        with self.assertRaises(ZeroDivisionError):
+            pno.neighborhoodOverlapArrays(keys_1, neighbors_1, keys_2, neighbors_2)
+
+if __name__ == '__main__':
+    unittest.main()